@@ -19,6 +19,7 @@ from bossutils import aws
 from bossutils import logger
 
 from heaviside.activities import fanout
+from bossutils.fanout import fanout_step_functions
 
 log = logger.BossLogger().logger
 
@@ -60,6 +61,9 @@ def ingest_populate(args):
             'z_start': 0,
             'z_stop': 0
             'z_tile_size': 16,
+
+            'fanout_policy': None, # Optional bossutils.fanout policy, adapts the
+                                   # number of concurrent upload_sfn executions
         }
 
     Returns:
@@ -70,14 +74,22 @@ def ingest_populate(args):
 
     clear_queue(args['upload_queue'])
 
-    results = fanout(aws.get_session(),
-                     args['upload_sfn'],
-                     split_args(args),
-                     max_concurrent = MAX_NUM_PROCESSES,
-                     rampup_delay = RAMPUP_DELAY,
-                     rampup_backoff = RAMPUP_BACKOFF,
-                     poll_delay = POLL_DELAY,
-                     status_delay = STATUS_DELAY)
+    if args.get('fanout_policy') is None:
+        results = fanout(aws.get_session(),
+                         args['upload_sfn'],
+                         split_args(args),
+                         max_concurrent = MAX_NUM_PROCESSES,
+                         rampup_delay = RAMPUP_DELAY,
+                         rampup_backoff = RAMPUP_BACKOFF,
+                         poll_delay = POLL_DELAY,
+                         status_delay = STATUS_DELAY)
+    else:
+        results = fanout_step_functions(aws.get_session(),
+                                        args['upload_sfn'],
+                                        split_args(args),
+                                        args['fanout_policy'],
+                                        poll_delay = POLL_DELAY,
+                                        status_delay = STATUS_DELAY)
 
     total_sent = reduce(lambda x, y: x+y, results, 0)
 
@@ -0,0 +1,167 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the downsample_volume lambda code on the activity worker
+
+Instead of launching a StepFunction / Lambda per block, the blocks are
+processed by a pool of worker processes on the local host. This removes the
+lambda startup and per invocation overhead, which dominates for small and
+medium channels.
+
+Each worker allocates its volume buffers when it starts and installs them
+into bossutils.downsample.BUFFERS, where downsample_volume looks for them,
+so they are reused for every block the worker processes. The number of
+workers is limited so that their buffers fit in the host's available memory.
+If a worker dies, for example killed when the host runs out of memory, the
+downsample fails instead of waiting for the worker's block.
+
+Note: The activity worker needs the same packages as the downsample_volume
+      lambda (spdb, blosc, Pillow).
+"""
+
+import os
+import json
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from bossutils import logger
+from bossutils.downsample import BUFFERS
+
+log = logger.BossLogger().logger
+
+# str: Location of the downsample_volume lambda code
+DOWNSAMPLE_VOLUME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      '..', 'lambda', 'downsample_volume.py')
+
+# float: Memory each worker uses besides its volume buffers, in volumes
+#        (the decompression buffers and the output of each level)
+WORKER_OVERHEAD = 1.5
+
+# float: Fraction of the host's available memory the workers can use
+MEMORY_FRACTION = 0.8
+
+# int: Blocks queued for each worker, so a worker doesn't wait for its next block
+TASKS_PER_WORKER = 2
+
+# The downsample_volume module, loaded in each worker process
+_downsample_volume = None
+
+def load_downsample_volume():
+    """Import the downsample_volume lambda code"""
+    spec = importlib.util.spec_from_file_location('downsample_volume', DOWNSAMPLE_VOLUME_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def available_memory():
+    """Get the memory available to new processes, in bytes
+
+    Returns:
+        int|None: MemAvailable from /proc/meminfo, or None if it can't be read
+    """
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _init_worker(volumes, shape, dtype):
+    """Pool initializer, allocates the worker's volume buffers"""
+    global _downsample_volume
+    _downsample_volume = load_downsample_volume()
+
+    for i in range(volumes):
+        BUFFERS.set('volume-{}'.format(i), np.zeros(shape, dtype=dtype))
+
+def _run(task):
+    """Run downsample_volume for one set of arguments
+
+    Args:
+        task (int, str): Index of the arguments and the JSON encoded arguments,
+                         decoded the same as a lambda invocation
+
+    Returns:
+        int: The index of the arguments
+    """
+    index, sub_args = task
+    _downsample_volume.handler(json.loads(sub_args), None)
+    return index
+
+def downsample_local(sub_args, shape, data_type, processes=None, progress=None, batched=False):
+    """Run downsample_volume for each set of arguments on a local process pool
+
+    If any invocation fails, or a worker process dies (BrokenProcessPool), the
+    blocks that haven't started are cancelled and the error raised.
+
+    Args:
+        sub_args (iterable[dict]): downsample_volume lambda arguments
+        shape (tuple): ZYX shape of the volume each invocation loads (dim * block)
+        data_type (str): 'uint8' | 'uint16' | 'uint64'
+        processes (optional[int]): Number of worker processes (default the number of CPUs)
+                                   Reduced if the workers' buffers don't fit in MEMORY_FRACTION
+                                   of the available memory
+        progress (optional[callable]): Called with a list of the indices (into sub_args)
+                                       of each invocation as it finishes
+        batched (bool): If the arguments contain multiple 'targets', in which case
+                        downsample_volume double buffers the volumes
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    shape = tuple(int(v) for v in shape)
+    dtype = np.dtype(data_type)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    volumes = 2 if batched else 1
+
+    available = available_memory()
+    if available is not None:
+        per_worker = int((volumes + WORKER_OVERHEAD) * nbytes)
+        limit = max(int(available * MEMORY_FRACTION) // per_worker, 1)
+        if limit < processes:
+            log.warning("Only {} MB of memory is available, using {} processes instead of {}".format(
+                        available // 2**20, limit, processes))
+            processes = limit
+
+    log.debug("Downsampling locally with {} processes, {} MB of volume buffers".format(
+              processes, processes * volumes * nbytes // 2**20))
+
+    tasks = ((index, json.dumps(args)) for index, args in enumerate(sub_args))
+
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(processes, context, _init_worker, (volumes, shape, dtype)) as executor:
+        pending = set()
+        def finish():
+            nonlocal pending
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if progress is not None:
+                progress([future.result() for future in done if future.exception() is None])
+            for future in done:
+                future.result() # Raise the first error
+
+        try:
+            for task in tasks:
+                if len(pending) >= processes * TASKS_PER_WORKER:
+                    finish()
+                pending.add(executor.submit(_run, task))
+
+            while pending:
+                finish()
+        finally:
+            for future in pending:
+                future.cancel()
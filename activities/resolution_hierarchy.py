@@ -12,13 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import bisect
+import threading
+import numpy as np
+
 from bossutils import aws, logger
+from bossutils.dirty_cubes import DirtyCubeTracker, now
 from spdb.c_lib.ndtype import CUBOIDSIZE
 
 from bossutils.multidimensional import XYZ, ceildiv
 from bossutils.multidimensional import range as xyz_range
+from bossutils.multidimensional import morton_range, morton_encode, morton_decode
 
 from heaviside.activities import fanout
+from bossutils.fanout import fanout_step_functions, CloudWatchThrottles
+from local_downsample import downsample_local
 
 log = logger.BossLogger().logger
 
@@ -40,6 +49,23 @@ RAMPUP_DELAY = 15
 #        When RAMPUP_DELAY is zero there is no longer a delay between launched
 RAMPUP_BACKOFF = 0.8
 
+# int: The maximum number of resolutions a single downsample_volume invocation
+#      can generate when the 'downsample_levels' argument is given
+MAX_DOWNSAMPLE_LEVELS = 3
+
+# int - MB: The maximum memory for the volume buffers of a downsample_volume
+#           invocation. Fewer levels are generated if step ** levels cubes of
+#           the channel's data type don't fit
+MAX_VOLUME_MEMORY = 1024
+
+# str: The S3 Index table index used to look up all of the cubes for a channel
+S3_INDEX_TABLE_INDEX = 'ingest-job-index'
+
+# int: Maximum number of populated cubes whose OccupancyIndex is passed to the
+#      next resolution in the returned arguments, instead of re-reading the S3
+#      Index. Bounded as the Step Function state is limited to 256KB
+MAX_OCCUPANCY_STATE = 4096
+
 def downsample_channel(args):
     """
     Slice the given channel into chunks of 2x2x2 or 2x2x1 cubes that are then
@@ -80,6 +106,56 @@ def downsample_channel(args):
 
             type (str) 'isotropic' | 'anisotropic'
             iso_resolution (int) if resolution >= iso_resolution && type == 'anisotropic' downsample both
+
+            downsample_levels (optional[int]) The number of resolutions to generate in a single pass
+                                              Each downsample_volume invocation loads step ** levels cubes
+                                              and writes every intermediate resolution (default 1)
+                                              Limited to MAX_DOWNSAMPLE_LEVELS and MAX_VOLUME_MEMORY
+            skip_empty (optional[bool]) If the S3 Index should be used to only launch downsample_volume
+                                        for blocks that contain data (default False)
+            occupancy (optional[dict]) Set when skip_empty is, the populated cubes of the next resolution,
+                                       propagated from the blocks that were downsampled, so the next
+                                       iteration doesn't re-read the S3 Index (see save_occupancy)
+            downsample_batch_size (optional[int]) The number of blocks each downsample_volume invocation
+                                                  should process (default 1)
+            incremental (optional[bool]) Only downsample the blocks containing resolution 0 cubes recorded in
+                                         the dirty cube table, which are cleared after the last resolution
+            dirty_cube_table (optional[str]) Name of the DynamoDB dirty cube table, required for incremental
+            dirty_before (optional[int]) Set on the first incremental iteration, only cubes dirtied before
+                                         this time (ms) are downsampled
+            skip_unchanged (optional[bool]) Passed to downsample_volume, don't upload or index downsampled
+                                            cubes whose content digest matches the S3 Index (default False)
+            downsample_method (optional[str]) Passed to downsample_volume, the bossutils.downsample reducer
+                                              to use, such as 'nearest' for fast preview pyramids
+                                              (default bilinear resize for images, ndlib for annotations)
+            memory_limit (optional[int]) Passed to downsample_volume, MB of buffers an annotation downsample
+                                         can use before the volume is streamed through in slabs
+            downsample_order (optional[str]) 'xyz' | 'morton' The order to process the blocks in (default 'xyz')
+                                             Morton order keeps batches of blocks spatially adjacent
+            downsample_cursor (optional[int]) Morton ID of the first downsampled cube to generate, used to
+                                              resume a partially completed resolution. Requires 'morton' order
+                                              and is cleared once the resolution is finished
+            downsample_cursor_config (optional[str]) 'anisotropic' | 'isotropic' The downsample the cursor
+                                                     resumes. Required if the resolution has both
+                                                     (default the only downsample). Must be
+                                                     'isotropic' if the downsamples are fused
+            fanout_policy (optional[str|dict]) Adapt the number of concurrent downsample_volume executions
+                                               using the given bossutils.fanout policy, instead of a fixed
+                                               MAX_NUM_PROCESSES (see bossutils.fanout.create_policy)
+                                               S3 throttling is only seen if the s3_bucket has an
+                                               'EntireBucket' request metrics configuration
+            downsample_progress_table (optional[str]) Name of a DynamoDB table to checkpoint the completed
+                                                      blocks of each resolution in. If the activity is
+                                                      retried the completed blocks are skipped. Uses
+                                                      'morton' order by default and requires it
+            downsample_executor (optional[str]) 'lambda' | 'local' Where to run downsample_volume. 'local'
+                                                runs it on a process pool on the activity worker, for
+                                                channels where lambda overhead dominates (default 'lambda')
+            local_processes (optional[int]) Number of processes for the 'local' executor
+                                            (default the number of CPUs)
+            fuse_iso (optional[bool]) At iso_resolution, generate the anisotropic and isotropic cubes from
+                                      a single read of each 2x2x2 block, instead of two separate passes
+                                      over the same source cubes (default False)
         }
     """
 
@@ -122,16 +198,59 @@ def downsample_channel(args):
                 'frame_stop_key': 'iso_{}_stop',
             })
 
+    levels = downsample_levels(args, configs)
+    fused = fuse_configs(args, configs)
+
+    # Occupancy of the source cubes, keyed by the ISO flag of the source data
+    # Propagated from the previous resolution if it was small enough to pass along
+    occupancy = load_occupancy(args.pop('occupancy', None), resolution)
+
+    def source_occupancy(iso):
+        if iso not in occupancy:
+            occupancy[iso] = OccupancyIndex.from_s3_index(aws.get_session(), args, resolution, iso)
+        return occupancy[iso]
+
+    # Occupancy of the generated cubes, keyed by their ISO flag
+    generated = {}
+
+    # The dirty resolution 0 cubes, for an incremental downsample
+    dirty = None
+    if args.get('incremental', False):
+        tracker = DirtyCubeTracker(args['dirty_cube_table'], aws.get_session().client('dynamodb'))
+        dirty_key = DirtyCubeTracker.channel_key('{}&{}&{}'.format(args['collection_id'],
+                                                                   args['experiment_id'],
+                                                                   args['channel_id']), 0)
+        if 'dirty_before' not in args:
+            args['dirty_before'] = now()
+        dirty = tracker.dirty(dirty_key, args['dirty_before'])
+        log.debug("Dirty resolution 0 cubes: {}".format(len(dirty)))
+
+    # Checkpoints of the completed blocks, keyed by config name
+    progress = {}
+
+    # The cursor only applies to the downsample that was interrupted
+    cursor_config = None
+    if args.get('downsample_cursor') is not None:
+        cursor_config = args.get('downsample_cursor_config')
+        if cursor_config is None:
+            if len(configs) > 1:
+                raise ValueError("'downsample_cursor_config' is required to resume one of two downsamples")
+            cursor_config = configs[0]['name']
+
+        # The anisotropic blocks before the cursor are done, but not the isotropic ones
+        if fused and cursor_config != 'isotropic':
+            raise ValueError("A fused downsample can only be resumed with an 'isotropic' cursor")
+
     for config in configs:
         frame_start = frame(config['frame_start_key'])
         frame_stop = frame(config['frame_stop_key'])
         step = config['step']
+        block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
         use_iso_flag = config['iso_flag'] # If the resulting cube should be marked with the ISO flag
         index_annotations = args['resolution'] < (args['annotation_index_max'] - 1)
 
-        # Round to the furthest full cube from the center of the data
-        cubes_start = frame_start // dim
-        cubes_stop = ceildiv(frame_stop, dim)
+        # The blocks of source cubes that overlap the frame, aligned to the block grid
+        cubes_start, cubes_stop = frame_blocks(frame_start, frame_stop, dim, block)
 
         log.debug('Downsampling {} resolution {}'.format(config['name'], resolution))
         log.debug("Frame corner: {}".format(frame_start))
@@ -139,31 +258,91 @@ def downsample_channel(args):
         log.debug("Cubes corner: {}".format(cubes_start))
         log.debug("Cubes extent: {}".format(cubes_stop))
         log.debug("Downsample step: {}".format(step))
+        log.debug("Downsample levels: {}".format(levels))
         log.debug("Indexing Annotations: {}".format(index_annotations))
 
+        # The first isotropic downsample reads the anisotropic data
+        parent_iso = use_iso_flag and resolution != args['iso_resolution']
+
+        if fused and not use_iso_flag:
+            # The anisotropic cubes are generated by the fused isotropic pass
+            log.debug("Fused with the isotropic downsample")
+            if dirty is None and args.get('skip_empty', False):
+                # Both passes read the anisotropic cubes, loaded once for the isotropic pass
+                generated[use_iso_flag] = source_occupancy(False).parents(block)
+            resize_frame(args, config, block)
+            continue
+
+        blocks = None
+        if dirty is not None:
+            blocks = dirty_index(args, dirty, resolution, parent_iso).parents(block)
+            log.debug("Dirty blocks: {}".format(len(blocks)))
+        elif args.get('skip_empty', False):
+            # The blocks are keyed by the coordinates of the cubes they generate
+            blocks = generated[use_iso_flag] = source_occupancy(parent_iso).parents(block)
+            log.debug("Populated blocks: {}".format(len(blocks)))
+
+        completed = None
+        if args.get('downsample_progress_table'):
+            completed = progress[config['name']] = DownsampleProgress(aws.get_session(), args, config['name'], block)
+            completed.load()
+
         # Call the downsample_volume lambda to process the data
-        fanout(aws.get_session(),
-               args['downsample_volume_sfn'],
-               make_args(args, cubes_start, cubes_stop, step, dim, use_iso_flag, index_annotations),
-               max_concurrent = MAX_NUM_PROCESSES,
-               rampup_delay = RAMPUP_DELAY,
-               rampup_backoff = RAMPUP_BACKOFF,
-               poll_delay = POLL_DELAY,
-               status_delay = STATUS_DELAY)
-
-        # Resize the coordinate frame extents as the data shrinks
-        # DP NOTE: doesn't currently work correctly with non-zero frame starts
-        def resize(var, size):
-            start = config['frame_start_key'].format(var)
-            stop = config['frame_stop_key'].format(var)
-            args[start] //= size
-            args[stop] = ceildiv(args[stop], size)
-        resize('x', step.x)
-        resize('y', step.y)
-        resize('z', step.z)
+        cursor = args['downsample_cursor'] if config['name'] == cursor_config else None
+        sub_args = make_args(args, cubes_start, cubes_stop, step, dim, use_iso_flag, index_annotations, levels, blocks,
+                             completed, cursor, fuse_anisotropic = fused)
+        if args.get('downsample_executor', 'lambda') == 'local':
+            # Run the downsample_volume code on this host
+            downsample_local(sub_args if completed is None else completed.track(sub_args),
+                             (dim * block).zyx,
+                             args['data_type'],
+                             processes = args.get('local_processes'),
+                             progress = None if completed is None else completed.finished,
+                             batched = args.get('downsample_batch_size', 1) > 1)
+        elif completed is None and args.get('fanout_policy') is None:
+            fanout(aws.get_session(),
+                   args['downsample_volume_sfn'],
+                   sub_args,
+                   max_concurrent = MAX_NUM_PROCESSES,
+                   rampup_delay = RAMPUP_DELAY,
+                   rampup_backoff = RAMPUP_BACKOFF,
+                   poll_delay = POLL_DELAY,
+                   status_delay = STATUS_DELAY)
+        else:
+            if args.get('fanout_policy') is None:
+                # Progress is reported by the adaptive fanout, run the same as heaviside's fanout
+                policy, metrics, rampup_delay = {'name': 'static', 'concurrency': MAX_NUM_PROCESSES}, None, RAMPUP_DELAY
+            else:
+                # Throttling of the resources the downsample_volume lambda uses
+                # The S3 metric needs a request metrics configuration on the bucket
+                policy, rampup_delay = args['fanout_policy'], 0
+                metrics = CloudWatchThrottles.dynamodb(args['s3_index']) + \
+                          CloudWatchThrottles.dynamodb(args['id_index']) + \
+                          CloudWatchThrottles.s3(args['s3_bucket'])
+            fanout_step_functions(aws.get_session(),
+                                  args['downsample_volume_sfn'],
+                                  sub_args if completed is None else completed.track(sub_args),
+                                  policy,
+                                  throttle_metrics = metrics,
+                                  poll_delay = POLL_DELAY,
+                                  status_delay = STATUS_DELAY,
+                                  progress = None if completed is None else completed.finished,
+                                  rampup_delay = rampup_delay,
+                                  rampup_backoff = RAMPUP_BACKOFF)
+
+        resize_frame(args, config, block)
+
+    # Pass the occupancy of the generated cubes on to the next resolution
+    state = save_occupancy(generated, resolution + levels)
+    if state is not None:
+        args['occupancy'] = state
+
+    # The cursor only applies to the resolution that was interrupted
+    args.pop('downsample_cursor', None)
+    args.pop('downsample_cursor_config', None)
 
     # if next iteration will split into aniso and iso downsampling, copy the coordinate frame
-    if args['type'] != 'isotropic' and (resolution + 1) == args['iso_resolution']:
+    if args['type'] != 'isotropic' and (resolution + levels) == args['iso_resolution']:
         def copy(var):
             args['iso_{}_start'.format(var)] = args['{}_start'.format(var)]
             args['iso_{}_stop'.format(var)] = args['{}_stop'.format(var)]
@@ -174,19 +353,556 @@ def downsample_channel(args):
     # Advance the loop and recalculate the conditional
     # Using max - 1 because resolution_max should not be a valid resolution
     # and res < res_max will end with res = res_max - 1, which generates res_max resolution
-    args['resolution'] = resolution + 1
+    args['resolution'] = resolution + levels
     args['res_lt_max'] = args['resolution'] < (args['resolution_max'] - 1)
+
+    # The resolution is finished, so a retry of a later resolution shouldn't skip blocks
+    for completed in progress.values():
+        completed.clear()
+
+    # The whole hierarchy has been regenerated for the dirty cubes
+    if dirty is not None and not args['res_lt_max']:
+        tracker.clear(dirty_key, dirty, args['dirty_before'])
+
     return args
 
-def make_args(args, start, stop, step, dim, use_iso_flag, index_annotations):
-    for target in xyz_range(start, stop, step = step):
-        yield {
+def load_occupancy(state, resolution):
+    """Load the occupancy propagated from the previous resolution
+
+    Args:
+        state (optional[dict]): See save_occupancy
+        resolution (int): The resolution being downsampled
+
+    Returns:
+        dict: OccupancyIndex of the cubes of the resolution, keyed by ISO flag
+              Empty if the state is missing or for a different resolution
+    """
+    if state is None or state['resolution'] != resolution:
+        return {}
+    return {iso == 'iso': OccupancyIndex(np.array(mortons, dtype=np.uint64))
+            for iso, mortons in state['mortons'].items()}
+
+def save_occupancy(generated, resolution):
+    """Create the state that passes the occupancy of the generated cubes on
+
+    Args:
+        generated (dict): OccupancyIndex of the generated cubes, keyed by ISO flag
+        resolution (int): The resolution of the generated cubes
+
+    Returns:
+        optional[dict]: {'resolution': int, 'mortons': {'iso' | 'noiso': list[int]}}
+                        None if the indices have more than MAX_OCCUPANCY_STATE cubes, in
+                        which case the next resolution reads the S3 Index
+    """
+    if len(generated) == 0:
+        return None
+
+    if sum(len(index) for index in generated.values()) > MAX_OCCUPANCY_STATE:
+        return None
+
+    return {
+        'resolution': resolution,
+        'mortons': {'iso' if iso else 'noiso': [int(morton) for morton in index.mortons]
+                    for iso, index in generated.items()},
+    }
+
+def resize_frame(args, config, block):
+    """Resize the coordinate frame extents of a config as the data shrinks
+
+    The start is rounded down and the stop up, so the new extents are the
+    exact voxels containing downsampled data, for any frame start.
+
+    Args:
+        args (dict): The downsample_channel arguments, updated in place
+        config (dict): The downsample configuration
+        block (XYZ): Number of cubes downsampled into a single cube
+    """
+    def resize(var, size):
+        start = config['frame_start_key'].format(var)
+        stop = config['frame_stop_key'].format(var)
+        args[start] //= size
+        args[stop] = ceildiv(args[stop], size)
+    resize('x', block.x)
+    resize('y', block.y)
+    resize('z', block.z)
+
+def fuse_configs(args, configs):
+    """Figure out if the anisotropic and isotropic downsamples can be fused
+
+    Only at iso_resolution do both downsamples read the same (anisotropic)
+    source cubes. Above it the isotropic downsample reads the ISO cubes, so
+    there is no shared data to load once.
+
+    Args:
+        args (dict): The downsample_channel arguments
+        configs (list): The downsample configurations for this iteration
+
+    Returns:
+        bool: If a single isotropic pass should also generate the anisotropic cubes
+    """
+    if not args.get('fuse_iso', False) or len(configs) != 2:
+        return False
+
+    if args['resolution'] != args['iso_resolution']:
+        return False
+
+    # Both passes have to cover the same blocks
+    for var in ('x', 'y', 'z'):
+        if args['{}_start'.format(var)] != args['iso_{}_start'.format(var)] or \
+           args['{}_stop'.format(var)] != args['iso_{}_stop'.format(var)]:
+            log.warning("Anisotropic and isotropic frames differ, not fusing")
+            return False
+
+    return True
+
+def dirty_index(args, mortons, resolution, iso):
+    """Propagate dirty resolution 0 cubes up to the given resolution
+
+    Args:
+        args (dict): The downsample_channel arguments
+        mortons (np.array): Morton IDs of the dirty resolution 0 cubes
+        resolution (int): Resolution to propagate the cubes to
+        iso (bool): If the isotropic cubes of the resolution are wanted
+
+    Returns:
+        OccupancyIndex: The cubes of the resolution affected by the dirty cubes
+    """
+    index = OccupancyIndex(mortons)
+    for res in range(resolution):
+        # Isotropic data is generated from the anisotropic data at iso_resolution
+        if args['type'] == 'isotropic' or (iso and res >= args['iso_resolution']):
+            step = XYZ(2,2,2)
+        else:
+            step = XYZ(2,2,1)
+        index = index.parents(step)
+    return index
+
+def downsample_levels(args, configs):
+    """Figure out how many resolutions to generate in this iteration
+
+    Multiple levels are only generated when a single downsample is happening
+    and will stop at iso_resolution, so that the isotropic coordinate frame
+    can be split off, and at resolution_max. The levels are also limited so
+    the buffers of a downsample_volume invocation fit in MAX_VOLUME_MEMORY.
+
+    Args:
+        args (dict): The downsample_channel arguments
+        configs (list): The downsample configurations for this iteration
+
+    Returns:
+        int: The number of resolutions to generate
+    """
+    resolution = args['resolution']
+    levels = min(args.get('downsample_levels', 1), MAX_DOWNSAMPLE_LEVELS)
+
+    if len(configs) > 1:
+        return 1
+
+    # Using max - 1 because resolution_max should not be a valid resolution
+    levels = min(levels, args['resolution_max'] - 1 - resolution)
+    if args['type'] != 'isotropic' and resolution < args['iso_resolution']:
+        levels = min(levels, args['iso_resolution'] - resolution)
+
+    # All of the generated cubes need to be the same size
+    dim = CUBOIDSIZE[resolution]
+    while levels > 1 and CUBOIDSIZE[resolution + levels] != dim:
+        levels -= 1
+
+    step = configs[0]['step']
+    while levels > 1 and volume_memory(args, step, levels) > MAX_VOLUME_MEMORY * 2**20:
+        log.debug("{} levels don't fit in {} MB".format(levels, MAX_VOLUME_MEMORY))
+        levels -= 1
+
+    return max(levels, 1)
+
+def volume_memory(args, step, levels):
+    """Estimate the bytes of buffers a downsample_volume invocation uses
+
+    Counts the loaded volume, a second volume if blocks are batched (the next
+    block is loaded while the current one is downsampled), and the output of
+    every level.
+
+    Args:
+        args (dict): The downsample_channel arguments
+        step (XYZ): Number of cubes downsampled into a single cube
+        levels (int): Number of resolutions to generate
+
+    Returns:
+        int: Number of bytes
+    """
+    dim = XYZ(*CUBOIDSIZE[args['resolution']])
+    block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+    volume = int(np.prod((dim * block).zyx)) * np.dtype(args['data_type']).itemsize
+
+    volumes = 2 if args.get('downsample_batch_size', 1) > 1 else 1
+    outputs = sum(volume // int(np.prod(step)) ** level for level in range(1, levels + 1))
+    return volumes * volume + outputs
+
+def frame_blocks(frame_start, frame_stop, dim, block):
+    """Compute the minimal range of blocks that cover a frame
+
+    The blocks are aligned to multiples of the block size, so the cubes of each
+    block downsample into whole cubes at the lower resolution. Only blocks
+    containing a cube that overlaps the frame are included, for any frame start.
+
+    Args:
+        frame_start (XYZ): First voxel of the frame
+        frame_stop (XYZ): Last voxel (exclusive) of the frame
+        dim (XYZ): Dimensions of a single cube
+        block (XYZ): Number of cubes in each block
+
+    Returns:
+        (XYZ, XYZ): The first cube of the first block and the last cube
+                    (exclusive) of the last blocks, both multiples of block
+    """
+    cubes_start = frame_start // dim
+    cubes_stop = ceildiv(frame_stop, dim)
+
+    blocks_start = (cubes_start // block) * block
+    blocks_stop = ceildiv(cubes_stop, block) * block
+
+    # An empty frame has no blocks
+    if any(frame_stop[i] <= frame_start[i] for i in range(3)):
+        blocks_stop = blocks_start
+
+    return blocks_start, blocks_stop
+
+def make_args(args, start, stop, step, dim, use_iso_flag, index_annotations, levels=1, blocks=None, completed=None,
+              cursor=None, fuse_anisotropic=False):
+    """Generate the downsample_volume arguments for every block of the frame
+
+    If args['downsample_batch_size'] is greater than one, the blocks are grouped
+    and each set of arguments contains a list of 'targets' instead of a single
+    'target'.
+
+    Args:
+        blocks (optional[OccupancyIndex]): If given, only blocks in the index are
+                                           downsampled. Keyed by the block coordinate
+                                           (target // step ** levels)
+        completed (optional[DownsampleProgress]): If given, blocks that were already
+                                                  completed are skipped
+        cursor (optional[int]): Morton ID of the first block to generate
+        fuse_anisotropic (bool): If downsample_volume should also generate the
+                                 anisotropic cubes of each isotropic block
+    """
+    batch_size = args.get('downsample_batch_size', 1)
+    order = args.get('downsample_order', 'xyz' if completed is None else 'morton')
+    if completed is not None:
+        if order != 'morton':
+            raise ValueError("Downsample checkpoints require 'morton' order")
+        if completed.cursor is not None:
+            cursor = max(cursor or 0, completed.cursor)
+
+    def make(**target):
+        sub_args = {
             'lambda-name' : 'downsample_volume', # name of the function in multiLambda to call
             'args': args,
-            'target': target, # XYZ type is automatically handled by JSON.dumps
-            'step': step,     # Since it is a subclass of tuple
-            'dim': dim,
+            'step': step,     # XYZ type is automatically handled by JSON.dumps
+            'dim': dim,       # Since it is a subclass of tuple
             'use_iso_flag': use_iso_flag,
             'index_annotations': index_annotations,
+            'levels': levels,
         }
+        if fuse_anisotropic:
+            sub_args['fuse_anisotropic'] = True
+        sub_args.update(target)
+        return sub_args
+
+    batch = []
+    block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+    for target in make_targets(start, stop, step, levels, blocks, order, cursor):
+        if completed is not None and (target // block).morton in completed:
+            continue
+
+        if batch_size <= 1:
+            yield make(target = target)
+            continue
+
+        batch.append(target)
+        if len(batch) == batch_size:
+            yield make(targets = batch)
+            batch = []
+
+    if len(batch) > 0:
+        yield make(targets = batch)
+
+def make_targets(start, stop, step, levels=1, blocks=None, order='xyz', cursor=None):
+    """Generate the corner of every block of the frame to downsample
+
+    In 'morton' order the blocks are generated in the Morton order of the
+    downsampled cubes, so consecutive blocks are spatially adjacent and the
+    traversal can be resumed from the Morton ID of a downsampled cube.
+
+    If blocks is given only its entries are decoded, instead of visiting
+    every block of the frame, so an incremental downsample of a few cubes
+    doesn't depend on the size of the frame.
+
+    Args:
+        start (XYZ): First cube of the frame
+        stop (XYZ): Last cube (exclusive) of the frame
+        step (XYZ): Number of cubes downsampled into a single cube
+        levels (int): Number of resolutions generated by each block
+        blocks (optional[OccupancyIndex]): If given, only blocks in the index are yielded
+        order (str): 'xyz' | 'morton'
+        cursor (optional[int]): Morton ID of the first block to yield, only used for 'morton' order
+
+    Returns:
+        generator[XYZ]
+
+    Raises:
+        ValueError: If the order is unknown or a cursor is given for 'xyz' order
+    """
+    block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+    if order not in ('xyz', 'morton'):
+        raise ValueError("Unknown downsample order '{}'".format(order))
+    if order == 'xyz' and cursor is not None:
+        raise ValueError("A downsample cursor requires 'morton' order")
+
+    if blocks is not None:
+        yield from blocks.targets(start, stop, block, order, cursor)
+    elif order == 'morton':
+        yield from morton_range(start, stop, step = block, cursor = cursor)
+    else:
+        yield from xyz_range(start, stop, step = block)
+
+class DownsampleProgress(object):
+    """Checkpoint of the blocks of a resolution that have been downsampled
+
+    The blocks are processed in Morton order, so the progress is stored as a
+    cursor, the Morton ID of the first block that may not be complete, and
+    the [start, stop) Morton ranges of the blocks after the cursor that are
+    complete. Only sub-executions that run out of order create ranges, so the
+    record stays small.
+
+    The record is a DynamoDB item in args['downsample_progress_table'] with
+        hash key: 'progress-key' (S) 'col_id&exp_id&chan_id&resolution&config'
+        'block' (S): The block size the record was created with
+        'cursor' (N), 'ranges' (S): JSON list of [start, stop] ranges
+        'updated' (N): Time of the last update, in milliseconds
 
+    Args:
+        session (Session): Boto3 session
+        args (dict): The downsample_channel arguments
+        config (str): Name of the downsample config, 'anisotropic' | 'isotropic'
+        block (XYZ): Number of cubes in each block
+    """
+    def __init__(self, session, args, config, block):
+        self.client = session.client('dynamodb')
+        self.table = args['downsample_progress_table']
+        self.key = {'progress-key': {'S': '{}&{}&{}&{}&{}'.format(args['collection_id'],
+                                                                  args['experiment_id'],
+                                                                  args['channel_id'],
+                                                                  args['resolution'],
+                                                                  config)}}
+        self.block = block
+
+        self.cursor = None
+        self.ranges = [] # Completed ranges from the loaded checkpoint
+        self.spans = [] # [start, stop) of each tracked sub-execution's blocks
+        self.done = []
+        self.first = 0 # Index of the first incomplete span
+        self.tracked = False # If every sub-execution has been tracked
+        self.lock = threading.Lock() # Executors may track and finish on different threads
+
+    def load(self):
+        """Load the checkpoint from a previous attempt"""
+        resp = self.client.get_item(TableName = self.table,
+                                    Key = self.key,
+                                    ConsistentRead = True)
+        item = resp.get('Item')
+        if item is None or item['block']['S'] != str(list(self.block)):
+            return
+
+        self.cursor = int(item['cursor']['N'])
+        self.ranges = [tuple(r) for r in json.loads(item['ranges']['S'])]
+        log.debug("Resuming from block {} with {} completed ranges".format(self.cursor, len(self.ranges)))
+
+    def __contains__(self, morton):
+        if self.cursor is not None and morton < self.cursor:
+            return True
+        return any(start <= morton < stop for start, stop in self.ranges)
+
+    def track(self, sub_args):
+        """Record the blocks of each set of downsample_volume arguments
+
+        Returns:
+            generator: sub_args
+        """
+        for sub_args_ in sub_args:
+            targets = sub_args_['targets'] if 'targets' in sub_args_ else [sub_args_['target']]
+            mortons = [(XYZ(*target) // self.block).morton for target in targets]
+            with self.lock:
+                self.spans.append((min(mortons), max(mortons) + 1))
+                self.done.append(False)
+            yield sub_args_
+
+        with self.lock:
+            self.tracked = True
+
+    def finished(self, indices):
+        """Mark the tracked sub-executions as complete and save the checkpoint
+
+        Args:
+            indices (list[int]): Indices of the sub-executions, in the order they were tracked
+        """
+        with self.lock:
+            for index in indices:
+                self.done[index] = True
+            while self.first < len(self.done) and self.done[self.first]:
+                self.first += 1
+
+            # Spans are in Morton order, the complete spans after the first
+            # incomplete span need to be recorded as ranges
+            spans = list(zip(self.spans[self.first:], self.done[self.first:]))
+            if self.first < len(self.spans):
+                cursor = self.spans[self.first][0]
+            else:
+                cursor = self.spans[-1][1] if self.spans else (self.cursor or 0)
+            tracked = self.tracked
+            tail = self.spans[-1][1] if self.spans else cursor
+            finished = self.first == len(self.spans) and tracked
+
+        incomplete = [span for span, done in spans if not done]
+        complete = [span for span, done in spans if done]
+        complete += [range_ for range_ in self.ranges if range_[1] > cursor]
+        complete.sort()
+
+        # The blocks after the last tracked span haven't been launched yet
+        if not tracked:
+            incomplete.append((tail, float('inf')))
+
+        # Blocks between two complete ranges don't need to be processed, unless
+        # they are part of an incomplete or untracked span, so the ranges are merged
+        stops = [stop for start, stop in incomplete]
+        def blocked(start, stop):
+            i = bisect.bisect_right(stops, start)
+            return i < len(incomplete) and incomplete[i][0] < stop
+
+        ranges = []
+        for start, stop in complete:
+            if ranges and (start <= ranges[-1][1] or not blocked(ranges[-1][1], start)):
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+
+        if finished: # Everything is complete
+            cursor = max([cursor] + [stop for start, stop in ranges])
+            ranges = []
+
+        self.client.put_item(TableName = self.table,
+                             Item = dict(self.key,
+                                         **{'block': {'S': str(list(self.block))},
+                                            'cursor': {'N': str(cursor)},
+                                            'ranges': {'S': json.dumps(ranges)},
+                                            'updated': {'N': str(now())}}))
+
+    def clear(self):
+        """Remove the checkpoint"""
+        self.client.delete_item(TableName = self.table,
+                                Key = self.key)
+
+class OccupancyIndex(object):
+    """Compact index of the cubes of a resolution that contain data
+
+    Stores the sorted Morton IDs of the populated cubes in a numpy array, which
+    takes 8 bytes per populated cube, independent of the size of the
+    coordinate frame.
+
+    Args:
+        mortons (iterable|np.array): Morton IDs of the populated cubes
+    """
+    def __init__(self, mortons):
+        if not isinstance(mortons, np.ndarray):
+            mortons = np.fromiter(mortons, dtype=np.uint64)
+        self.mortons = np.unique(mortons.astype(np.uint64))
+
+    def __len__(self):
+        return len(self.mortons)
+
+    def __contains__(self, morton):
+        idx = np.searchsorted(self.mortons, morton)
+        return idx < len(self.mortons) and self.mortons[idx] == morton
+
+    def parents(self, step):
+        """Propagate the index to the next resolution
+
+        Args:
+            step (XYZ): The number of cubes downsampled into a single cube
+
+        Returns:
+            OccupancyIndex: Index of the cubes that will be generated by
+                            downsampling the populated cubes
+        """
+        coords = morton_decode(self.mortons) // np.array(step, dtype=np.uint64)
+        return OccupancyIndex(morton_encode(coords))
+
+    def targets(self, start, stop, block, order='xyz', cursor=None):
+        """Generate the corners of the indexed blocks within a frame
+
+        Yields the same targets as filtering make_targets' traversal of the
+        frame by the index, without visiting the blocks that aren't indexed.
+
+        Args:
+            start (XYZ): First cube of the frame
+            stop (XYZ): Last cube (exclusive) of the frame
+            block (XYZ): Number of cubes in each block, the index is keyed by target // block
+            order (str): 'xyz' | 'morton'
+            cursor (optional[int]): Morton ID of the first block to yield
+
+        Returns:
+            generator[XYZ]
+        """
+        mortons = self.mortons
+        if cursor is not None:
+            mortons = mortons[mortons >= np.uint64(cursor)]
+
+        # Offsets, in blocks, from the first block of the frame
+        first = start // block
+        count = ceildiv(stop - start, block)
+        offsets = morton_decode(mortons).astype(np.int64) - np.array(first, dtype=np.int64)
+        inside = np.all((offsets >= 0) & (offsets < np.array(count, dtype=np.int64)), axis=1)
+        offsets = offsets[inside]
+
+        # The index is in Morton order, xyz order is X major like bossutils.multidimensional.range
+        if order == 'xyz':
+            offsets = offsets[np.lexsort((offsets[:, 2], offsets[:, 1], offsets[:, 0]))]
+
+        for x, y, z in offsets:
+            yield start + XYZ(int(x), int(y), int(z)) * block
+
+    @classmethod
+    def from_s3_index(cls, session, args, resolution, iso):
+        """Build the index from the S3 Index entries of a channel's resolution
+
+        Args:
+            session (Session): Boto3 session
+            args (dict): The downsample_channel arguments
+            resolution (int): The resolution to index
+            iso (bool): If the isotropic (ISO flagged) cubes should be indexed
+
+        Returns:
+            OccupancyIndex
+        """
+        client = session.client('dynamodb')
+        paginator = client.get_paginator('query')
+        # ingest-job-range is 'exp&chan&res&ingest_job'
+        prefix = '{}&{}&{}&'.format(args['experiment_id'], args['channel_id'], resolution)
+        pages = paginator.paginate(TableName = args['s3_index'],
+                                   IndexName = S3_INDEX_TABLE_INDEX,
+                                   KeyConditionExpression = '#hash = :hash AND begins_with(#range, :range)',
+                                   ExpressionAttributeNames = {'#hash': 'ingest-job-hash',
+                                                               '#range': 'ingest-job-range',
+                                                               '#key': 'object-key'},
+                                   ExpressionAttributeValues = {':hash': {'S': str(args['collection_id'])},
+                                                                ':range': {'S': prefix}},
+                                   ProjectionExpression = '#key')
+
+        def mortons():
+            for page in pages:
+                for item in page['Items']:
+                    # object-key is 'digest&[ISO&]col&exp&chan&res&t&morton'
+                    parts = item['object-key']['S'].split('&')
+                    if (parts[1] == 'ISO') == iso and parts[-2] == '0':
+                        yield int(parts[-1])
+
+        return cls(mortons())
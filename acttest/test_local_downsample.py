@@ -0,0 +1,90 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import local_downsample as ld
+from lmbdtest.fakes import MemoryS3Bucket, MemoryDynamoDBTable, make_args
+from bossutils.multidimensional import XYZ
+import os
+import blosc
+import multiprocessing
+import numpy as np
+import unittest
+from unittest.mock import patch
+from concurrent.futures.process import BrokenProcessPool
+
+load_downsample_volume = ld.load_downsample_volume
+HashedKey = load_downsample_volume().HashedKey
+
+class TestDownsampleLocal(unittest.TestCase):
+    def setUp(self):
+        # Shared with the forked workers
+        self.manager = multiprocessing.Manager()
+        self.store = self.manager.dict()
+        self.s3_index = self.manager.dict()
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def load(self):
+        """Load downsample_volume in the worker, using the shared in memory resources"""
+        dv = load_downsample_volume()
+        dv.S3Bucket = lambda bucket: MemoryS3Bucket(self.store)
+        dv.DynamoDBTable = lambda table: MemoryDynamoDBTable(self.s3_index, ('object-key', 'version-node'))
+        dv.CUBOIDSIZE = [[64, 64, 16]] * 8
+        return dv
+
+    def test_downsample_local(self):
+        args = make_args('uint8', 'anisotropic')
+        args['downsample_method'] = 'mean'
+        dim, step = XYZ(64, 64, 16), XYZ(2, 2, 1)
+        targets = [XYZ(0, 0, 0), XYZ(2, 0, 0), XYZ(0, 0, 1)]
+        for i, target in enumerate(targets):
+            data = np.full(dim.zyx, (i + 1) * 10, dtype=np.uint8)
+            self.store[HashedKey(None, 1, 2, 3, 0, 0, target.morton, version=0)] = blosc.compress(data, typesize=1)
+
+        sub_args = [{'args': args, 'step': step, 'dim': dim, 'use_iso_flag': False, 'index_annotations': False,
+                     'target': target} for target in targets]
+        finished = []
+        with patch.object(ld, 'load_downsample_volume', self.load):
+            ld.downsample_local(sub_args, (dim * step).zyx, 'uint8', processes = 2, progress = finished.extend)
+
+        self.assertEqual(sorted(finished), [0, 1, 2])
+        self.assertEqual(len(self.store), 6)
+        self.assertEqual(len(self.s3_index), 3)
+        for i, target in enumerate(targets):
+            key = HashedKey(None, 1, 2, 3, 1, 0, (target // step).morton, version=0)
+            cube = np.frombuffer(blosc.decompress(self.store[key]), dtype=np.uint8).reshape(dim.zyx)
+            self.assertEqual(cube[0, 0, 0], (i + 1) * 10)
+            self.assertEqual(cube[0, -1, -1], 0) # Only one of the four source cubes exists
+
+    def test_memory_limit(self):
+        with patch.object(ld, 'available_memory', lambda: 10 * 2**20), \
+             patch.object(ld, 'ProcessPoolExecutor') as executor:
+            ld.downsample_local([], (16, 128, 128), 'uint64', processes = 8, batched = True)
+
+        # 2 MB volumes, 7 MB per worker with double buffering
+        self.assertEqual(executor.call_args[0][0], 1)
+
+    def test_worker_dies(self):
+        """Test that a worker that dies fails the downsample instead of hanging"""
+        def load():
+            dv = self.load()
+            dv.handler = lambda args, context: os._exit(1)
+            return dv
+
+        args = make_args('uint8', 'anisotropic')
+        sub_args = [{'args': args, 'step': XYZ(2, 2, 1), 'dim': XYZ(64, 64, 16), 'use_iso_flag': False,
+                     'index_annotations': False, 'target': XYZ(0, 0, 0)}]
+        with patch.object(ld, 'load_downsample_volume', load), self.assertRaises(BrokenProcessPool):
+            ld.downsample_local(sub_args, (16, 128, 128), 'uint8', processes = 2)
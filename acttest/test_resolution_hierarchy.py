@@ -0,0 +1,337 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import resolution_hierarchy as rh
+from bossutils.multidimensional import XYZ
+
+import random
+import unittest
+from unittest.mock import patch
+
+ANISOTROPIC = {'name': 'anisotropic', 'step': XYZ(2, 2, 1)}
+ISOTROPIC = {'name': 'isotropic', 'step': XYZ(2, 2, 2)}
+
+def make_args(**kwargs):
+    args = {
+        'resolution': 0,
+        'resolution_max': 8,
+        'iso_resolution': 3,
+        'type': 'anisotropic',
+        'data_type': 'uint8',
+        'downsample_levels': 3,
+    }
+    args.update(kwargs)
+    return args
+
+@patch.object(rh, 'CUBOIDSIZE', [[512, 512, 16]] * 8)
+class TestDownsampleLevels(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(rh.downsample_levels(make_args(), [ANISOTROPIC]), 3)
+        self.assertEqual(rh.downsample_levels(make_args(downsample_levels=5), [ANISOTROPIC]), 3)
+        self.assertEqual(rh.downsample_levels(make_args(), [ANISOTROPIC, ISOTROPIC]), 1)
+
+    def test_stop_at_iso_resolution(self):
+        self.assertEqual(rh.downsample_levels(make_args(resolution=1), [ANISOTROPIC]), 2)
+
+    def test_memory(self):
+        # 64 uint8 cubes are 256 MB, 512 are 2 GB
+        self.assertEqual(rh.downsample_levels(make_args(type='isotropic'), [ISOTROPIC]), 2)
+
+        # 16 uint64 cubes are 512 MB, 64 are 2 GB
+        args = make_args(data_type='uint64')
+        self.assertEqual(rh.downsample_levels(args, [ANISOTROPIC]), 2)
+
+        # Batched blocks load a second volume
+        args['downsample_batch_size'] = 4
+        self.assertEqual(rh.downsample_levels(args, [ANISOTROPIC]), 1)
+
+@patch.object(rh, 'CUBOIDSIZE', [[512, 512, 16]] * 8)
+class TestDownsampleCursor(unittest.TestCase):
+    def test_cursor_requires_config(self):
+        # Both downsamples happen at iso_resolution, so the cursor is ambiguous
+        args = make_args(resolution=3, downsample_cursor=10)
+        with self.assertRaises(ValueError):
+            rh.downsample_channel(args)
+
+    def test_fused_cursor(self):
+        """Test that a fused downsample isn't resumed from an anisotropic cursor"""
+        args = make_args(resolution=3, fuse_iso=True, downsample_cursor=10, downsample_cursor_config='anisotropic',
+                         x_start=0, x_stop=1024, y_start=0, y_stop=1024, z_start=0, z_stop=32)
+        for var in ('x', 'y', 'z'):
+            args['iso_{}_start'.format(var)] = args['{}_start'.format(var)]
+            args['iso_{}_stop'.format(var)] = args['{}_stop'.format(var)]
+
+        with self.assertRaisesRegex(ValueError, 'fused'):
+            rh.downsample_channel(args)
+
+        # The isotropic cursor applies to the fused pass
+        args['downsample_cursor_config'] = 'isotropic'
+        with patch.object(rh, 'downsample_local') as local, patch.object(rh, 'aws'):
+            rh.downsample_channel(dict(args, downsample_executor='local', downsample_order='morton',
+                                       annotation_index_max=1))
+        sub_args = list(local.call_args[0][0])
+        self.assertEqual(len(sub_args), 0) # The only block, 0, is before the cursor
+
+    def test_make_args_cursor(self):
+        args = make_args(downsample_order='morton')
+        sub_args = rh.make_args(args, XYZ(0, 0, 0), XYZ(4, 4, 1), XYZ(2, 2, 1), XYZ(512, 512, 16), False, False,
+                                cursor=XYZ(1, 1, 0).morton)
+        self.assertEqual([a['target'] for a in sub_args], [XYZ(2, 2, 0)])
+
+class TestMakeTargets(unittest.TestCase):
+    def test_occupancy_targets(self):
+        """Test that the index's targets match filtering every block of the frame"""
+        start, stop, step = XYZ(4, 0, 2), XYZ(20, 12, 5), XYZ(2, 2, 1)
+        block = step * step
+        index = rh.OccupancyIndex([XYZ(1, 0, 2).morton, XYZ(4, 2, 3).morton, XYZ(2, 1, 4).morton,
+                                   XYZ(0, 0, 2).morton, XYZ(9, 9, 9).morton]) # last two outside the frame
+
+        for order, cursor in [('xyz', None), ('morton', None), ('morton', XYZ(2, 1, 4).morton)]:
+            expected = [target for target in rh.make_targets(start, stop, step, 2, None, order, cursor)
+                        if (target // block).morton in index]
+            targets = list(rh.make_targets(start, stop, step, 2, index, order, cursor))
+            self.assertEqual(targets, expected)
+        self.assertEqual(len(list(rh.make_targets(start, stop, step, 2, index))), 3)
+
+class MemoryDynamoDB(object):
+    """In memory stand-in for the DynamoDB client calls DownsampleProgress makes"""
+    def __init__(self):
+        self.items = {}
+
+    def client(self, name):
+        return self
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['progress-key']['S'])
+        return {} if item is None else {'Item': item}
+
+    def put_item(self, TableName, Item):
+        self.items[Item['progress-key']['S']] = Item
+
+    def delete_item(self, TableName, Key):
+        self.items.pop(Key['progress-key']['S'], None)
+
+class TestDownsampleProgress(unittest.TestCase):
+    block = XYZ(2, 2, 1)
+
+    def setUp(self):
+        self.session = MemoryDynamoDB()
+        self.args = {'downsample_progress_table': 'progress', 'collection_id': 1, 'experiment_id': 2,
+                     'channel_id': 3, 'resolution': 0}
+
+    def progress(self, block=None):
+        progress = rh.DownsampleProgress(self.session, self.args, 'anisotropic', block or self.block)
+        progress.load()
+        return progress
+
+    def sub_args(self, mortons):
+        for morton in mortons:
+            yield {'target': XYZ.from_morton(morton) * self.block}
+
+    def test_out_of_order(self):
+        progress = self.progress()
+        list(progress.track(self.sub_args(range(6))))
+        progress.finished([0, 2])
+        progress.finished([5])
+
+        progress = self.progress()
+        self.assertEqual([m for m in range(6) if m in progress], [0, 2, 5])
+
+        # Only the blocks that weren't completed are run by the retry
+        list(progress.track(self.sub_args([1, 3, 4])))
+        progress.finished([1]) # block 3
+
+        progress = self.progress()
+        self.assertEqual([m for m in range(6) if m in progress], [0, 2, 3, 5])
+        self.assertNotIn(4, progress)
+        self.assertNotIn(1, progress)
+
+    def test_untracked(self):
+        progress = self.progress()
+        sub_args = progress.track(self.sub_args(range(4)))
+        next(sub_args)
+        progress.finished([0])
+
+        # The blocks that haven't been tracked yet are not complete
+        self.assertEqual([m for m in range(4) if m in self.progress()], [0])
+
+        list(sub_args)
+        progress.finished([1, 2, 3])
+        self.assertEqual([m for m in range(4) if m in self.progress()], [0, 1, 2, 3])
+
+    def test_load(self):
+        self.assertNotIn(0, self.progress())
+
+        progress = self.progress()
+        list(progress.track(self.sub_args(range(2))))
+        progress.finished([0])
+
+        self.assertIn(0, self.progress())
+        self.assertNotIn(0, self.progress(XYZ(2, 2, 2))) # Different block size
+
+        progress.clear()
+        self.assertNotIn(0, self.progress())
+
+    def test_resume(self):
+        """Test that a checkpoint never includes blocks that didn't run, over interrupted attempts"""
+        rng = random.Random(0)
+        for run in range(100):
+            self.session.items = {}
+            count = rng.randint(1, 30)
+            ran = set()
+
+            while len(ran) < count:
+                progress = self.progress()
+                mortons = [m for m in range(count) if m not in progress]
+                self.assertTrue(set(mortons) >= set(range(count)) - ran)
+
+                # Track some of the blocks, as a fanout launches them, and finish them in any order
+                sub_args = progress.track(self.sub_args(mortons))
+                tracked = [next(sub_args) for i in range(rng.randint(1, len(mortons)))]
+                if rng.random() < 0.5:
+                    tracked += list(sub_args)
+                indices = list(range(len(tracked)))
+                rng.shuffle(indices)
+
+                # The attempt is interrupted after some of the blocks finish
+                for index in indices[:rng.randint(1, len(indices))]:
+                    progress.finished([index])
+                    ran.add(mortons[index])
+
+                    completed = self.progress()
+                    self.assertEqual({m for m in range(count) if m in completed} - ran, set())
+
+class TestFrameHelpers(unittest.TestCase):
+    dim = XYZ(512, 512, 16)
+
+    def test_frame_blocks(self):
+        block = XYZ(2, 2, 1)
+        self.assertEqual(rh.frame_blocks(XYZ(0, 0, 0), XYZ(1024, 1024, 16), self.dim, block),
+                         (XYZ(0, 0, 0), XYZ(2, 2, 1)))
+
+        # An offset frame starts in the middle of a block and ends in the middle of a cube
+        self.assertEqual(rh.frame_blocks(XYZ(600, 100, 20), XYZ(1100, 1600, 40), self.dim, block),
+                         (XYZ(0, 0, 1), XYZ(4, 4, 3)))
+
+    def test_frame_blocks_empty(self):
+        start, stop = rh.frame_blocks(XYZ(600, 100, 20), XYZ(600, 1600, 40), self.dim, XYZ(2, 2, 1))
+        self.assertEqual(start, stop)
+        self.assertEqual(list(rh.make_targets(start, stop, XYZ(2, 2, 1))), [])
+
+    def test_resize_frame(self):
+        config = {'frame_start_key': '{}_start', 'frame_stop_key': '{}_stop'}
+        args = {'x_start': 3, 'y_start': 0, 'z_start': 5, 'x_stop': 9, 'y_stop': 8, 'z_stop': 6}
+        rh.resize_frame(args, config, XYZ(4, 4, 1))
+
+        # The start is rounded down and the stop up
+        self.assertEqual(args, {'x_start': 0, 'y_start': 0, 'z_start': 5, 'x_stop': 3, 'y_stop': 2, 'z_stop': 6})
+
+    def test_fuse_configs(self):
+        args = make_args(resolution=3, fuse_iso=True)
+        for var in ('x', 'y', 'z'):
+            args['{}_start'.format(var)] = args['iso_{}_start'.format(var)] = 0
+            args['{}_stop'.format(var)] = args['iso_{}_stop'.format(var)] = 100
+
+        self.assertTrue(rh.fuse_configs(args, [ANISOTROPIC, ISOTROPIC]))
+        self.assertFalse(rh.fuse_configs(args, [ISOTROPIC]))
+        self.assertFalse(rh.fuse_configs(dict(args, fuse_iso=False), [ANISOTROPIC, ISOTROPIC]))
+        self.assertFalse(rh.fuse_configs(dict(args, resolution=4), [ANISOTROPIC, ISOTROPIC]))
+
+        # Both downsamples have to cover the same frame
+        self.assertFalse(rh.fuse_configs(dict(args, iso_z_stop=50), [ANISOTROPIC, ISOTROPIC]))
+
+class TestOccupancyIndex(unittest.TestCase):
+    def test_contains(self):
+        index = rh.OccupancyIndex([9, 3, 3, 27])
+        self.assertEqual(len(index), 3)
+        self.assertIn(3, index)
+        self.assertNotIn(4, index)
+        self.assertNotIn(100, index)
+
+    def test_parents(self):
+        cubes = [XYZ(0, 0, 0), XYZ(1, 1, 0), XYZ(2, 0, 1), XYZ(5, 3, 3)]
+        parents = rh.OccupancyIndex([cube.morton for cube in cubes]).parents(XYZ(2, 2, 1))
+
+        expected = sorted([XYZ(0, 0, 0).morton, XYZ(1, 0, 1).morton, XYZ(2, 1, 3).morton])
+        self.assertEqual(list(parents.mortons), expected)
+
+    def test_dirty_index(self):
+        mortons = [XYZ(4, 4, 4).morton, XYZ(5, 5, 5).morton]
+        args = make_args(iso_resolution=1)
+
+        # Anisotropic cubes halve X and Y for every resolution
+        self.assertEqual(list(rh.dirty_index(args, mortons, 2, False).mortons), [XYZ(1, 1, 4).morton,
+                                                                                  XYZ(1, 1, 5).morton])
+
+        # Isotropic cubes halve Z as well above iso_resolution
+        self.assertEqual(list(rh.dirty_index(args, mortons, 2, True).mortons), [XYZ(1, 1, 2).morton])
+
+@patch.object(rh, 'CUBOIDSIZE', [[512, 512, 16]] * 8)
+@patch.object(rh, 'aws')
+class TestOccupancyPropagation(unittest.TestCase):
+    def channel_args(self, **kwargs):
+        args = make_args(collection_id=1, experiment_id=2, channel_id=3, annotation_index_max=1,
+                         downsample_levels=1, downsample_executor='local', skip_empty=True,
+                         x_start=0, x_stop=512 * 8, y_start=0, y_stop=512 * 8, z_start=0, z_stop=16 * 4)
+        args.update(kwargs)
+        return args
+
+    def downsample(self, args):
+        targets = []
+        def local(sub_args, *args, **kwargs):
+            targets.extend(sub['target'] for sub in sub_args)
+
+        with patch.object(rh, 'downsample_local', side_effect=local):
+            args = rh.downsample_channel(args)
+        return args, targets
+
+    def test_propagate(self, aws):
+        """Test that the next resolution uses the occupancy of the generated cubes"""
+        cubes = [XYZ(0, 0, 0), XYZ(1, 1, 0), XYZ(6, 2, 3)]
+        index = rh.OccupancyIndex([cube.morton for cube in cubes])
+        with patch.object(rh.OccupancyIndex, 'from_s3_index', return_value=index) as from_s3_index:
+            args, targets = self.downsample(self.channel_args())
+            self.assertEqual(from_s3_index.call_count, 1)
+            self.assertEqual(targets, [XYZ(0, 0, 0), XYZ(6, 2, 3)])
+            self.assertEqual(args['occupancy']['resolution'], 1)
+
+            args, targets = self.downsample(args)
+            from_s3_index.assert_called_once() # Not read again
+            self.assertEqual(targets, [XYZ(0, 0, 0), XYZ(2, 0, 3)])
+
+    def test_too_large(self, aws):
+        """Test that an index too large for the Step Function state is re-read"""
+        index = rh.OccupancyIndex(range(rh.MAX_OCCUPANCY_STATE * 4 + 4))
+        with patch.object(rh.OccupancyIndex, 'from_s3_index', return_value=index):
+            args, targets = self.downsample(self.channel_args(x_stop=512 * 1024, y_stop=512 * 1024))
+        self.assertNotIn('occupancy', args)
+
+    def test_fused(self, aws):
+        """Test that a fused run propagates both outputs from a single read of the S3 Index"""
+        cubes = [XYZ(0, 0, 0), XYZ(3, 3, 1)]
+        index = rh.OccupancyIndex([cube.morton for cube in cubes])
+        args = self.channel_args(resolution=3, fuse_iso=True)
+        for var in ('x', 'y', 'z'):
+            args['iso_{}_start'.format(var)] = args['{}_start'.format(var)]
+            args['iso_{}_stop'.format(var)] = args['{}_stop'.format(var)]
+
+        with patch.object(rh.OccupancyIndex, 'from_s3_index', return_value=index) as from_s3_index:
+            args, targets = self.downsample(args)
+
+        from_s3_index.assert_called_once_with(aws.get_session(), args, 3, False)
+        self.assertEqual(targets, [XYZ(0, 0, 0), XYZ(2, 2, 0)])
+        self.assertEqual(args['occupancy']['mortons'], {
+            'noiso': sorted([XYZ(0, 0, 0).morton, XYZ(1, 1, 1).morton]),
+            'iso': sorted([XYZ(0, 0, 0).morton, XYZ(1, 1, 0).morton]),
+        })
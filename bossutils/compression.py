@@ -0,0 +1,208 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrent blosc compression of cuboids.
+
+The compressed data is a plain blosc buffer of the cuboid's bytes, so it is
+decompressible by Cube.from_blosc / blosc.decompress no matter which codec,
+level, or shuffle was used.
+
+By default python-blosc holds the GIL while compressing, so cuboids
+compressed on multiple threads only use multiple vCPUs once the process has
+called blosc.set_releasegil(True). That is a process wide setting, so it is
+left to the lambdas that use a Compressor to enable.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import blosc
+import numpy as np
+
+# dict: Default compression settings, keyed by data type name
+#       The same as blosc.compress's defaults
+DEFAULT_SETTINGS = {
+    'uint8': {'cname': 'blosclz', 'clevel': 9, 'shuffle': 'shuffle'},
+    'uint16': {'cname': 'blosclz', 'clevel': 9, 'shuffle': 'shuffle'},
+    'uint64': {'cname': 'blosclz', 'clevel': 9, 'shuffle': 'shuffle'},
+}
+
+# int: Number of shared Compressors a warm lambda keeps, one per distinct settings
+COMPRESSOR_CACHE = 4
+
+SHUFFLES = {
+    'noshuffle': blosc.NOSHUFFLE,
+    'shuffle': blosc.SHUFFLE,
+    'bitshuffle': blosc.BITSHUFFLE,
+}
+
+def codec_settings(dtype, settings=None):
+    """Get the blosc.compress arguments for a data type
+
+    Args:
+        dtype (np.dtype|str): Data type of the cuboids
+        settings (optional[dict]): Overrides of DEFAULT_SETTINGS, keyed by data
+                                   type name, each a dict with any of 'cname',
+                                   'clevel', and 'shuffle' ('noshuffle' | 'shuffle'
+                                   | 'bitshuffle')
+
+    Returns:
+        dict: Keyword arguments for blosc.compress
+
+    Raises:
+        ValueError: If the codec or shuffle is not supported
+    """
+    dtype = np.dtype(dtype)
+    kwargs = dict(DEFAULT_SETTINGS.get(dtype.name, DEFAULT_SETTINGS['uint8']))
+    if settings is not None:
+        kwargs.update(settings.get(dtype.name, {}))
+
+    if kwargs['cname'] not in blosc.cnames:
+        raise ValueError("Unsupported blosc codec '{}'".format(kwargs['cname']))
+    if kwargs['shuffle'] not in SHUFFLES:
+        raise ValueError("Unsupported blosc shuffle '{}'".format(kwargs['shuffle']))
+
+    return {
+        'typesize': dtype.itemsize,
+        'cname': kwargs['cname'],
+        'clevel': int(kwargs['clevel']),
+        'shuffle': SHUFFLES[kwargs['shuffle']],
+    }
+
+class Compressor(object):
+    """Compress cuboids concurrently, recording compression metrics
+
+    Args:
+        settings (optional[dict]): Per data type overrides, see codec_settings
+        max_workers (optional[int]): Number of compression threads
+                                     (default the number of CPUs)
+    """
+    def __init__(self, settings=None, max_workers=None):
+        self.settings = settings
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = None
+        self.lock = threading.Lock()
+        self.kwargs = {}
+
+        self.count = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the compression threads"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def compress(self, data):
+        """Compress a single cuboid on the calling thread
+
+        Args:
+            data (np.array): Cuboid data
+
+        Returns:
+            bytes: The blosc compressed data
+        """
+        data = np.ascontiguousarray(data)
+        with self.lock:
+            kwargs = self.kwargs.get(data.dtype)
+            if kwargs is None:
+                kwargs = self.kwargs[data.dtype] = codec_settings(data.dtype, self.settings)
+
+        start = time.perf_counter()
+        compressed = blosc.compress(data, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.count += 1
+            self.raw_bytes += data.nbytes
+            self.compressed_bytes += len(compressed)
+            self.seconds += elapsed
+
+        return compressed
+
+    def submit(self, data):
+        """Compress a cuboid on the compression threads
+
+        Returns:
+            Future: Resolves to the compressed bytes
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.executor.submit(self.compress, data)
+
+    def compress_many(self, arrays):
+        """Compress multiple cuboids concurrently
+
+        Args:
+            arrays (iterable[np.array]): Cuboid data
+
+        Returns:
+            list[bytes]: The compressed data, in the same order
+        """
+        return [future.result() for future in [self.submit(data) for data in arrays]]
+
+    def metrics(self):
+        """Get the compression metrics of all cuboids compressed so far
+
+        Returns:
+            dict: count, raw_bytes, compressed_bytes, ratio (raw / compressed),
+                  seconds (summed across threads), and throughput (raw MB per
+                  second of compression time, per thread)
+        """
+        with self.lock:
+            return {
+                'count': self.count,
+                'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'ratio': self.raw_bytes / self.compressed_bytes if self.compressed_bytes else None,
+                'seconds': self.seconds,
+                'throughput': self.raw_bytes / 2**20 / self.seconds if self.seconds else None,
+            }
+
+@functools.lru_cache(maxsize=COMPRESSOR_CACHE)
+def _shared_compressor(settings, max_workers):
+    return Compressor(json.loads(settings) if settings else None, max_workers)
+
+# A forked child doesn't have the parent's compression threads
+os.register_at_fork(after_in_child=_shared_compressor.cache_clear)
+
+def shared_compressor(settings=None, max_workers=None):
+    """Get the Compressor shared by every caller with the same arguments
+
+    The Compressors are cached in this module, so a warm lambda reuses their
+    threads across invocations instead of starting new ones each time the
+    lambda loader re-runs its script. A shared Compressor is never closed,
+    and its metrics accumulate across invocations. Forked processes get new
+    Compressors.
+
+    Args:
+        settings (optional[dict]): Per data type overrides, see codec_settings
+        max_workers (optional[int]): Number of compression threads
+
+    Returns:
+        Compressor
+    """
+    return _shared_compressor(json.dumps(settings, sort_keys=True) if settings else None, max_workers)
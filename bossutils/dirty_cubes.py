@@ -0,0 +1,137 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tracking of cuboids that have been written since the channel was last
+downsampled.
+
+The dirty cube table is a DynamoDB table with
+    hash key: 'channel-key' (S) 'col_id&exp_id&chan_id&resolution&time_sample'
+    range key: 'morton' (N) Morton ID of the cuboid
+and a 'dirty-time' (N) attribute, the time in milliseconds the cuboid was last
+written. Re-writing a cuboid updates its dirty-time, so entries read before a
+downsample started can be cleared without losing later writes.
+"""
+
+import time
+import boto3
+import botocore
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from bossutils.dynamodb import batch_write
+
+# int: Maximum number of concurrent conditional deletes when clearing cuboids
+#      BatchWriteItem doesn't support conditions, so each delete is a request
+MAX_CLEAR_THREADS = 16
+
+def now():
+    """The current time in milliseconds, as used for dirty-time"""
+    return int(time.time() * 1000)
+
+class DirtyCubeTracker(object):
+    """Record and query the dirty cuboids of a channel
+
+    Args:
+        table (str): Name of the dirty cube DynamoDB table
+        client (optional[DynamoDB.Client]): Client to use, a new boto3 client
+                                            is created if not given
+    """
+    def __init__(self, table, client=None):
+        self.table = table
+        self.ddb = client if client is not None else boto3.client('dynamodb')
+
+    @staticmethod
+    def channel_key(lookup_key, resolution, time_sample=0):
+        """Create the channel-key for the cuboids of a channel's resolution
+
+        Args:
+            lookup_key (str): 'col_id&exp_id&chan_id' of the channel
+            resolution (int): Resolution of the cuboids
+            time_sample (int): Time sample of the cuboids
+
+        Returns:
+            str
+        """
+        return '{}&{}&{}'.format(lookup_key, resolution, time_sample)
+
+    def mark(self, channel_key, mortons):
+        """Mark the given cuboids as dirty
+
+        Args:
+            channel_key (str): See channel_key()
+            mortons (iterable[int]): Morton IDs of the written cuboids
+        """
+        dirty_time = str(now())
+        requests = [{'PutRequest': {'Item': {'channel-key': {'S': channel_key},
+                                             'morton': {'N': str(int(morton))},
+                                             'dirty-time': {'N': dirty_time}}}}
+                    for morton in set(int(m) for m in mortons)]
+
+        batch_write(self.ddb, self.table, requests)
+
+    def dirty(self, channel_key, before=None):
+        """Get the dirty cuboids of a channel's resolution
+
+        Args:
+            channel_key (str): See channel_key()
+            before (optional[int]): Only return cuboids dirtied at or before this time
+
+        Returns:
+            np.array: uint64 Morton IDs of the dirty cuboids
+        """
+        kwargs = {
+            'TableName': self.table,
+            'KeyConditionExpression': '#key = :key',
+            'ExpressionAttributeNames': {'#key': 'channel-key', '#morton': 'morton'},
+            'ExpressionAttributeValues': {':key': {'S': channel_key}},
+            'ProjectionExpression': '#morton',
+        }
+        if before is not None:
+            kwargs['FilterExpression'] = '#time <= :before'
+            kwargs['ExpressionAttributeNames']['#time'] = 'dirty-time'
+            kwargs['ExpressionAttributeValues'][':before'] = {'N': str(before)}
+
+        mortons = []
+        for page in self.ddb.get_paginator('query').paginate(**kwargs):
+            mortons.extend(int(item['morton']['N']) for item in page['Items'])
+        return np.array(mortons, dtype=np.uint64)
+
+    def clear(self, channel_key, mortons, before):
+        """Remove cuboids from the dirty list
+
+        Only entries that have not been dirtied again since `before` are removed.
+        The conditional deletes are issued concurrently.
+
+        Args:
+            channel_key (str): See channel_key()
+            mortons (iterable[int]): Morton IDs of the cuboids to clear
+            before (int): Time the cuboids were read with dirty()
+        """
+        def delete(morton):
+            try:
+                self.ddb.delete_item(TableName = self.table,
+                                     Key = {'channel-key': {'S': channel_key},
+                                            'morton': {'N': str(int(morton))}},
+                                     ConditionExpression = '#time <= :before',
+                                     ExpressionAttributeNames = {'#time': 'dirty-time'},
+                                     ExpressionAttributeValues = {':before': {'N': str(before)}})
+            except botocore.exceptions.ClientError as ex:
+                # Dirtied again after the downsample started
+                if ex.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+        with ThreadPoolExecutor(max_workers = MAX_CLEAR_THREADS) as executor:
+            # Wait for all of the deletes, raising the first error
+            for future in [executor.submit(delete, morton) for morton in mortons]:
+                future.result()
@@ -0,0 +1,246 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Vectorized downsampling of 3D volumes.
+
+Volumes are numpy arrays (or bossutils.multidimensional.Buffers) indexed in
+ZYX order. The downsample factor is given in XYZ order, to match the step
+used by the resolution hierarchy code.
+
+The whole volume is reduced at once by reshaping it into a view of
+(Z, fz, Y, fy, X, fx) blocks and reducing over the block axes, so no per
+slice copies are made.
+
+REDUCERS maps a method name to the function used to reduce the blocks.
+ANNOTATION_REDUCERS lists the methods that preserve annotation IDs.
+Additional reducers can be added with register_reducer.
+
+BUFFERS is a module level BufferPool. Lambda functions run by the lambda
+loader are re-executed for each invocation, but imported modules are not, so
+buffers in the pool are reused by warm lambdas.
+"""
+
+import threading
+import numpy as np
+
+def extract_factor(factor):
+    """Convert the given factor into a (z, y, x) tuple of ints
+
+    Args:
+        factor (XYZ|int): Downsample factor, or a single factor for all axes
+
+    Returns:
+        tuple: (fz, fy, fx)
+    """
+    if isinstance(factor, int):
+        return factor, factor, factor
+    x, y, z = factor
+    return int(z), int(y), int(x)
+
+def blocks(volume, factor):
+    """Create a view of the volume split into blocks of the given factor
+
+    Args:
+        volume (np.array): ZYX volume, each dimension a multiple of factor
+        factor (XYZ|int): Downsample factor
+
+    Returns:
+        np.array: View of shape (Z, fz, Y, fy, X, fx)
+    """
+    fz, fy, fx = extract_factor(factor)
+    volume = np.asarray(volume)
+    z, y, x = volume.shape
+    if z % fz or y % fy or x % fx:
+        raise ValueError("Volume shape {} is not a multiple of the downsample factor {}".format(volume.shape,
+                                                                                                (fz, fy, fx)))
+    return volume.reshape(z // fz, fz, y // fy, fy, x // fx, fx)
+
+BLOCK_AXES = (1, 3, 5)
+
+def reduce_mean(view, out):
+    """Average each block, rounding to the nearest integer
+
+    Integer data is averaged without overflow. Data up to 32 bits is summed in
+    a 64 bit accumulator. 64 bit data is split into the quotient and remainder
+    of the block size, which are summed separately, so the result is exact.
+
+    Area averaging with an integer factor is the same as the block mean, so
+    both the 'mean' and 'area' methods use this reducer.
+    """
+    n = view.shape[1] * view.shape[3] * view.shape[5]
+    dtype = view.dtype
+
+    if not np.issubdtype(dtype, np.integer):
+        np.mean(view, axis=BLOCK_AXES, out=out)
+    elif dtype.itemsize <= 4:
+        sum_ = view.sum(axis=BLOCK_AXES, dtype=np.uint64)
+        out[...] = (sum_ + (n // 2)) // n
+    else:
+        quot = (view // n).sum(axis=BLOCK_AXES, dtype=np.uint64)
+        rem = (view % n).sum(axis=BLOCK_AXES, dtype=np.uint64)
+        out[...] = quot + (rem + (n // 2)) // n
+
+def reduce_nearest(view, out):
+    """Select the first voxel of each block
+
+    Only a strided view of the volume is read, so this is the fastest
+    reducer. Annotation IDs are preserved.
+    """
+    out[...] = view[:, 0, :, 0, :, 0]
+
+def reduce_max(view, out):
+    """Select the largest value of each block (max pooling)"""
+    np.amax(view, axis=BLOCK_AXES, out=out)
+
+def reduce_min(view, out):
+    """Select the smallest value of each block (min pooling)"""
+    np.amin(view, axis=BLOCK_AXES, out=out)
+
+def reduce_mode(view, out):
+    """Select the most common non-zero value of each block
+
+    Zero is only selected if the whole block is zero. Ties are broken by
+    selecting the smallest value.
+
+    The blocks are processed one output Z slice at a time to limit the size of
+    the temporary arrays.
+    """
+    n = view.shape[1] * view.shape[3] * view.shape[5]
+    for z in range(view.shape[0]):
+        # (fz, Y, fy, X, fx) -> (Y * X, n)
+        values = view[z].transpose(1, 3, 0, 2, 4).reshape(-1, n)
+        values = np.sort(values, axis=1)
+
+        # Number of times each value appears in its block
+        counts = (values[:, :, None] == values[:, None, :]).sum(axis=2)
+        counts[values == 0] = 0
+
+        # argmax selects the first, and therefore smallest, most common value
+        idx = counts.argmax(axis=1)
+        out[z] = values[np.arange(len(values)), idx].reshape(out.shape[1:])
+
+REDUCERS = {
+    'nearest': reduce_nearest,
+    'mean': reduce_mean,
+    'area': reduce_mean,
+    'max': reduce_max,
+    'min': reduce_min,
+    'mode': reduce_mode,
+}
+
+ANNOTATION_REDUCERS = ['nearest', 'mode']
+
+def register_reducer(name, reducer, annotation=False):
+    """Add a reducer that can be selected by name
+
+    Args:
+        name (str): Method name used to select the reducer
+        reducer (callable): Function taking the (Z, fz, Y, fy, X, fx) view and
+                            the (Z, Y, X) output array, see reduce_mean
+        annotation (bool): If the reducer preserves annotation IDs
+
+    Raises:
+        ValueError: If a reducer with the name already exists
+    """
+    if name in REDUCERS:
+        raise ValueError("Downsample method '{}' already exists".format(name))
+
+    REDUCERS[name] = reducer
+    if annotation:
+        ANNOTATION_REDUCERS.append(name)
+
+def block_reduce(volume, factor, method='mean', out=None):
+    """Downsample the volume by reducing each block of factor voxels
+
+    Args:
+        volume (np.array): ZYX volume, each dimension a multiple of factor
+        factor (XYZ|int): Downsample factor
+        method (str): Name of the reducer in REDUCERS
+        out (optional[np.array]): Array to place the results into, must be
+                                  volume.shape / factor
+
+    Returns:
+        np.array: The downsampled volume
+
+    Raises:
+        ValueError: If the method is unknown or the shapes are wrong
+    """
+    if method not in REDUCERS:
+        raise ValueError("Unsupported downsample method '{}'".format(method))
+
+    view = blocks(volume, factor)
+    shape = (view.shape[0], view.shape[2], view.shape[4])
+    if out is None:
+        out = np.empty(shape, dtype=view.dtype)
+    elif tuple(out.shape) != shape:
+        raise ValueError("Output shape {} doesn't match downsampled shape {}".format(tuple(out.shape), shape))
+
+    REDUCERS[method](view, np.asarray(out))
+    return out
+
+class BufferPool(object):
+    """Cache of named numpy arrays, so large buffers can be reused instead of
+    being reallocated
+
+    A named buffer is only kept for the last shape and data type requested.
+    Reused buffers contain the data from their previous use.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, shape, dtype):
+        """Get the named buffer
+
+        Args:
+            name (str): Name of the buffer
+            shape (tuple): ZYX shape of the buffer
+            dtype (np.dtype): Data type of the buffer
+
+        Returns:
+            (np.array, bool): The C ordered buffer and if it was newly allocated
+                              (and therefore zeroed)
+        """
+        shape = tuple(int(v) for v in shape)
+        dtype = np.dtype(dtype)
+        with self.lock:
+            buf = self.buffers.get(name)
+            if buf is not None and buf.shape == shape and buf.dtype == dtype:
+                return buf, False
+
+            # Release the old buffer before allocating the new one
+            self.buffers.pop(name, None)
+            buf = np.zeros(shape, dtype=dtype, order='C')
+            self.buffers[name] = buf
+            return buf, True
+
+    def set(self, name, buf):
+        """Use the given array as the named buffer
+
+        Allows buffers allocated up front, such as by a local downsample worker when
+        it starts, to be used by code that gets its buffers from the pool.
+
+        Args:
+            name (str): Name of the buffer
+            buf (np.array): C ordered array to use
+        """
+        with self.lock:
+            self.buffers[name] = buf
+
+    def clear(self):
+        """Release all of the buffers"""
+        with self.lock:
+            self.buffers.clear()
+
+BUFFERS = BufferPool()
@@ -0,0 +1,94 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched DynamoDB writes and the items written by the lambdas"""
+
+import time
+import random
+
+# int: Maximum number of items in a DynamoDB BatchWriteItem request
+MAX_BATCH_ITEMS = 25
+
+# int: Number of times unprocessed items are resubmitted
+MAX_RETRIES = 6
+
+# float - seconds: The initial delay before resubmitting unprocessed items
+#                  Doubled for each retry and randomly jittered
+RETRY_DELAY = 0.1
+
+def batch_write(client, table, requests):
+    """Write the requests in batches, resubmitting any unprocessed items with backoff
+
+    Args:
+        client (DynamoDB.Client): Client to use
+        table (str): Name of the table
+        requests (list[dict]): BatchWriteItem PutRequest / DeleteRequest entries
+
+    Raises:
+        Exception: If items are still unprocessed after MAX_RETRIES
+    """
+    for i in range(0, len(requests), MAX_BATCH_ITEMS):
+        delay = RETRY_DELAY
+        items = {table: requests[i:i + MAX_BATCH_ITEMS]}
+        for retry in range(MAX_RETRIES + 1):
+            resp = client.batch_write_item(RequestItems = items)
+            items = resp.get('UnprocessedItems', {})
+            if not items:
+                break
+
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+        else:
+            raise Exception("Could not write {} items to {}".format(len(items[table]), table))
+
+def s3_index_put_request(object_key, ingest_job, version=0):
+    """Create the BatchWriteItem PutRequest of a cuboid's S3 Index entry
+
+    Mirrors the item put by spdb's AWSObjectStore.add_cuboid_to_index (the
+    spdb/spatialdb/object.py of the spdb the lambdas are deployed with), so
+    it must be updated if that item changes:
+        object-key (S): The cuboid's object key (hash key)
+                        'hash&col_id&exp_id&chan_id&resolution&time_sample&morton'
+        version-node (N): The cuboid's version (range key)
+        ingest-job-hash (S): 'col_id' (ingest job index hash key)
+        ingest-job-range (S): 'exp_id&chan_id&resolution&ingest_job' (ingest job index range key)
+    The ingest job index is used to find the cuboids written by an ingest job.
+
+    A put replaces the whole item, including the id-set that spdb's
+    update_id_indices adds to the entries of annotation cuboids, so it must
+    only be used for a new entry, before the ID Index is updated.
+
+    Args:
+        object_key (str): Object key of the cuboid
+        ingest_job (int): ID of the ingest job that wrote the cuboid
+        version (int): Version of the cuboid
+
+    Returns:
+        dict
+
+    Raises:
+        ValueError: If the object key doesn't have the expected layout
+    """
+    parts = object_key.split('&')
+    if len(parts) != 7:
+        raise ValueError("Object key '{}' is not "
+                         "'hash&col_id&exp_id&chan_id&resolution&time_sample&morton'".format(object_key))
+    _, col_id, exp_id, chan_id, resolution, _, _ = parts
+
+    return {'PutRequest': {'Item': {
+        'object-key': {'S': object_key},
+        'version-node': {'N': str(version)},
+        'ingest-job-hash': {'S': col_id},
+        'ingest-job-range': {'S': '{}&{}&{}&{}'.format(exp_id, chan_id, resolution, ingest_job)},
+    }}}
@@ -0,0 +1,406 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive fanout of StepFunction executions.
+
+heaviside.activities.fanout launches sub-executions with a fixed maximum
+concurrency. adaptive_fanout instead asks a policy for the concurrency after
+every polling round, giving it the observed sub-execution latency, the
+completion rate, and the number of throttling errors seen.
+
+Throttling errors are counted from
+    * StepFunction API calls that were throttled
+    * An optional throttle monitor, such as CloudWatchThrottles, which reads
+      the DynamoDB throttle and S3 5xx (503 SlowDown) metrics
+
+Throttling inside the sub-executions, which retry throttled requests, is only
+seen through the monitor. The DynamoDB metrics are always published, but S3
+only publishes 5xxErrors for buckets with a request metrics configuration
+(see CloudWatchThrottles.s3). Without one S3 throttling isn't counted.
+
+The execution backend is pluggable, StepFunctionBackend runs StepFunctions
+and the unit tests use a simulated backend.
+
+POLICIES maps the policy names accepted by create_policy to policy classes.
+A policy has an `initial` concurrency and an `update(concurrency, stats)`
+method that returns the new concurrency.
+"""
+
+import time
+from collections import namedtuple, deque
+from datetime import datetime, timedelta
+
+from bossutils.logger import BossLogger
+
+# StepFunction error codes that mean the request was throttled
+THROTTLE_ERRORS = ('ThrottlingException',
+                   'TooManyRequestsException',
+                   'ExecutionLimitExceeded')
+
+FanoutStats = namedtuple('FanoutStats', [
+    'running',          # int: Number of sub-executions currently running
+    'pending',          # int: Number of sub-executions not launched yet
+    'completed',        # int: Sub-executions that finished in the window
+    'latency',          # float|None - seconds: Mean run time of the sub-executions finished in the window
+    'baseline_latency', # float|None - seconds: Lowest window latency seen so far
+    'rate',             # float|None - per second: Sub-executions finished per second over the
+                        #                          window, None until `window` rounds have been polled
+    'throttles',        # int: Throttling errors seen since the last update
+])
+
+class StaticPolicy(object):
+    """Always use the same concurrency, like heaviside's fanout
+
+    Args:
+        concurrency (int): Number of concurrent sub-executions
+    """
+    def __init__(self, concurrency=50):
+        self.initial = concurrency
+
+    def update(self, concurrency, stats):
+        return self.initial
+
+class AIMDPolicy(object):
+    """Additive increase, multiplicative decrease of the concurrency
+
+    * Any throttling multiplies the concurrency by `decrease`
+    * If the window latency is more than `latency_factor` times the baseline
+      latency, or the completion rate dropped below `rate_factor` times the
+      best rate seen while running at a higher concurrency than that best rate
+      was seen at, the concurrency is reduced by `increase`
+    * Otherwise, if sub-executions are completing and there are pending
+      sub-executions waiting for the concurrency limit, the concurrency is
+      increased by `increase`
+
+    Args:
+        initial (int): Starting concurrency
+        minimum (int): Lowest concurrency
+        maximum (int): Highest concurrency
+        increase (int): Amount to add to / subtract from the concurrency
+        decrease (float): Multiplier applied to the concurrency when throttled
+        latency_factor (float): Allowed growth of latency over the baseline
+        rate_factor (float): Allowed drop of the completion rate from the best rate
+    """
+    def __init__(self, initial=10, minimum=1, maximum=250, increase=5, decrease=0.5,
+                 latency_factor=2.0, rate_factor=0.8):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.rate_factor = rate_factor
+
+        self.best_rate = 0.0
+        self.best_concurrency = initial
+
+    def update(self, concurrency, stats):
+        if stats.throttles > 0:
+            new = int(concurrency * self.decrease)
+        elif stats.latency is not None and stats.baseline_latency and \
+             stats.latency > stats.baseline_latency * self.latency_factor:
+            new = concurrency - self.increase
+        elif stats.rate is not None and stats.rate < self.best_rate * self.rate_factor and \
+             concurrency > self.best_concurrency:
+            new = max(self.best_concurrency, concurrency - self.increase)
+        elif stats.completed > 0 and stats.pending > 0:
+            new = concurrency + self.increase
+        else:
+            new = concurrency
+
+        if stats.rate is not None and stats.rate > self.best_rate:
+            self.best_rate = stats.rate
+            self.best_concurrency = concurrency
+
+        return max(self.minimum, min(self.maximum, new))
+
+POLICIES = {
+    'static': StaticPolicy,
+    'aimd': AIMDPolicy,
+}
+
+def create_policy(config):
+    """Create a fanout policy
+
+    Args:
+        config (str|dict): Name of the policy in POLICIES, or a dict with the
+                           'name' of the policy and its keyword arguments
+
+    Returns:
+        Policy object
+
+    Raises:
+        ValueError: If the policy is unknown
+    """
+    if isinstance(config, str):
+        config = {'name': config}
+    config = dict(config)
+    name = config.pop('name')
+    if name not in POLICIES:
+        raise ValueError("Unknown fanout policy '{}'".format(name))
+    return POLICIES[name](**config)
+
+class StepFunctionBackend(object):
+    """Run sub-executions as StepFunction executions
+
+    Args:
+        session (boto3.session): Active session for communicating with AWS
+        sub_sfn (str): Name or full ARN of the StepFunction to execute
+    """
+    def __init__(self, session, sub_sfn):
+        # heaviside is only needed when actually running StepFunctions
+        from heaviside.activities import SFN
+        self.sfn = SFN(session, sub_sfn)
+
+    def launch(self, args):
+        """Start a sub-execution, returning its handle"""
+        return self.sfn.launch(args)
+
+    def status(self, handle):
+        """Get the state of the sub-execution
+
+        Returns:
+            (str, object): 'RUNNING' | 'SUCCEEDED' | 'FAILED' and the parsed output
+        """
+        status = self.sfn.status(handle)
+        if status.success:
+            return 'SUCCEEDED', status.output
+        elif status.failed:
+            return 'FAILED', None
+        else:
+            return 'RUNNING', None
+
+    def error(self, handle):
+        """Get the exception describing why the sub-execution failed"""
+        return self.sfn.error(handle)
+
+    def cancel(self, handle):
+        self.sfn.cancel(handle)
+
+    @staticmethod
+    def is_throttle(ex):
+        """If the exception raised by launch / status was throttling"""
+        response = getattr(ex, 'response', None)
+        return response is not None and response.get('Error', {}).get('Code') in THROTTLE_ERRORS
+
+class CloudWatchThrottles(object):
+    """Throttle monitor that sums CloudWatch metrics
+
+    CloudWatch metrics are published once a minute, so the metrics are only
+    read once per `period`, returning 0 in between.
+
+    Args:
+        session (boto3.session): Active session for communicating with AWS
+        metrics (list[tuple]): (namespace, metric name, dimensions dict) of the
+                               metrics to sum
+        period (int) - seconds: How often to read the metrics
+    """
+    def __init__(self, session, metrics, period=60):
+        self.client = session.client('cloudwatch')
+        self.metrics = metrics
+        self.period = period
+        self.last = datetime.utcnow()
+
+    @staticmethod
+    def dynamodb(table):
+        """Read and write throttle metrics of a DynamoDB table"""
+        return [('AWS/DynamoDB', metric, {'TableName': table})
+                for metric in ('ReadThrottleEvents', 'WriteThrottleEvents')]
+
+    @staticmethod
+    def s3(bucket, filter_id='EntireBucket'):
+        """5xx error (503 SlowDown) metric of an S3 bucket
+
+        Note: Requires a request metrics configuration on the bucket, with the
+              given filter_id ('EntireBucket' is the id the S3 console uses
+              for a filter covering the whole bucket). Otherwise the metric
+              has no datapoints and always counts as 0
+        """
+        return [('AWS/S3', '5xxErrors', {'BucketName': bucket, 'FilterId': filter_id})]
+
+    def __call__(self):
+        now = datetime.utcnow()
+        if now - self.last < timedelta(seconds=self.period):
+            return 0
+
+        total = 0
+        for namespace, metric, dimensions in self.metrics:
+            resp = self.client.get_metric_statistics(Namespace = namespace,
+                                                     MetricName = metric,
+                                                     Dimensions = [{'Name': k, 'Value': v}
+                                                                   for k, v in dimensions.items()],
+                                                     StartTime = self.last,
+                                                     EndTime = now,
+                                                     Period = self.period,
+                                                     Statistics = ['Sum'])
+            total += sum(point['Sum'] for point in resp['Datapoints'])
+
+        self.last = now
+        return int(total)
+
+def adaptive_fanout(backend, sub_args, policy=None, throttle_monitor=None, poll_delay=5, status_delay=1,
+                    window=6, progress=None, rampup_delay=0, rampup_backoff=0.8, clock=time.time, sleep=time.sleep):
+    """Execute a sub-execution for each of the arguments, adapting the
+    number of concurrent executions to the observed behavior
+
+    If any sub-execution fails all running sub-executions are cancelled and
+    the error is raised.
+
+    Args:
+        backend (StepFunctionBackend): Backend to run the sub-executions on
+        sub_args (iterable): Arguments for each sub-execution
+        policy (optional[Policy]): Controls the concurrency (default AIMDPolicy)
+        throttle_monitor (optional[callable]): Returns the number of throttling
+                                               errors seen since it was last called
+        poll_delay (int) - seconds: Delay between polling rounds
+        status_delay (int) - seconds: Delay between each status request
+        window (int): Number of polling rounds the latency and rate are measured over
+        progress (optional[callable]): Called after each polling round with the list of
+                                       indices (into sub_args) of the sub-executions
+                                       that finished successfully during the round
+        rampup_delay (int) - seconds: Initial delay after each launch, like heaviside's fanout,
+                                      so AWS resources can scale to the request volume
+        rampup_backoff (float): Multiplier applied to the rampup_delay after each launch
+        clock (callable): Returns the current time in seconds
+        sleep (callable): Sleeps for the given seconds
+
+    Returns:
+        list: The output of each sub-execution, in the same order as sub_args
+    """
+    log = BossLogger().logger
+
+    if policy is None:
+        policy = AIMDPolicy()
+
+    pending = deque(enumerate(sub_args))
+    results = [None] * len(pending)
+    running = {} # handle -> (index, start time)
+    concurrency = policy.initial
+
+    # (time, [latencies]) of each polling round in the window
+    rounds = deque(maxlen = window)
+    baseline = None
+
+    try:
+        while pending or running:
+            throttles = 0
+
+            # Launch any pending sub-executions, as the concurrency allows
+            while pending and len(running) < concurrency:
+                index, args = pending[0]
+                try:
+                    handle = backend.launch(args)
+                except Exception as ex:
+                    if not backend.is_throttle(ex):
+                        raise
+                    throttles += 1
+                    break
+
+                pending.popleft()
+                running[handle] = (index, clock())
+
+                if rampup_delay > 0:
+                    sleep(rampup_delay)
+                    rampup_delay = int(rampup_delay * rampup_backoff)
+
+            sleep(poll_delay)
+
+            # Check the status of the running sub-executions
+            latencies, finished = [], []
+            for handle, (index, start) in list(running.items()):
+                try:
+                    state, output = backend.status(handle)
+                except Exception as ex:
+                    if not backend.is_throttle(ex):
+                        raise
+                    throttles += 1
+                    break
+
+                if state == 'FAILED':
+                    del running[handle]
+                    raise backend.error(handle)
+                elif state == 'SUCCEEDED':
+                    del running[handle]
+                    results[index] = output
+                    latencies.append(clock() - start)
+                    finished.append(index)
+
+                if status_delay:
+                    sleep(status_delay)
+
+            if progress is not None and finished:
+                progress(finished)
+
+            if throttle_monitor is not None:
+                throttles += throttle_monitor()
+
+            # Measure over the window of polling rounds
+            now = clock()
+            rounds.append((now, latencies))
+            window_latencies = [l for _, ls in rounds for l in ls]
+            latency = sum(window_latencies) / len(window_latencies) if window_latencies else None
+            if latency is not None and (baseline is None or latency < baseline):
+                baseline = latency
+
+            rate = None
+            if len(rounds) == window and now > rounds[0][0]:
+                # Completions in the first round happened before the window started
+                completed = sum(len(ls) for _, ls in list(rounds)[1:])
+                rate = completed / (now - rounds[0][0])
+
+            stats = FanoutStats(len(running), len(pending), len(window_latencies), latency, baseline,
+                                rate, throttles)
+            new = policy.update(concurrency, stats)
+            if new != concurrency:
+                log.debug("Fanout concurrency {} -> {} ({})".format(concurrency, new, stats))
+            concurrency = new
+
+        return results
+
+    finally:
+        # Only non-empty if there was an exception
+        for handle in running:
+            try:
+                backend.cancel(handle)
+            except:
+                log.exception("Could not cancel {}".format(handle))
+
+def fanout_step_functions(session, sub_sfn, sub_args, policy, throttle_metrics=None, poll_delay=5, status_delay=1,
+                          progress=None, rampup_delay=0, rampup_backoff=0.8):
+    """Adaptive version of heaviside.activities.fanout
+
+    Args:
+        session (boto3.session): Active session for communicating with AWS
+        sub_sfn (str): Name or full ARN of the StepFunction to execute
+        sub_args (iterable): Arguments for each StepFunction execution
+        policy (str|dict): Policy configuration, see create_policy
+        throttle_metrics (optional[list]): CloudWatch metrics to count as
+                                           throttling, see CloudWatchThrottles
+        poll_delay (int) - seconds: Delay between polling rounds
+        status_delay (int) - seconds: Delay between each status request
+        progress (optional[callable]): See adaptive_fanout
+        rampup_delay (int) - seconds: See adaptive_fanout
+        rampup_backoff (float): See adaptive_fanout
+
+    Returns:
+        list: The output of each execution, in the same order as sub_args
+    """
+    backend = StepFunctionBackend(session, sub_sfn)
+    monitor = CloudWatchThrottles(session, throttle_metrics) if throttle_metrics else None
+    return adaptive_fanout(backend, sub_args, create_policy(policy), monitor,
+                           poll_delay = poll_delay,
+                           status_delay = status_delay,
+                           progress = progress,
+                           rampup_delay = rampup_delay,
+                           rampup_backoff = rampup_backoff)
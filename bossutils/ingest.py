@@ -0,0 +1,302 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tile decoding and cuboid writing for the ingest lambda.
+
+Kept out of the lambda script, which loads its settings and reads its event
+when it is run, so that they can be imported and tested.
+"""
+
+import threading
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+from PIL import Image
+from spdb.spatialdb import SpdbError
+
+from bossutils.dynamodb import batch_write, s3_index_put_request
+
+# int: Default number of tiles downloaded and decoded concurrently
+#      Override with the 'tile_fetch_threads' event key
+MAX_TILE_THREADS = 8
+
+# int: Default number of cuboids compressed and uploaded concurrently
+#      Override with the 'cuboid_write_threads' event key
+MAX_WRITE_THREADS = 8
+
+# int: Cuboids each write thread can have in flight, so that the next cuboids
+#      are compressed while the previous ones are uploaded
+CUBOIDS_PER_THREAD = 2
+
+# int: Copies of a whole tile each decode thread can hold
+#      Pillow decodes the whole tile, even when only a crop of it is needed,
+#      and the decoded image is then copied into a numpy array
+DECODE_COPIES = 2
+
+class TileSlab(object):
+    """The tiles of a chunk, decoded into a preallocated (z, y, x) array
+
+    By default each tile is decoded as soon as it is downloaded, directly into
+    a slab allocated once for the whole chunk, so the chunk never exists twice
+    in memory. If a memory limit is given and the whole slab doesn't fit, the
+    encoded tiles are kept instead and decoded one window of cuboid columns
+    at a time (see windows), trading decode time for memory.
+
+    The memory limit includes the tiles being decoded by each thread (see
+    DECODE_COPIES) and the reserved memory, in addition to the slab or the
+    encoded tiles and window.
+
+    Args:
+        tile_key_list (list[str]): Tile keys, sorted by Z slice
+        dtype (np.dtype): Data type of the channel
+        metrics (StageMetrics): Records the 'fetch' and 'decode' times
+        open_bucket (callable): Creates a TileBucket, called once per thread
+                                as boto3 resources are not thread safe
+        max_workers (int): Maximum number of tiles to fetch or decode at once
+        memory_limit (optional[int]): MB the decoded chunk can use
+        reserved (int): Bytes of the memory limit used by other buffers
+    """
+    def __init__(self, tile_key_list, dtype, metrics, open_bucket,
+                 max_workers=MAX_TILE_THREADS, memory_limit=None, reserved=0):
+        self.tile_key_list = tile_key_list
+        self.dtype = np.dtype(dtype)
+        self.metrics = metrics
+        self.open_bucket = open_bucket
+        self.max_workers = max(1, min(max_workers, len(tile_key_list)))
+        self.memory_limit = memory_limit
+        self.reserved = reserved
+        self.shape = None # (z, y, x) of the whole chunk
+        self.data = None # The decoded chunk, if it fit in memory
+        self.encoded = None # The encoded tiles, if the chunk didn't fit
+        self.buffer = None # Window buffer, reused for each window
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def decode_nbytes(self):
+        """Bytes used by the tiles being decoded at once"""
+        z, y, x = self.shape
+        return self.max_workers * DECODE_COPIES * y * x * self.dtype.itemsize
+
+    def _decode(self, image, out):
+        with self.metrics.time('decode'):
+            tile = np.asarray(image, dtype=self.dtype)
+            out[:tile.shape[0], :tile.shape[1]] = tile
+
+    def _map(self, func):
+        """Call func(z, tile_key) for each tile on a thread pool, raising the first error"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(func, z, tile_key) for z, tile_key in enumerate(self.tile_key_list)]
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                # Don't process the rest of the tiles if one failed
+                for future in futures:
+                    future.cancel()
+
+    def fetch(self):
+        """Download the tiles concurrently, decoding them if the chunk fits in memory
+
+        The S3 requests of one tile overlap with the decoding of others.
+
+        Raises:
+            KeyError: If a tile is missing from the tile bucket
+        """
+        local = threading.local()
+        encoded = [None] * len(self.tile_key_list)
+
+        def fetch(z, tile_key):
+            if not hasattr(local, 'bucket'):
+                local.bucket = self.open_bucket()
+            with self.metrics.time('fetch'):
+                image_data, _, _, _ = local.bucket.getObjectByKey(tile_key)
+            image = Image.open(BytesIO(image_data)) # Only reads the header
+
+            # The first tile decides the size of the chunk
+            with self.lock:
+                if self.shape is None:
+                    self.shape = (len(self.tile_key_list), image.size[1], image.size[0])
+                    if (self.memory_limit is None or
+                        self.nbytes + self.decode_nbytes + self.reserved <= self.memory_limit * 2**20):
+                        self.data = np.zeros(self.shape, dtype=self.dtype)
+                    else:
+                        self.encoded = encoded
+
+            if self.data is not None:
+                self._decode(image, self.data[z])
+            else:
+                encoded[z] = image_data
+
+        self._map(fetch)
+
+    def windows(self, cuboid_size):
+        """Split the chunk into (y_start, y_stop, x_start, x_stop) windows of whole cuboids
+
+        If the chunk was decoded there is a single window. Otherwise the windows
+        are bands of cuboid columns along X, as wide as fit in the memory left
+        after the encoded tiles, the tiles being decoded, and the reserved
+        memory, or if a single column doesn't fit, bands of cuboids along Y
+        within each column. A window is never smaller than one cuboid.
+
+        Args:
+            cuboid_size (list): The [x, y, z] cuboid size
+
+        Returns:
+            list[tuple]
+        """
+        z, y, x = self.shape
+        if self.data is not None:
+            return [(0, y, 0, x)]
+
+        cx, cy = cuboid_size[0], cuboid_size[1]
+        available = (self.memory_limit * 2**20 - self.reserved - self.decode_nbytes -
+                     sum(len(data) for data in self.encoded))
+        column = z * y * cx * self.dtype.itemsize
+        if available >= column:
+            width, height = cx * (available // column), y
+        else:
+            width, height = cx, cy * max(1, available // (z * cy * cx * self.dtype.itemsize))
+
+        return [(y_start, min(y_start + height, y), x_start, min(x_start + width, x))
+                for x_start in range(0, x, width)
+                for y_start in range(0, y, height)]
+
+    def window(self, y_start, y_stop, x_start, x_stop):
+        """Get the (z, y, x) data of a window, decoding the tiles if needed
+
+        The returned array is only valid until the next call.
+        """
+        if self.data is not None:
+            return self.data[:, y_start:y_stop, x_start:x_stop]
+
+        shape = (self.shape[0], y_stop - y_start, x_stop - x_start)
+        if self.buffer is None or self.buffer.size < np.prod(shape):
+            self.buffer = np.zeros(int(np.prod(shape)), dtype=self.dtype)
+        out = self.buffer[:int(np.prod(shape))].reshape(shape)
+        out.fill(0)
+
+        def decode(z, tile_key):
+            # Decodes the whole tile, see DECODE_COPIES
+            image = Image.open(BytesIO(self.encoded[z]))
+            self._decode(image.crop((x_start, y_start, x_stop, y_stop)), out[z])
+
+        self._map(decode)
+        return out
+
+def cuboid_memory(cuboid_size, dtype, max_in_flight):
+    """Get the bytes used by the cuboids write_cuboids holds at once
+
+    Each cuboid in flight holds its data and its compressed data, which is
+    at most the same size, plus the cuboid being assembled.
+
+    Args:
+        cuboid_size (list): The [x, y, z] cuboid size
+        dtype (np.dtype): Data type of the channel
+        max_in_flight (int): See write_cuboids
+
+    Returns:
+        int
+    """
+    nbytes = int(np.prod(cuboid_size)) * np.dtype(dtype).itemsize
+    return (2 * max_in_flight + 1) * nbytes
+
+def write_cuboids(sp, resource, resolution, cuboids, ingest_job, s3_index_table,
+                  executor, compressor, metrics, max_in_flight):
+    """Compress, upload, and index cuboids concurrently
+
+    Each cuboid is compressed on the compressor's threads, in parallel with
+    the S3 PUTs of the others on the executor's threads. At most max_in_flight
+    cuboids are held at once, the next cuboid isn't taken from the cuboids
+    iterable until an earlier one is written, so the memory used is bounded
+    (see cuboid_memory).
+
+    The S3 Index entries of image cuboids are written with BatchWriteItem
+    once all of the cuboids are uploaded, so an entry only exists for a
+    stored cuboid. Updating the ID Index of an annotation cuboid adds its
+    id-set to the cuboid's S3 Index entry, which a later put would replace,
+    so annotation cuboids are indexed one at a time, with spdb's
+    add_cuboid_to_index before update_id_indices, right after the upload.
+
+    Args:
+        sp (SpatialDB): SpatialDB instance
+        resource (BossResourceBasic): Resource of the cuboids
+        resolution (int): Resolution of the cuboids
+        cuboids (iterable[(str, Cube)]): Object keys and cubes to write
+        ingest_job (int): Ingest job ID
+        s3_index_table (str): Name of the S3 Index table
+        executor (ThreadPoolExecutor): Threads to upload and index with
+        compressor (Compressor): Compressor for the cuboid data
+        metrics (StageMetrics): Records the 'put' and 'index' times
+        max_in_flight (int): Maximum number of cuboids held at once
+
+    Returns:
+        list[SpdbError]: Errors updating the ID Index of annotation cuboids
+    """
+    annotation = resource.data['channel']['type'] == 'annotation'
+
+    def write(object_key, cube, compressed):
+        compressed = compressed.result()
+        with metrics.time('put'):
+            sp.objectio.put_objects([object_key], [compressed])
+
+        if annotation:
+            with metrics.time('index'):
+                sp.objectio.add_cuboid_to_index(object_key, ingest_job=ingest_job)
+            try:
+                with metrics.time('index'):
+                    sp.objectio.update_id_indices(resource, resolution, [object_key], [cube.data])
+            except SpdbError as ex:
+                return ex
+
+    errors = []
+    def wait():
+        ex = in_flight.popleft().result()
+        if ex is not None:
+            errors.append(ex)
+
+    requests = []
+    in_flight = deque()
+    try:
+        for object_key, cube in cuboids:
+            if not annotation:
+                # Created before the upload, so an unexpected key fails before anything is written
+                requests.append(s3_index_put_request(object_key, ingest_job))
+
+            if len(in_flight) >= max_in_flight:
+                wait()
+
+            # Decompressible by Cube.from_blosc / blosc.decompress, using the configured codec
+            compressed = compressor.submit(cube.data)
+            in_flight.append(executor.submit(write, object_key, cube, compressed))
+
+        # Wait for the rest of the uploads, raising the first error
+        while in_flight:
+            wait()
+    finally:
+        # Don't write the rest of the cuboids if one failed
+        for future in in_flight:
+            future.cancel()
+
+    if requests:
+        with metrics.time('index'):
+            batch_write(boto3.client('dynamodb'), s3_index_table, requests)
+
+    return errors
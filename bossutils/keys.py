@@ -0,0 +1,112 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""BOSS object keys of the cubes of a channel resolution.
+
+The lambda loader runs a lambda's script with runpy.run_path on every
+invocation, so anything cached in the script is rebuilt each time. The
+KeyContexts are cached in this module instead, which stays imported by a
+warm lambda, so they are reused across invocations.
+"""
+
+import hashlib
+import functools
+import numpy as np
+
+from bossutils.multidimensional import XYZ
+from bossutils.downsample import BUFFERS
+
+# int: Number of KeyContexts cached by a warm worker
+KEY_CONTEXT_CACHE = 64
+
+class KeyContext(object):
+    """BOSS keys, cube dimensions and buffers for one channel resolution
+
+    The parts of the HashedKey shared by every cube of the channel resolution
+    are joined, encoded, and hashed once, so generating a key only hashes
+    the Morton ID suffix. Use key_context() to get a cached instance.
+
+    Args:
+        collection_id (int): Collection ID
+        experiment_id (int): Experiment ID
+        channel_id (int): Channel ID
+        resolution (int): Resolution of the cubes
+        iso (str|None): 'ISO' if the keys should include the ISO flag
+        data_type (str): 'uint8' | 'uint16' | 'uint64'
+        dim (tuple): XYZ dimensions of a single cube
+    """
+    def __init__(self, collection_id, experiment_id, channel_id, resolution, iso, data_type, dim):
+        self.resolution = resolution
+        self.iso = iso
+        self.dim = XYZ(*dim)
+        self.dtype = np.dtype(data_type)
+
+        parts = [iso, collection_id, experiment_id, channel_id, resolution]
+        prefix = '&'.join([str(part) for part in parts if part is not None]) + '&'
+
+        # Cube keys include the time sample, ID Index keys don't
+        self._cube_prefix = prefix + '0&' # time sample 0
+        self._cube_hash = hashlib.md5(self._cube_prefix.encode())
+        self._id_prefix = prefix
+        self._id_hash = hashlib.md5(self._id_prefix.encode())
+
+    @staticmethod
+    def _key(prefix, digest, suffix, version):
+        digest = digest.copy()
+        digest.update(suffix.encode())
+        key = '{}&{}{}'.format(digest.hexdigest(), prefix, suffix)
+        if version is not None:
+            key = '{}&{}'.format(key, version)
+        return key
+
+    def cube_key(self, morton, version=None):
+        """Same as HashedKey(iso, col, exp, chan, res, 0, morton, version=version)"""
+        return self._key(self._cube_prefix, self._cube_hash, str(int(morton)), version)
+
+    def cube_keys(self, mortons, version=None):
+        """Generate the cube keys for a sequence or array of Morton IDs
+
+        Returns:
+            list[str]: The keys, in the same order as mortons
+        """
+        prefix, digest, key = self._cube_prefix, self._cube_hash, self._key
+        return [key(prefix, digest, str(int(morton)), version) for morton in mortons]
+
+    def id_key(self, id):
+        """Same as HashedKey(iso, col, exp, chan, res, id)"""
+        return self._key(self._id_prefix, self._id_hash, str(id), None)
+
+    def buffer(self, name, cubes=XYZ(1, 1, 1)):
+        """Get a pooled buffer (see BufferPool.get) for a block of cubes
+
+        Args:
+            name (str): Name of the buffer
+            cubes (XYZ): Number of cubes the buffer holds
+
+        Returns:
+            (np.array, bool): The buffer and if it was newly allocated
+        """
+        return BUFFERS.get(name, (self.dim * cubes).zyx, self.dtype)
+
+@functools.lru_cache(maxsize=KEY_CONTEXT_CACHE)
+def key_context(collection_id, experiment_id, channel_id, resolution, iso, data_type, dim):
+    """Get the cached KeyContext for a channel resolution
+
+    Args:
+        See KeyContext, dim must be a tuple so it can be part of the cache key
+
+    Returns:
+        KeyContext
+    """
+    return KeyContext(collection_id, experiment_id, channel_id, resolution, iso, data_type, dim)
@@ -0,0 +1,146 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per invocation timing of lambda stages.
+
+Instead of printing as work happens, the duration of each stage is
+aggregated in memory and a single JSON record is emitted at the end of the
+invocation. Every duration is counted in the totals, while only a bounded
+random sample is kept for the percentiles, so the memory used doesn't grow
+with the number of cuboids. Whole records are also sampled, so busy lambdas
+can limit their CloudWatch log volume.
+
+Example record:
+    {"metrics": "ingest", "wall": 2.1, "counters": {"cuboids": 16},
+     "stages": {"fetch": {"count": 16, "total": 1.2, "max": 0.2, "p50": 0.07, "p90": 0.1}}}
+"""
+
+import sys
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+# int: Maximum number of durations kept per stage for the percentiles
+SAMPLE_SIZE = 256
+
+class StageMetrics(object):
+    """Aggregated stage durations and counters for a single invocation
+
+    Safe to use from multiple threads.
+
+    Args:
+        name (str): Name of the record, usually the lambda
+        sample_rate (float): Fraction of invocations that emit their record
+        clock (callable): Returns the current time in seconds
+    """
+    def __init__(self, name, sample_rate=1.0, clock=time.perf_counter):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.start = clock()
+        self.lock = threading.Lock()
+        self.stages = {} # name: [count, total, max, samples]
+        self.counters = {}
+
+    @contextmanager
+    def time(self, stage):
+        """Context manager that adds the duration of the block to the stage"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(stage, self.clock() - start)
+
+    def add(self, stage, seconds, count=1):
+        """Add a duration to the stage
+
+        Args:
+            stage (str): Name of the stage
+            seconds (float): Duration of the work
+            count (int): Number of items the duration covers
+        """
+        with self.lock:
+            values = self.stages.get(stage)
+            if values is None:
+                values = self.stages[stage] = [0, 0.0, 0.0, []]
+            values[0] += count
+            values[1] += seconds
+            values[2] = max(values[2], seconds)
+
+            # Reservoir sample, so every duration has the same chance of being kept
+            samples = values[3]
+            if len(samples) < SAMPLE_SIZE:
+                samples.append(seconds)
+            else:
+                i = random.randrange(values[0])
+                if i < SAMPLE_SIZE:
+                    samples[i] = seconds
+
+    def count(self, name, value=1):
+        """Increment a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, **extra):
+        """Create the aggregated record
+
+        Args:
+            extra: Additional values to include in the record
+
+        Returns:
+            dict
+        """
+        def percentile(samples, p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+        with self.lock:
+            stages = {}
+            for stage, (count, total, max_, samples) in self.stages.items():
+                samples = sorted(samples)
+                stages[stage] = {
+                    'count': count,
+                    'total': round(total, 6),
+                    'max': round(max_, 6),
+                    'p50': round(percentile(samples, 0.5), 6),
+                    'p90': round(percentile(samples, 0.9), 6),
+                }
+
+            record = {
+                'metrics': self.name,
+                'wall': round(self.clock() - self.start, 6),
+                'counters': dict(self.counters),
+                'stages': stages,
+            }
+        record.update(extra)
+        return record
+
+    def emit(self, out=None, **extra):
+        """Write the record as a single JSON line, if the invocation is sampled
+
+        Args:
+            out (optional[file]): Where to write the record (default stdout)
+            extra: Additional values to include in the record
+
+        Returns:
+            bool: If the record was written
+        """
+        if random.random() >= self.sample_rate:
+            return False
+
+        out = out or sys.stdout
+        out.write(json.dumps(self.record(**extra)) + '\n')
+        out.flush()
+        return True
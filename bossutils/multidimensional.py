@@ -121,6 +121,143 @@ def range(*args, step=None):
             for z in range_(int(start.z), int(stop.z), int(step.z)):
                 yield cls(x=x, y=y, z=z)
 
+def morton_range(*args, step=None, cursor=None):
+    """Same as range, but yields the vectors in Morton (Z-order) order
+
+    The order is by the Morton ID of each vector divided by step. When start is
+    a multiple of step this is the Morton ID of the cube generated by
+    downsampling the block of cubes starting at the vector.
+
+    Args:
+        cursor (optional[int]): Skip all vectors whose Morton ID is less than cursor,
+                                used to resume an interrupted traversal
+
+    Returns:
+        generator: Vectors of the same type as start
+    """
+    if len(args) == 2:
+        start, stop = args
+    else:
+        stop, = args
+        start = type(stop)(0,0,0)
+    cls = type(start)
+
+    if step is None:
+        step = cls(1,1,1)
+
+    # Traverse the grid coordinates (vector // step) of the range
+    lo = XYZ(*[int(start[i]) // int(step[i]) for i in range_(3)])
+    count = XYZ(*[max(ceildiv(int(stop[i]) - int(start[i]), int(step[i])), 0) for i in range_(3)])
+    hi = lo + count
+    if 0 in count:
+        return
+
+    # Walk an octree that covers the grid, in Morton order, pruning nodes
+    # outside of the range or before the cursor
+    size = 1 << max(int(v - 1).bit_length() for v in hi)
+    nodes = [(XYZ(0,0,0), size)]
+    while nodes:
+        corner, size = nodes.pop()
+
+        if any(corner[i] >= hi[i] or corner[i] + size <= lo[i] for i in range_(3)):
+            continue
+
+        if cursor is not None and corner.morton + size ** 3 <= cursor:
+            continue
+
+        if size == 1:
+            if cursor is None or corner.morton >= cursor:
+                yield cls(x = start.x + (corner.x - lo.x) * step.x,
+                          y = start.y + (corner.y - lo.y) * step.y,
+                          z = start.z + (corner.z - lo.z) * step.z)
+            continue
+
+        # Push the octants in reverse so the first octant is processed first
+        half = size // 2
+        for octant in reversed(range_(8)):
+            offset = XYZ(octant & 1, (octant >> 1) & 1, (octant >> 2) & 1)
+            nodes.append((corner + offset * half, half))
+
+# Magic numbers used to spread the 21 low bits of a value out to every third
+# bit, as (shift, mask) pairs. Compacting applies the shifts in reverse.
+MORTON_SPLIT = [(32, 0x1f00000000ffff),
+                (16, 0x1f0000ff0000ff),
+                (8,  0x100f00f00f00f00f),
+                (4,  0x10c30c30c30c30c3),
+                (2,  0x1249249249249249)]
+MORTON_COMPACT = [(2,  0x10c30c30c30c30c3),
+                  (4,  0x100f00f00f00f00f),
+                  (8,  0x1f0000ff0000ff),
+                  (16, 0x1f00000000ffff),
+                  (32, 0x1fffff)]
+
+def _split_bits(v):
+    v = v & np.uint64(0x1fffff)
+    for shift, mask in MORTON_SPLIT:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+def _compact_bits(v):
+    v = v & np.uint64(0x1249249249249249)
+    for shift, mask in MORTON_COMPACT:
+        v = (v | (v >> np.uint64(shift))) & np.uint64(mask)
+    return v
+
+def morton_encode(xyz):
+    """Vectorized version of VectorMathMixin.morton
+
+    Args:
+        xyz (np.array): (N, 3) array of X, Y, Z coordinates, each less than 2 ** 21
+
+    Returns:
+        np.array: (N,) uint64 array of Morton IDs
+    """
+    xyz = np.asarray(xyz, dtype=np.uint64).reshape(-1, 3)
+    return _split_bits(xyz[:, 0]) | \
+           (_split_bits(xyz[:, 1]) << np.uint64(1)) | \
+           (_split_bits(xyz[:, 2]) << np.uint64(2))
+
+def morton_decode(mortons):
+    """Vectorized version of VectorMathMixin.from_morton
+
+    Args:
+        mortons (np.array): Morton IDs
+
+    Returns:
+        np.array: (N, 3) uint64 array of X, Y, Z coordinates
+    """
+    mortons = np.asarray(mortons, dtype=np.uint64).reshape(-1)
+    return np.stack([_compact_bits(mortons),
+                     _compact_bits(mortons >> np.uint64(1)),
+                     _compact_bits(mortons >> np.uint64(2))], axis=1)
+
+def range_blocks(*args, step=None, block_size=65536):
+    """Same as range, but yields the vectors as (N, 3) numpy arrays
+
+    The vectors are generated in the same order as range, X major.
+
+    Args:
+        block_size (int): Maximum number of vectors in each yielded array
+
+    Returns:
+        generator[np.array]: (N, 3) int64 arrays of X, Y, Z coordinates
+    """
+    if len(args) == 2:
+        start, stop = args
+    else:
+        stop, = args
+        start = type(stop)(0,0,0)
+
+    if step is None:
+        step = XYZ(1,1,1)
+
+    axes = [np.arange(int(start[i]), int(stop[i]), int(step[i]), dtype=np.int64) for i in range_(3)]
+    total = len(axes[0]) * len(axes[1]) * len(axes[2])
+    for first in range_(0, total, block_size):
+        idx = np.arange(first, min(first + block_size, total), dtype=np.int64)
+        x, y, z = np.unravel_index(idx, (len(axes[0]), len(axes[1]), len(axes[2])))
+        yield np.stack([axes[0][x], axes[1][y], axes[2][z]], axis=1)
+
 slice_ = slice
 def slice(args):
     start = stop = step = (None, None, None)
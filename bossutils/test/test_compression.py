@@ -0,0 +1,54 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.compression import Compressor, codec_settings, shared_compressor
+
+import blosc
+import numpy as np
+import unittest
+
+class TestCompressor(unittest.TestCase):
+    def test_compress_many(self):
+        """Test that the data round trips through blosc.decompress, in order"""
+        arrays = [np.full((4, 32, 32), i, dtype=np.uint16) for i in range(10)]
+        settings = {'uint16': {'cname': 'lz4', 'clevel': 5, 'shuffle': 'bitshuffle'}}
+
+        with Compressor(settings, max_workers = 4) as compressor:
+            compressed = compressor.compress_many(arrays)
+            metrics = compressor.metrics()
+
+        for data, array in zip(compressed, arrays):
+            actual = np.frombuffer(blosc.decompress(data), dtype=np.uint16).reshape(array.shape)
+            np.testing.assert_array_equal(actual, array)
+
+        self.assertEqual(metrics['count'], 10)
+        self.assertEqual(metrics['raw_bytes'], sum(a.nbytes for a in arrays))
+        self.assertGreater(metrics['ratio'], 1)
+
+    def test_shared_compressor(self):
+        settings = {'uint8': {'cname': 'lz4'}}
+        compressor = shared_compressor(settings, 2)
+
+        self.assertIs(shared_compressor({'uint8': {'cname': 'lz4'}}, 2), compressor)
+        self.assertIsNot(shared_compressor(settings, 4), compressor)
+        self.assertIsNot(shared_compressor(None, 2), compressor)
+        self.assertEqual(compressor.settings, settings)
+
+    def test_codec_settings(self):
+        self.assertEqual(codec_settings('uint64'),
+                         {'typesize': 8, 'cname': 'blosclz', 'clevel': 9, 'shuffle': blosc.SHUFFLE})
+        self.assertEqual(codec_settings(np.uint8, {'uint8': {'clevel': 1}})['clevel'], 1)
+
+        with self.assertRaises(ValueError):
+            codec_settings('uint8', {'uint8': {'cname': 'unknown'}})
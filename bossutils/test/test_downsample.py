@@ -0,0 +1,114 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.downsample import block_reduce, register_reducer, REDUCERS, ANNOTATION_REDUCERS
+
+import numpy as np
+import unittest
+
+class TestBlockReduce(unittest.TestCase):
+    def test_mean_isotropic(self):
+        """Test that the Z slices are averaged along with X and Y"""
+        volume = np.zeros((2, 2, 2), dtype=np.uint8)
+        volume[0] = 10
+        volume[1] = 20
+
+        actual = block_reduce(volume, (2, 2, 2), 'mean')
+
+        self.assertEqual(actual.shape, (1, 1, 1))
+        self.assertEqual(actual[0, 0, 0], 15)
+
+    def test_mean_anisotropic(self):
+        volume = np.arange(4 * 4 * 2, dtype=np.uint16).reshape(2, 4, 4)
+
+        actual = block_reduce(volume, (2, 2, 1), 'mean')
+
+        # Mean of each 2x2 block, rounded half up
+        expected = (volume.reshape(2, 1, 2, 2, 2, 2).sum(axis=(1, 3, 5)) + 2) // 4
+        np.testing.assert_array_equal(actual, expected)
+        self.assertEqual(actual.dtype, np.uint16)
+
+    def test_mean_uint64_no_overflow(self):
+        max_ = np.iinfo(np.uint64).max
+        volume = np.full((2, 2, 2), max_, dtype=np.uint64)
+        volume[0, 0, 0] = max_ - 8
+
+        actual = block_reduce(volume, 2, 'area')
+
+        self.assertEqual(actual[0, 0, 0], max_ - 1)
+
+    def test_out(self):
+        volume = np.ones((2, 4, 4), dtype=np.uint8)
+        out = np.zeros((1, 2, 2), dtype=np.uint8)
+
+        actual = block_reduce(volume, (2, 2, 2), out=out)
+
+        self.assertIs(actual, out)
+        np.testing.assert_array_equal(out, 1)
+
+    def test_bad_shape(self):
+        volume = np.zeros((3, 4, 4), dtype=np.uint8)
+        with self.assertRaises(ValueError):
+            block_reduce(volume, (2, 2, 2))
+
+    def test_unknown_method(self):
+        volume = np.zeros((2, 2, 2), dtype=np.uint8)
+        with self.assertRaises(ValueError):
+            block_reduce(volume, 2, 'bicubic')
+
+    def test_nearest_max_min(self):
+        volume = np.arange(2 * 4 * 4, dtype=np.uint16).reshape(2, 4, 4)
+        view = volume.reshape(1, 2, 2, 2, 2, 2)
+
+        np.testing.assert_array_equal(block_reduce(volume, 2, 'nearest'), volume[::2, ::2, ::2])
+        np.testing.assert_array_equal(block_reduce(volume, 2, 'max'), view.max(axis=(1, 3, 5)))
+        np.testing.assert_array_equal(block_reduce(volume, 2, 'min'), view.min(axis=(1, 3, 5)))
+
+    def test_register_reducer(self):
+        def reduce_last(view, out):
+            out[...] = view[:, -1, :, -1, :, -1]
+
+        register_reducer('last', reduce_last, annotation = True)
+        self.addCleanup(REDUCERS.pop, 'last')
+        self.addCleanup(ANNOTATION_REDUCERS.remove, 'last')
+
+        volume = np.arange(8, dtype=np.uint64).reshape(2, 2, 2)
+        self.assertEqual(block_reduce(volume, 2, 'last')[0, 0, 0], 7)
+        self.assertIn('last', ANNOTATION_REDUCERS)
+
+        with self.assertRaises(ValueError):
+            register_reducer('mean', reduce_last)
+
+    def test_mode(self):
+        """Test that the most common non-zero ID is selected"""
+        volume = np.zeros((2, 2, 4), dtype=np.uint64)
+        # Block 0: 5 appears twice, 7 once, zero five times
+        volume[0, 0, 0] = 5
+        volume[1, 1, 1] = 5
+        volume[0, 1, 0] = 7
+        # Block 1: tie between 9 and 2 ** 60
+        volume[0, 0, 2] = 9
+        volume[1, 0, 3] = 2 ** 60
+
+        actual = block_reduce(volume, (2, 2, 2), 'mode')
+
+        np.testing.assert_array_equal(actual, [[[5, 9]]])
+        self.assertEqual(actual.dtype, np.uint64)
+
+    def test_mode_empty(self):
+        volume = np.zeros((2, 2, 2), dtype=np.uint64)
+
+        actual = block_reduce(volume, 2, 'mode')
+
+        self.assertEqual(actual[0, 0, 0], 0)
@@ -0,0 +1,81 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.dynamodb import batch_write, s3_index_put_request
+from bossutils.dynamodb import MAX_BATCH_ITEMS, MAX_RETRIES, RETRY_DELAY
+
+import unittest
+from unittest.mock import patch
+
+class UnprocessedClient(object):
+    """DynamoDB client that leaves the last `unprocessed` items of each batch unprocessed"""
+    def __init__(self, unprocessed):
+        self.unprocessed = list(unprocessed) # per call
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        (table, items), = RequestItems.items()
+        self.calls.append(items)
+
+        count = self.unprocessed.pop(0) if self.unprocessed else 0
+        if count == 0:
+            return {'UnprocessedItems': {}}
+        return {'UnprocessedItems': {table: items[-count:]}}
+
+def put(i):
+    return {'PutRequest': {'Item': {'key': {'N': str(i)}}}}
+
+@patch('bossutils.dynamodb.time.sleep')
+class TestBatchWrite(unittest.TestCase):
+    def test_batches(self, sleep):
+        client = UnprocessedClient([])
+        requests = [put(i) for i in range(MAX_BATCH_ITEMS * 2 + 1)]
+
+        batch_write(client, 'table', requests)
+
+        self.assertEqual([len(items) for items in client.calls], [MAX_BATCH_ITEMS, MAX_BATCH_ITEMS, 1])
+        self.assertEqual(sum(client.calls, []), requests)
+        sleep.assert_not_called()
+
+    @patch('bossutils.dynamodb.random.uniform', return_value = 1.0)
+    def test_retry_unprocessed(self, uniform, sleep):
+        """Test that only the unprocessed items are resubmitted, with doubling delays"""
+        client = UnprocessedClient([5, 2])
+        requests = [put(i) for i in range(10)]
+
+        batch_write(client, 'table', requests)
+
+        self.assertEqual(client.calls, [requests, requests[5:], requests[8:]])
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [RETRY_DELAY, RETRY_DELAY * 2])
+
+    def test_unprocessed_raises(self, sleep):
+        client = UnprocessedClient([1] * (MAX_RETRIES + 1))
+
+        with self.assertRaises(Exception):
+            batch_write(client, 'table', [put(i) for i in range(3)])
+        self.assertEqual(len(client.calls), MAX_RETRIES + 1)
+
+class TestS3IndexPutRequest(unittest.TestCase):
+    def test_item(self):
+        key = 'a1b2&1&2&3&0&0&42'
+        self.assertEqual(s3_index_put_request(key, 7), {'PutRequest': {'Item': {
+            'object-key': {'S': key},
+            'version-node': {'N': '0'},
+            'ingest-job-hash': {'S': '1'},
+            'ingest-job-range': {'S': '2&3&0&7'},
+        }}})
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            s3_index_put_request('a1b2&ISO&1&2&3&0&0&42', 7)
@@ -0,0 +1,183 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.fanout import adaptive_fanout, create_policy, AIMDPolicy, StaticPolicy, FanoutStats
+
+import unittest
+
+class ThrottleError(Exception):
+    pass
+
+class SimulatedBackend(object):
+    """Simulated sub-executions running against a shared resource
+
+    Each sub-execution takes `latency` seconds, slowed down proportionally once
+    more than `capacity` are running. Launching a sub-execution while more
+    than `throttle_limit` are running causes a throttling error in the
+    resource, reported through the throttle monitor.
+    """
+    def __init__(self, latency=10, capacity=100, throttle_limit=None, launch_throttles=0, fail=None):
+        self.time = 0.0
+        self.latency = latency
+        self.capacity = capacity
+        self.throttle_limit = throttle_limit
+        self.launch_throttles = launch_throttles
+        self.fail = fail
+
+        self.executions = {}
+        self.cancelled = []
+        self.throttles = 0
+        self.max_running = 0
+        self.concurrency = [] # running count at each launch
+
+    def clock(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+    def running(self):
+        return sum(1 for e in self.executions.values() if e['end'] > self.time)
+
+    def launch(self, args):
+        if self.launch_throttles > 0:
+            self.launch_throttles -= 1
+            raise ThrottleError()
+
+        running = self.running()
+        if self.throttle_limit is not None and running >= self.throttle_limit:
+            self.throttles += 1
+
+        slowdown = max(1.0, (running + 1) / self.capacity)
+        handle = len(self.executions)
+        self.executions[handle] = {'args': args, 'end': self.time + self.latency * slowdown}
+        self.max_running = max(self.max_running, running + 1)
+        self.concurrency.append(running + 1)
+        return handle
+
+    def status(self, handle):
+        execution = self.executions[handle]
+        if execution['end'] > self.time:
+            return 'RUNNING', None
+        elif execution['args'] == self.fail:
+            return 'FAILED', None
+        else:
+            return 'SUCCEEDED', execution['args'] * 2
+
+    def error(self, handle):
+        return Exception("Sub-execution {} failed".format(handle))
+
+    def cancel(self, handle):
+        self.cancelled.append(handle)
+
+    def is_throttle(self, ex):
+        return isinstance(ex, ThrottleError)
+
+    def throttle_monitor(self):
+        throttles, self.throttles = self.throttles, 0
+        return throttles
+
+    def run(self, sub_args, policy, progress=None, rampup_delay=0):
+        return adaptive_fanout(self, sub_args, policy,
+                               throttle_monitor = self.throttle_monitor,
+                               progress = progress,
+                               rampup_delay = rampup_delay,
+                               poll_delay = 5,
+                               status_delay = 0,
+                               clock = self.clock,
+                               sleep = self.sleep)
+
+class TestAdaptiveFanout(unittest.TestCase):
+    def test_results_in_order(self):
+        backend = SimulatedBackend(launch_throttles = 3)
+
+        results = backend.run(range(100), StaticPolicy(7))
+
+        self.assertEqual(results, [i * 2 for i in range(100)])
+        self.assertEqual(backend.max_running, 7)
+
+    def test_progress(self):
+        backend = SimulatedBackend()
+        finished = []
+
+        backend.run(range(30), StaticPolicy(7), progress = finished.extend)
+
+        self.assertEqual(sorted(finished), list(range(30)))
+
+    def test_rampup(self):
+        backend = SimulatedBackend(latency = 1000)
+        backend.run(range(10), StaticPolicy(10), rampup_delay = 15)
+
+        # Launches are delayed by 15, 12, 9, 7, 5, 4, 3, 2, 1 seconds, like heaviside's fanout
+        launches = [e['end'] - 1000 for e in backend.executions.values()]
+        self.assertEqual(launches, [0, 15, 27, 36, 43, 48, 52, 55, 57, 58])
+
+    def test_failure_cancels_running(self):
+        backend = SimulatedBackend(fail = 3)
+        with self.assertRaises(Exception):
+            backend.run(range(20), StaticPolicy(10))
+
+        self.assertEqual(sorted(backend.cancelled), list(range(4, 10)))
+
+    def test_increases_without_throttling(self):
+        backend = SimulatedBackend(capacity = 1000)
+
+        backend.run(range(2000), AIMDPolicy(initial = 10, maximum = 200))
+
+        self.assertGreater(backend.max_running, 100)
+
+    def test_backs_off_when_throttled(self):
+        backend = SimulatedBackend(capacity = 1000, throttle_limit = 30)
+
+        results = backend.run(range(2000), AIMDPolicy(initial = 10, maximum = 200))
+
+        self.assertEqual(len(results), 2000)
+        # Concurrency stays near the throttle limit instead of the maximum
+        later = backend.concurrency[len(backend.concurrency) // 2:]
+        self.assertLess(sum(later) / len(later), 45)
+
+    def test_backs_off_when_latency_increases(self):
+        backend = SimulatedBackend(capacity = 40)
+
+        backend.run(range(2000), AIMDPolicy(initial = 10, maximum = 200))
+
+        later = backend.concurrency[len(backend.concurrency) // 2:]
+        self.assertLess(sum(later) / len(later), 100)
+
+class TestPolicies(unittest.TestCase):
+    def stats(self, **kwargs):
+        values = dict(running = 10, pending = 100, completed = 5, latency = 10.0, baseline_latency = 10.0,
+                      rate = 1.0, throttles = 0)
+        values.update(kwargs)
+        return FanoutStats(**values)
+
+    def test_aimd(self):
+        policy = AIMDPolicy(initial = 10, minimum = 2, maximum = 20, increase = 5, decrease = 0.5)
+
+        self.assertEqual(policy.update(10, self.stats()), 15)
+        self.assertEqual(policy.update(20, self.stats()), 20)
+        self.assertEqual(policy.update(10, self.stats(throttles = 1)), 5)
+        self.assertEqual(policy.update(3, self.stats(throttles = 1)), 2)
+        self.assertEqual(policy.update(10, self.stats(latency = 30.0)), 5)
+        self.assertEqual(policy.update(10, self.stats(pending = 0)), 10)
+
+    def test_create_policy(self):
+        policy = create_policy({'name': 'aimd', 'maximum': 500})
+        self.assertIsInstance(policy, AIMDPolicy)
+        self.assertEqual(policy.maximum, 500)
+
+        self.assertEqual(create_policy('static').initial, 50)
+
+        with self.assertRaises(ValueError):
+            create_policy('unknown')
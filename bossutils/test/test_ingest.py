@@ -0,0 +1,237 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.ingest import TileSlab, write_cuboids
+from bossutils.compression import Compressor
+from bossutils.metrics import StageMetrics
+
+from io import BytesIO
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import numpy as np
+import unittest
+from unittest.mock import patch, MagicMock
+
+CUBOID_SIZE = [64, 64, 16]
+
+class MemoryTileBucket(object):
+    """Stand-in for the ndingest TileBucket"""
+    def __init__(self, tiles):
+        self.tiles = tiles
+
+    def getObjectByKey(self, tile_key):
+        return self.tiles[tile_key], None, None, None
+
+def encode(tile):
+    data = BytesIO()
+    Image.fromarray(tile).save(data, 'PNG')
+    return data.getvalue()
+
+class TestTileSlab(unittest.TestCase):
+    def make_slab(self, shape, max_workers=2, memory_limit=None, encoded_size=1000):
+        """A slab that wasn't able to decode a chunk of the given shape"""
+        keys = ['tile{}'.format(z) for z in range(shape[0])]
+        slab = TileSlab(keys, 'uint8', StageMetrics('test'), None, max_workers, memory_limit)
+        slab.shape = shape
+        slab.encoded = [b'x' * encoded_size for key in keys]
+        return slab
+
+    def assertCovers(self, windows, shape):
+        """Assert that the windows tile the chunk without overlapping"""
+        covered = np.zeros(shape[1:], dtype=int)
+        for y_start, y_stop, x_start, x_stop in windows:
+            covered[y_start:y_stop, x_start:x_stop] += 1
+        self.assertTrue((covered == 1).all())
+
+    def test_windows_columns(self):
+        """Test that windows are as many cuboid columns as fit after the encoded and decoding tiles"""
+        shape = (16, 256, 200)
+        slab = self.make_slab(shape, memory_limit = 1)
+
+        # 1 MB - 2 threads * 2 copies * 256 * 200 - 16 * 1000 encoded = 3 columns of 16 * 256 * 64
+        windows = slab.windows(CUBOID_SIZE)
+        self.assertEqual(windows, [(0, 256, 0, 192), (0, 256, 192, 200)])
+        self.assertCovers(windows, shape)
+
+        # The same memory used by other buffers leaves room for 2 columns
+        slab.reserved = 16 * 256 * 64
+        windows = slab.windows(CUBOID_SIZE)
+        self.assertEqual(windows, [(0, 256, 0, 128), (0, 256, 128, 200)])
+
+    def test_windows_rows(self):
+        """Test that a column that doesn't fit is split into bands of cuboids along Y"""
+        shape = (16, 1024, 200)
+        slab = self.make_slab(shape, memory_limit = 1)
+
+        # 1 MB - 2 threads * 2 copies * 1024 * 200 - 16 * 1000 encoded = 3 cuboids of 16 * 64 * 64
+        windows = slab.windows(CUBOID_SIZE)
+        self.assertEqual(len(windows), 4 * 6)
+        self.assertEqual(windows[0], (0, 192, 0, 64))
+        self.assertEqual(windows[-1], (960, 1024, 192, 200))
+        self.assertCovers(windows, shape)
+
+    def test_windows_minimum(self):
+        """Test that a window is never smaller than a cuboid"""
+        shape = (16, 100, 100)
+        slab = self.make_slab(shape, memory_limit = 1, encoded_size = 2**20)
+
+        windows = slab.windows(CUBOID_SIZE)
+        self.assertEqual(windows, [(0, 64, 0, 64), (64, 100, 0, 64), (0, 64, 64, 100), (64, 100, 64, 100)])
+
+    def test_windows_decoded(self):
+        slab = self.make_slab((16, 256, 200))
+        slab.data = np.zeros(slab.shape, dtype=np.uint8)
+        self.assertEqual(slab.windows(CUBOID_SIZE), [(0, 256, 0, 200)])
+
+    def fetch(self, memory_limit):
+        rng = np.random.RandomState(0)
+        chunk = rng.randint(0, 256, size=(4, 150, 130)).astype(np.uint8)
+        tiles = {'tile{}'.format(z): encode(chunk[z]) for z in range(chunk.shape[0])}
+
+        slab = TileSlab(sorted(tiles), 'uint8', StageMetrics('test'),
+                        lambda: MemoryTileBucket(tiles), 2, memory_limit)
+        slab.fetch()
+        return chunk, slab
+
+    def test_fetch_decoded(self):
+        chunk, slab = self.fetch(None)
+
+        self.assertIsNone(slab.encoded)
+        self.assertEqual(slab.shape, chunk.shape)
+        np.testing.assert_array_equal(slab.window(0, 150, 0, 130), chunk)
+
+    def test_fetch_windows(self):
+        """Test that decoding the windows of a chunk that didn't fit gives the same data"""
+        # 2 threads * 2 copies of the tiles and the decoded chunk don't fit
+        chunk, slab = self.fetch(0.1)
+
+        self.assertIsNone(slab.data)
+        windows = slab.windows(CUBOID_SIZE)
+        self.assertGreater(len(windows), 1)
+        for y_start, y_stop, x_start, x_stop in windows:
+            np.testing.assert_array_equal(slab.window(y_start, y_stop, x_start, x_stop),
+                                          chunk[:, y_start:y_stop, x_start:x_stop])
+
+    def test_missing_tile(self):
+        slab = TileSlab(['tile0'], 'uint8', StageMetrics('test'), lambda: MemoryTileBucket({}))
+        with self.assertRaises(KeyError):
+            slab.fetch()
+
+class MemoryObjectIO(object):
+    """Stand-in for SpatialDB.objectio, that checks the number of cuboids held"""
+    def __init__(self, held):
+        self.held = held
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def put_objects(self, keys, data):
+        time.sleep(0.001)
+        with self.lock:
+            self.objects.update(zip(keys, data))
+            self.held[0] -= len(keys)
+
+class MemoryS3Index(object):
+    """Stand-in for the S3 Index table, for both spdb and the DynamoDB client"""
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        for request in requests:
+            self.put_item(request['PutRequest']['Item'])
+        return {'UnprocessedItems': {}}
+
+    def put_item(self, item):
+        with self.lock:
+            self.items[item['object-key']['S']] = item # Replaces the whole item
+
+    def add_cuboid_to_index(self, object_key, ingest_job=0):
+        self.put_item({'object-key': {'S': object_key}, 'version-node': {'N': '0'}})
+
+    def update_id_indices(self, resource, resolution, keys, cubes):
+        # Like spdb, ADDs the cuboid's IDs to its existing S3 Index entry
+        for key, cube in zip(keys, cubes):
+            with self.lock:
+                item = self.items[key]
+                ids = set(item.get('id-set', {}).get('NS', []))
+                item['id-set'] = {'NS': sorted(ids | set(str(id) for id in np.unique(cube) if id != 0))}
+
+class TestWriteCuboids(unittest.TestCase):
+    @patch('bossutils.ingest.boto3')
+    def test_bounded(self, boto3):
+        """Test that only max_in_flight cuboids are held at once and every cuboid is indexed"""
+        held = [0]
+        peak = [0]
+        objectio = MemoryObjectIO(held)
+        sp = MagicMock(objectio = objectio)
+        resource = MagicMock(data = {'channel': {'type': 'image'}})
+        boto3.client.return_value.batch_write_item.return_value = {'UnprocessedItems': {}}
+
+        keys = ['hash&1&2&3&0&0&{}'.format(i) for i in range(20)]
+        def cuboids():
+            for key in keys:
+                with objectio.lock:
+                    held[0] += 1
+                    peak[0] = max(peak[0], held[0])
+                yield key, MagicMock(data = np.zeros((1, 16, 64, 64), dtype=np.uint8))
+
+        with ThreadPoolExecutor(max_workers = 4) as executor, Compressor(max_workers = 2) as compressor:
+            errors = write_cuboids(sp, resource, 0, cuboids(), 7, 's3index', executor,
+                                   compressor, StageMetrics('test'), max_in_flight = 3)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(objectio.objects), sorted(keys))
+        self.assertLessEqual(peak[0], 3 + 1) # in flight and the one being assembled
+
+        items = [request['PutRequest']['Item']['object-key']['S']
+                 for call in boto3.client.return_value.batch_write_item.call_args_list
+                 for request in call[1]['RequestItems']['s3index']]
+        self.assertEqual(items, keys)
+
+    def write(self, channel_type, keys, index, objectio):
+        objectio.add_cuboid_to_index = index.add_cuboid_to_index
+        objectio.update_id_indices = index.update_id_indices
+        sp = MagicMock(objectio = objectio)
+        resource = MagicMock(data = {'channel': {'type': channel_type}})
+        cuboids = [(key, MagicMock(data = np.full((1, 16, 64, 64), i + 1, dtype=np.uint64)))
+                   for i, key in enumerate(keys)]
+
+        with patch('bossutils.ingest.boto3') as boto3, \
+             ThreadPoolExecutor(max_workers = 4) as executor, Compressor(max_workers = 2) as compressor:
+            boto3.client.return_value = index
+            errors = write_cuboids(sp, resource, 0, cuboids, 7, 's3index', executor,
+                                   compressor, StageMetrics('test'), max_in_flight = 3)
+        self.assertEqual(errors, [])
+
+    def test_annotation_id_sets(self):
+        """Test that indexing annotation cuboids doesn't replace the id-sets of their S3 Index entries"""
+        index = MemoryS3Index()
+        keys = ['hash&1&2&3&0&0&{}'.format(i) for i in range(10)]
+        self.write('annotation', keys, index, MemoryObjectIO([0]))
+
+        self.assertEqual(sorted(index.items), sorted(keys))
+        for i, key in enumerate(keys):
+            self.assertEqual(index.items[key]['id-set'], {'NS': [str(i + 1)]})
+
+    def test_invalid_key(self):
+        """Test that an object key that can't be indexed fails before the cuboid is uploaded"""
+        index = MemoryS3Index()
+        objectio = MemoryObjectIO([0])
+        with self.assertRaises(ValueError):
+            self.write('image', ['hash&ISO&1&2&3&0&0&2'], index, objectio)
+        self.assertEqual(objectio.objects, {})
+        self.assertEqual(index.items, {})
@@ -0,0 +1,51 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.metrics import StageMetrics, SAMPLE_SIZE
+
+import io
+import json
+import unittest
+
+class TestStageMetrics(unittest.TestCase):
+    def test_record(self):
+        now = [0.0]
+        metrics = StageMetrics('ingest', clock = lambda: now[0])
+
+        for i in range(1, SAMPLE_SIZE * 4 + 1):
+            with metrics.time('fetch'):
+                now[0] += i / 1000
+        metrics.add('compress', 2.5, count = 16)
+        metrics.count('cuboids', 16)
+
+        record = metrics.record(chunk_key = 'key')
+        fetch = record['stages']['fetch']
+
+        self.assertEqual(fetch['count'], SAMPLE_SIZE * 4)
+        self.assertAlmostEqual(fetch['max'], SAMPLE_SIZE * 4 / 1000)
+        self.assertLessEqual(fetch['p50'], fetch['p90'])
+        self.assertEqual(record['stages']['compress']['count'], 16)
+        self.assertEqual(record['counters'], {'cuboids': 16})
+        self.assertEqual(record['chunk_key'], 'key')
+        self.assertAlmostEqual(record['wall'], now[0])
+
+    def test_emit_sampled(self):
+        out = io.StringIO()
+
+        self.assertFalse(StageMetrics('flush', sample_rate = 0.0).emit(out))
+        self.assertTrue(StageMetrics('flush', sample_rate = 1.0).emit(out))
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['metrics'], 'flush')
@@ -0,0 +1,70 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bossutils.multidimensional import XYZ, morton_encode, morton_decode, morton_range, range_blocks
+from bossutils.multidimensional import range as xyz_range
+
+import numpy as np
+import unittest
+
+class TestMorton(unittest.TestCase):
+    def setUp(self):
+        self.coords = np.array([[0, 0, 0],
+                                [1, 2, 3],
+                                [511, 1024, 17],
+                                [2 ** 21 - 1, 5, 2 ** 20]], dtype=np.uint64)
+
+    def test_encode(self):
+        """Test that the vectorized encode matches ndlib"""
+        expected = [XYZ(*[int(v) for v in c]).morton for c in self.coords]
+
+        actual = morton_encode(self.coords)
+
+        self.assertEqual(actual.dtype, np.uint64)
+        self.assertEqual([int(m) for m in actual], expected)
+
+    def test_decode(self):
+        actual = morton_decode(morton_encode(self.coords))
+
+        np.testing.assert_array_equal(actual, self.coords)
+
+class TestRanges(unittest.TestCase):
+    def test_range_blocks(self):
+        """Test that the blocks contain the range in the same order"""
+        start, stop, step = XYZ(1, 2, 3), XYZ(9, 7, 8), XYZ(2, 1, 2)
+        expected = [tuple(v) for v in xyz_range(start, stop, step = step)]
+
+        actual = [tuple(v) for block in range_blocks(start, stop, step = step, block_size = 7)
+                           for v in block]
+
+        self.assertEqual(actual, expected)
+
+    def test_morton_range(self):
+        start, stop, step = XYZ(2, 0, 1), XYZ(11, 9, 6), XYZ(2, 2, 1)
+        expected = sorted(xyz_range(start, stop, step = step), key = lambda v: (v // step).morton)
+
+        actual = list(morton_range(start, stop, step = step))
+
+        self.assertEqual(actual, expected)
+
+    def test_morton_range_cursor(self):
+        start, stop, step = XYZ(0, 0, 0), XYZ(8, 8, 4), XYZ(2, 2, 2)
+        cursor = XYZ(2, 1, 1).morton
+
+        actual = list(morton_range(start, stop, step = step, cursor = cursor))
+
+        self.assertEqual(actual[0], XYZ(4, 2, 2))
+        self.assertTrue(all((v // step).morton >= cursor for v in actual))
+        self.assertEqual(len(actual), len([v for v in xyz_range(start, stop, step = step)
+                                             if (v // step).morton >= cursor]))
@@ -1,16 +1,24 @@
 import sys
 import json
+import time
+import random
 import logging
+import queue
 import blosc
 import boto3
+import botocore
 import hashlib
 import numpy as np
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from spdb.c_lib.ndtype import CUBOIDSIZE
 from spdb.c_lib import ndlib
 
 from bossutils.multidimensional import XYZ, Buffer
 from bossutils.multidimensional import range as xyz_range
+from bossutils.downsample import block_reduce, ANNOTATION_REDUCERS, BUFFERS
+from bossutils.compression import shared_compressor
+from bossutils import keys
 
 handler = logging.StreamHandler()
 handler.setLevel(logging.DEBUG)
@@ -19,6 +27,9 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 log.addHandler(handler)
 
+# Decompress and compress cubes on multiple threads at once (see bossutils.compression)
+blosc.set_releasegil(True)
+
 
 np_types = {
     'uint64': np.uint64,
@@ -26,6 +37,29 @@ np_types = {
     'uint8': np.uint8,
 }
 
+# int: Maximum number of threads used to concurrently download and decompress
+#      the cubes that make up the volume being downsampled
+MAX_FETCH_THREADS = 8
+
+# int: Maximum number of threads used to concurrently update the ID Index
+#      with the annotation IDs of a downsampled cube
+MAX_INDEX_THREADS = 16
+
+# int: Number of times a throttled DynamoDB request is retried
+THROTTLE_RETRIES = 6
+
+# float - seconds: The initial delay before retrying a throttled DynamoDB
+#                  request. Doubled for each retry and randomly jittered
+THROTTLE_DELAY = 0.1
+
+# DynamoDB error codes that mean the request was throttled
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException',
+                   'ThrottlingException',
+                   'RequestLimitExceeded')
+
+# XYZ: Step of the anisotropic downsample generated by a fused downsample
+ANISOTROPIC_STEP = XYZ(2, 2, 1)
+
 #### Helper functions and classes ####
 
 def HashedKey(*args, version = None):
@@ -52,6 +86,31 @@ def HashedKey(*args, version = None):
         key = '{}&{}'.format(key, version)
     return key
 
+def key_context(args, resolution, iso):
+    """Get the cached bossutils.keys.KeyContext for the args' channel at the given resolution
+
+    Args:
+        args (dict) : See downsample_volume
+        resolution (int) : Resolution of the cubes
+        iso (str|None) : 'ISO' if the keys should include the ISO flag
+
+    Returns:
+        KeyContext
+    """
+    return keys.key_context(args['collection_id'], args['experiment_id'], args['channel_id'],
+                            resolution, iso, args['data_type'], tuple(CUBOIDSIZE[resolution]))
+
+def cube_compressor(args):
+    """Get the shared bossutils.compression.Compressor for the args' compression settings
+
+    Args:
+        args (dict) : See downsample_volume
+
+    Returns:
+        Compressor
+    """
+    return shared_compressor(args.get('compression'), args.get('compression_threads'))
+
 class S3Bucket(object):
     """Wrapper for calls to S3
 
@@ -131,6 +190,19 @@ class DynamoDBTable(object):
         if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise Exception("Error {} index information to/from/in DynamoDB".format(action))
 
+    def _retry(self, method, **kwargs):
+        """Call the DynamoDB method, retrying with backoff if throttled"""
+        delay = THROTTLE_DELAY
+        for retry in range(THROTTLE_RETRIES + 1):
+            try:
+                return method(**kwargs)
+            except botocore.exceptions.ClientError as ex:
+                if ex.response['Error']['Code'] not in THROTTLE_ERRORS or retry == THROTTLE_RETRIES:
+                    raise
+
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+
     def put(self, item):
         try:
             self.ddb.put_item(TableName = self.table,
@@ -141,25 +213,46 @@ class DynamoDBTable(object):
             raise Exception("Error adding item to DynamoDB Table")
 
     def update_ids(self, key, ids):
-        resp = self.ddb.update_item(TableName = self.table,
-                                    Key = key,
-                                    UpdateExpression='ADD #idset :ids',
-                                    ExpressionAttributeNames={'#idset': 'id-set'},
-                                    ExpressionAttributeValues={':ids': {'NS': ids}},
-                                    ReturnConsumedCapacity='NONE')
+        resp = self._retry(self.ddb.update_item,
+                           TableName = self.table,
+                           Key = key,
+                           UpdateExpression='ADD #idset :ids',
+                           ExpressionAttributeNames={'#idset': 'id-set'},
+                           ExpressionAttributeValues={':ids': {'NS': ids}},
+                           ReturnConsumedCapacity='NONE')
 
         self._check_error(resp, 'updating')
 
     def update_id(self, key, obj_key):
-        resp = self.ddb.update_item(TableName = self.table,
-                                    Key = key,
-                                    UpdateExpression='ADD #cuboidset :objkey',
-                                    ExpressionAttributeNames={'#cuboidset': 'cuboid-set'},
-                                    ExpressionAttributeValues={':objkey': {'SS': [obj_key]}},
-                                    ReturnConsumedCapacity='NONE')
+        resp = self._retry(self.ddb.update_item,
+                           TableName = self.table,
+                           Key = key,
+                           UpdateExpression='ADD #cuboidset :objkey',
+                           ExpressionAttributeNames={'#cuboidset': 'cuboid-set'},
+                           ExpressionAttributeValues={':objkey': {'SS': [obj_key]}},
+                           ReturnConsumedCapacity='NONE')
+
+        self._check_error(resp, 'updating')
+
+    def update_digest(self, key, digest):
+        resp = self._retry(self.ddb.update_item,
+                           TableName = self.table,
+                           Key = key,
+                           UpdateExpression='SET #digest = :digest',
+                           ExpressionAttributeNames={'#digest': 'content-digest'},
+                           ExpressionAttributeValues={':digest': {'S': digest}},
+                           ReturnConsumedCapacity='NONE')
 
         self._check_error(resp, 'updating')
 
+    def get(self, key):
+        resp = self.ddb.get_item(TableName = self.table,
+                                 Key = key,
+                                 ConsistentRead=True,
+                                 ReturnConsumedCapacity='NONE')
+
+        return resp.get('Item')
+
     def exists(self, key):
         resp = self.ddb.get_item(TableName = self.table,
                                  Key = key,
@@ -171,12 +264,28 @@ class DynamoDBTable(object):
 
 #### Main lambda logic ####
 
-def downsample_volume(args, target, step, dim, use_iso_key, index_annotations):
+def downsample_volume(args, target, step, dim, use_iso_key, index_annotations, levels=1, fuse_anisotropic=False):
     """Downsample a volume into a single cube
 
     Download `step` cubes from S3, downsample them into a single cube, upload
     to S3 and update the S3 index for the new cube.
 
+    If `levels` is greater than one, `step ** levels` cubes are downloaded and
+    downsampled `levels` times in memory. Every cube of every intermediate
+    resolution is uploaded and indexed, so a single invocation generates
+    resolution + 1 through resolution + levels without reading the
+    intermediate resolutions back from S3.
+
+    If `fuse_anisotropic` is set, the 2x2x2 volume loaded for the isotropic
+    downsample is also downsampled by ANISOTROPIC_STEP into the two
+    anisotropic cubes it covers, so both are generated from a single read of
+    the source cubes. Only valid at iso_resolution, where the anisotropic and
+    isotropic downsamples have the same (non-ISO) source data.
+
+    Note: Image data is resized across the whole in memory volume, so voxels on
+          the edges of the intermediate cubes can differ slightly from data
+          generated one resolution at a time.
+
     Args:
         args {
             collection_id (int)
@@ -190,21 +299,61 @@ def downsample_volume(args, target, step, dim, use_iso_key, index_annotations):
             id_index (URL)
 
             resolution (int) The resolution to downsample. Creates resolution + 1
+            annotation_index_max (int) The maximum resolution to index annotation channel cubes at
+                                       Only used when levels > 1
 
             type (str) 'isotropic' | 'anisotropic'
             iso_resolution (int) if resolution >= iso_resolution && type == 'anisotropic' downsample both
+
+            fetch_threads (optional[int]) Number of concurrent cube downloads (default MAX_FETCH_THREADS)
+            skip_unchanged (optional[bool]) Record a digest of each downsampled cube in the S3 Index and
+                                            skip the upload and index updates if the cube is unchanged
+            downsample_method (optional[str]) Downsample method, a bossutils.downsample.REDUCERS name
+                                              ('nearest', 'mean', 'area', 'max', 'min', 'mode')
+                                              Annotation channels only support ANNOTATION_REDUCERS
+                                              (default is a per slice bilinear resize for images and
+                                               ndlib.addAnnotationData_ctype for annotations)
+            memory_limit (optional[int]) MB of volume buffers an annotation downsample can use. If the whole
+                                         volume doesn't fit it is streamed through in slabs (see stream_volume)
+            slab_axis (optional[str]) 'z' | 'y' The axis annotation volumes are split into slabs along
+                                      (default 'z')
+            compression (optional[dict]) Blosc settings per data type, see bossutils.compression.codec_settings
+            compression_threads (optional[int]) Number of threads compressing cubes (default the number of CPUs)
         }
 
         target (XYZ) : Corner of volume to downsample
         step (XYZ) : Extent of the volume to downsample
         dim (XYZ) : Dimensions of a single cube
         use_iso_key (boolean) : If the BOSS keys should include an 'ISO=' flag
+        index_annotations (boolean) : If resolution + 1 annotation cubes should be indexed
+        levels (int) : Number of resolutions to generate
+        fuse_anisotropic (boolean) : If the anisotropic cubes should also be generated
     """
-    log.debug("Downsampling {}".format(target))
-    # Hard coded values
-    version = 0
-    t = 0
-    dim_t = 1
+    downsample_volumes(args, [target], step, dim, use_iso_key, index_annotations, levels, fuse_anisotropic)
+
+def downsample_volumes(args, targets, step, dim, use_iso_key, index_annotations, levels=1, fuse_anisotropic=False):
+    """Downsample multiple volumes, sharing resources between them
+
+    The AWS clients, download threads, and volume buffers are created once and
+    reused for every target. The cubes for the next target are downloaded
+    while the current target is downsampled and uploaded.
+
+    Args:
+        args (dict) : See downsample_volume
+        targets (list[XYZ]) : Corners of the volumes to downsample
+        step (XYZ) : Extent of the volume to downsample
+        dim (XYZ) : Dimensions of a single cube
+        use_iso_key (boolean) : If the BOSS keys should include an 'ISO=' flag
+        index_annotations (boolean) : If resolution + 1 annotation cubes should be indexed
+        levels (int) : Number of resolutions to generate
+        fuse_anisotropic (boolean) : If the anisotropic cubes should also be generated
+    """
+    if len(targets) == 0:
+        return
+
+    if fuse_anisotropic:
+        if not use_iso_key or levels != 1 or step != XYZ(2, 2, 2) or args['resolution'] != args['iso_resolution']:
+            raise ValueError("Only the first isotropic downsample can be fused with the anisotropic downsample")
 
     iso = 'ISO' if use_iso_key else None
 
@@ -212,81 +361,304 @@ def downsample_volume(args, target, step, dim, use_iso_key, index_annotations):
     # isotropic downsample needs to use the anisotropic data. Future isotropic
     # downsamples will use the previous isotropic data.
     parent_iso = None if args['resolution'] == args['iso_resolution'] else iso
+    source = key_context(args, args['resolution'], parent_iso)
 
-    col_id = args['collection_id']
-    exp_id = args['experiment_id']
-    chan_id = args['channel_id']
-    data_type = args['data_type']
-    annotation_chan = args['annotation_channel']
-
-    resolution = args['resolution']
+    method = args.get('downsample_method')
+    if args['annotation_channel'] and method is not None and method not in ANNOTATION_REDUCERS:
+        raise ValueError("Downsample method '{}' is not valid for annotation channels".format(method))
 
     s3 = S3Bucket(args['s3_bucket'])
     s3_index = DynamoDBTable(args['s3_index'])
     id_index = DynamoDBTable(args['id_index'])
 
-    # Download all of the cubes that will be downsamples
-    volume = Buffer.zeros(dim * step, dtype=np_types[data_type], order='C')
+    # The number of source cubes downsampled into a single cube when generating levels
+    block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+
+    num_threads = min(args.get('fetch_threads', MAX_FETCH_THREADS), block.x * block.y * block.z)
+    index_threads = MAX_INDEX_THREADS if args['annotation_channel'] and index_annotations else 1
+
+    if args['annotation_channel'] and args.get('memory_limit') is not None:
+        dtype = source.dtype
+        volume_bytes = int(np.prod((dim * block).zyx)) * dtype.itemsize
+        cube_bytes = int(np.prod(dim.zyx)) * dtype.itemsize
+        required = min(len(targets), 2) * volume_bytes + num_threads * cube_bytes + \
+                   level_bytes(args['resolution'], step, levels, block, dtype)
+
+        if required > args['memory_limit'] * 2**20:
+            log.debug("Volume needs {} MB, streaming in slabs".format(required // 2**20))
+            with ThreadPoolExecutor(max_workers = num_threads) as fetch_executor, \
+                 ThreadPoolExecutor(max_workers = index_threads) as index_executor:
+                for target in targets:
+                    stream_volume(args, target, step, dim, levels, source, iso, index_annotations,
+                                  s3, s3_index, id_index, fetch_executor, index_executor)
+
+                    # Streaming doesn't keep the volume, so the anisotropic cubes are streamed separately
+                    if fuse_anisotropic:
+                        for z in range(step.z):
+                            stream_volume(args, target + XYZ(0, 0, z), ANISOTROPIC_STEP, dim, 1, source, None,
+                                          index_annotations, s3, s3_index, id_index, fetch_executor,
+                                          index_executor)
+            return
+
+    # Two volumes, so that one can be filled while the other is downsampled
+    # The buffers are pooled, so they may contain data from a previous invocation
+    volumes, reused = [], []
+    for i in range(min(len(targets), 2)):
+        volume, new = source.buffer('volume-{}'.format(i), block)
+        volumes.append(volume.view(Buffer))
+        reused.append(not new)
+
+    # One cube sized buffer per download thread, that the cube is decompressed
+    # into before being copied into the volume
+    scratch = queue.Queue()
+    for i in range(num_threads):
+        scratch.put(source.buffer('scratch-{}'.format(i))[0])
+    with ThreadPoolExecutor(max_workers = num_threads) as fetch_executor, \
+         ThreadPoolExecutor(max_workers = 1) as load_executor, \
+         ThreadPoolExecutor(max_workers = index_threads) as index_executor:
+
+        def load(i):
+            return load_volume(args, targets[i], dim, block, source, s3, fetch_executor, scratch,
+                               volumes[i % 2], reused = i >= 2 or reused[i % 2])
+
+        future = load_executor.submit(load, 0)
+        for i, target in enumerate(targets):
+            exists = future.result()
+            if i + 1 < len(targets):
+                future = load_executor.submit(load, i + 1)
+
+            log.debug("Downsampling {}".format(target))
+            if not exists.any(): # abort if the volume doesn't exist in S3
+                log.debug("Completely empty volume, not downsampling")
+                continue
+
+            volume = volumes[i % 2]
+            downsample_levels(args, target, step, levels, volume, exists, iso, index_annotations,
+                              s3, s3_index, id_index, index_executor)
+
+            if fuse_anisotropic:
+                # downsample_levels changes the volume's attributes, not its data
+                volume.dim = dim
+                volume.cubes = block
+                downsample_levels(args, target, ANISOTROPIC_STEP, 1, volume, exists, None, index_annotations,
+                                  s3, s3_index, id_index, index_executor, name = 'anisotropic')
+
+def load_volume(args, target, dim, block, source, s3, executor, scratch, volume, reused = False):
+    """Download all of the cubes that will be downsampled into the volume
+
+    The cubes are fetched and decompressed concurrently. Each download thread
+    decompresses directly into a scratch buffer, which is then copied into the
+    volume, so each cube is only copied once.
+
+    Args:
+        args (dict) : See downsample_volume
+        target (XYZ) : Corner of volume to downsample
+        dim (XYZ) : Dimensions of a single cube
+        block (XYZ) : Number of cubes in the volume
+        source (KeyContext) : Keys of the source cubes
+        s3 (S3Bucket) : Bucket containing the cubes
+        executor (ThreadPoolExecutor) : Threads to download the cubes with
+        scratch (queue.Queue) : Cube sized buffers, one per download thread
+        volume (Buffer) : Buffer of dim * block to fill
+        reused (boolean) : If the volume contains data from a previous target
+
+    Returns:
+        np.array : Boolean array (ZYX) of which cubes contain data
+    """
     volume.dim = dim
-    volume.cubes = step
+    volume.cubes = block
+
+    # Which cubes contain data, used to skip uploading empty output cubes
+    exists = np.zeros(block.zyx, dtype=bool)
 
-    volume_empty = True # abort if the volume doesn't exist in S3
-    for offset in xyz_range(step):
-        cube = target + offset
+    offsets = list(xyz_range(block))
+    keys = source.cube_keys([(target + offset).morton for offset in offsets], version = 0)
+
+    def fetch(offset, obj_key):
+        buf = scratch.get()
         try:
-            obj_key = HashedKey(parent_iso, col_id, exp_id, chan_id, resolution, t, cube.morton, version=version)
-            data = s3.get(obj_key)
-            data = blosc.decompress(data)
+            if fetch_cube(s3, obj_key, buf):
+                #log.debug("Downloaded cube {}".format(cube))
+                volume[offset * dim: (offset + 1) * dim] = buf
+                return offset, True
+        finally:
+            scratch.put(buf)
 
-            # DP ???: Check to see if the buffer is all zeros?
-            data = Buffer.frombuffer(data, dtype=np_types[data_type])
-            data.resize(dim)
+        # If the cube doesn't exist blank data will be used for downsampling
+        # If all the cubes don't exist, then the downsample is finished
+        if reused:
+            volume[offset * dim: (offset + 1) * dim] = 0
+        return offset, False
 
-            #log.debug("Downloaded cube {}".format(cube))
-            volume[offset * dim: (offset + 1) * dim] = data
-            volume_empty = False
-        except Exception as e: # TODO: Create custom exception for S3 download
-            #log.exception("Problem downloading cubes {}".format(cube))
-            #log.debug("No cube at {}".format(cube))
+    futures = [executor.submit(fetch, offset, key) for offset, key in zip(offsets, keys)]
+    for future in as_completed(futures):
+        offset, found = future.result()
+        exists[offset.zyx] = found
 
-            # Eat the error, we don't care if the cube doesn't exist
-            # If the cube doesn't exist blank data will be used for downsampling
-            # If all the cubes don't exist, then the downsample is finished
-            pass
+    return exists
 
-    if volume_empty:
-        log.debug("Completely empty volume, not downsampling")
-        return
+def downsample_levels(args, target, step, levels, volume, exists, iso, index_annotations, s3, s3_index, id_index,
+                      executor = None, name = 'cube'):
+    """Downsample a loaded volume, uploading the cubes for each level
+
+    The volume can contain more than step ** levels cubes, in which case each
+    level contains multiple output cubes.
+
+    Args:
+        args (dict) : See downsample_volume
+        target (XYZ) : Corner of volume to downsample
+        step (XYZ) : Extent of the volume to downsample for a single level
+        levels (int) : Number of resolutions to generate
+        volume (Buffer) : The loaded volume
+        exists (np.array) : Which cubes in the volume contain data
+        iso (str|None) : 'ISO' if the BOSS keys should include the ISO flag
+        index_annotations (boolean) : If resolution + 1 annotation cubes should be indexed
+        s3 (S3Bucket) : Bucket to upload the cubes to
+        s3_index (DynamoDBTable) : S3 Index table
+        id_index (DynamoDBTable) : ID Index table
+        executor (optional[ThreadPoolExecutor]) : Threads to update the ID Index with
+        name (str) : Prefix of the pooled output buffers, so different shaped outputs don't share buffers
+    """
+    resolution = args['resolution']
+    block = volume.cubes
+    scale = XYZ(1, 1, 1)
+
+    for level in range(1, levels + 1):
+        scale = scale * step
+
+        # Create downsampled cubes
+        output = key_context(args, resolution + level, iso)
+        new_dim = output.dim
+        cubes = block // scale
+        cube, new = output.buffer('{}-{}'.format(name, level), cubes)
+        cube = cube.view(Buffer)
+        if not new:
+            cube.fill(0)
+        cube.dim = new_dim * cubes
+        cube.cubes = cubes
+
+        volume.dim = cube.dim
+        volume.cubes = step
+        downsample_cube(volume, cube, args['annotation_channel'], args.get('downsample_method'))
+
+        # An output cube exists if any of its source cubes existed
+        exists = exists.reshape(cubes.z, step.z, cubes.y, step.y, cubes.x, step.x).any(axis=(1, 3, 5))
+
+        save_level(args, target, scale, level, cube, exists, iso, index_annotations, s3, s3_index, id_index,
+                   executor)
+
+        volume = cube
+
+def save_level(args, target, scale, level, cube, exists, iso, index_annotations, s3, s3_index, id_index,
+               executor = None):
+    """Upload the existing cubes of a downsampled level
+
+    The cubes are compressed concurrently, unless args['skip_unchanged'] is
+    set. Then each cube is only compressed by save_cube if it changed, one
+    at a time, so parallel compression is off.
+
+    Args:
+        args (dict) : See downsample_volume
+        target (XYZ) : Corner of volume that was downsampled
+        scale (XYZ) : Total downsample factor of the level
+        level (int) : The level, resolution + level is the resolution of the cubes
+        cube (Buffer) : The level's data, with the dim and cubes attributes set
+        exists (np.array) : Which cubes of the level contain data
+        iso (str|None) : 'ISO' if the BOSS keys should include the ISO flag
+        index_annotations (boolean) : If resolution + 1 annotation cubes should be indexed
+        s3 (S3Bucket) : Bucket to upload the cubes to
+        s3_index (DynamoDBTable) : S3 Index table
+        id_index (DynamoDBTable) : ID Index table
+        executor (optional[ThreadPoolExecutor]) : Threads to update the ID Index with
+    """
+    resolution = args['resolution']
+    new_dim = cube.dim // cube.cubes
+
+    corner = target // scale # scale down the output
+    index = index_annotations and (level == 1 or (resolution + level) < args['annotation_index_max'])
 
-    # Create downsampled cube
-    new_dim = XYZ(*CUBOIDSIZE[resolution + 1])
-    cube =  Buffer.zeros(new_dim, dtype=np_types[data_type], order='C')
-    cube.dim = new_dim
-    cube.cubes = XYZ(1,1,1)
+    # Compress all of the level's cubes concurrently, unless unchanged cubes may be skipped
+    compressor = cube_compressor(args)
+    cubes = []
+    for offset in xyz_range(cube.cubes):
+        if exists[offset.zyx]:
+            data = np.ascontiguousarray(cube[offset * new_dim: (offset + 1) * new_dim])
+            compressed = None if args.get('skip_unchanged', False) else compressor.submit(data)
+            cubes.append((offset, data, compressed))
 
-    downsample_cube(volume, cube, annotation_chan)
+    for offset, data, compressed in cubes:
+        save_cube(args, s3, s3_index, id_index, data, iso, resolution + level, corner + offset, index,
+                  executor, compressed)
 
-    target = target / step # scale down the output
+def save_cube(args, s3, s3_index, id_index, cube, iso, resolution, target, index_annotations, executor = None,
+              compressed = None):
+    """Upload a downsampled cube and update the S3 and ID indices
+
+    The unique annotation IDs of the cube are computed once. The ID Index entry
+    for each ID is a separate DynamoDB item, so the updates are issued
+    concurrently on the executor.
+
+    If args['skip_unchanged'] is set an MD5 digest of the cube data is stored
+    in the S3 Index entry, and the cube is not uploaded or indexed if the
+    digest already matches. The digest is only stored once the upload and
+    every index update succeeded, so a retry after a failure redoes them.
+
+    Args:
+        args (dict) : The downsample_volume arguments
+        s3 (S3Bucket) : Bucket to upload the cube to
+        s3_index (DynamoDBTable) : S3 Index table
+        id_index (DynamoDBTable) : ID Index table
+        cube (np.array) : Contiguous cube data
+        iso (str|None) : 'ISO' if the BOSS keys should include the ISO flag
+        resolution (int) : Resolution of the cube
+        target (XYZ) : Cube coordinate of the cube
+        index_annotations (boolean) : If the annotation IDs in the cube should be indexed
+        executor (optional[ThreadPoolExecutor]) : Threads to update the ID Index with
+        compressed (optional[Future]) : Compression of the cube already submitted to the cube_compressor
+    """
+    # Hard coded values
+    version = 0
+
+    col_id = args['collection_id']
+    exp_id = args['experiment_id']
+    chan_id = args['channel_id']
+    keys = key_context(args, resolution, iso)
+
+    # Same key scheme as the S3 object, but without the version
+    idx_obj_key = keys.cube_key(target.morton)
+    idx_key = S3IndexKey(idx_obj_key, version)
+
+    digest = None
+    if args.get('skip_unchanged', False):
+        digest = hashlib.md5(cube).hexdigest()
+        item = s3_index.get(idx_key)
+        if item is not None and item.get('content-digest', {}).get('S') == digest:
+            log.debug("Cube {} is unchanged, not uploading".format(target))
+            return
+        exists = item is not None
+    else:
+        exists = s3_index.exists(idx_key)
 
     # Save new cube in S3
-    obj_key = HashedKey(iso, col_id, exp_id, chan_id, resolution + 1, t, target.morton, version=version)
-    compressed = blosc.compress(cube, typesize=(np.dtype(cube.dtype).itemsize))
+    obj_key = keys.cube_key(target.morton, version=version)
+    if compressed is None:
+        compressed = cube_compressor(args).compress(cube)
+    else:
+        compressed = compressed.result()
     s3.put(obj_key, compressed)
 
     # Update indicies
-    # Same key scheme, but without the version
-    obj_key = HashedKey(iso, col_id, exp_id, chan_id, resolution + 1, t, target.morton)
+    obj_key = idx_obj_key
     # Create S3 Index if it doesn't exist
-    idx_key = S3IndexKey(obj_key, version)
-    if not s3_index.exists(idx_key):
+    if not exists:
         ingest_job = 0 # Valid to be 0, as posting a cutout uses 0
         idx_key = S3IndexKey(obj_key,
                              version,
                              col_id,
-                             '{}&{}&{}&{}'.format(exp_id, chan_id, resolution + 1, ingest_job))
+                             '{}&{}&{}&{}'.format(exp_id, chan_id, resolution, ingest_job))
         s3_index.put(idx_key)
 
-    if annotation_chan and index_annotations:
+    if args['annotation_channel'] and index_annotations:
         ids = ndlib.unique(cube)
 
         # Convert IDs to strings and drop any IDs that equal zero
@@ -296,14 +668,238 @@ def downsample_volume(args, target, step, dim, use_iso_key, index_annotations):
             idx_key = S3IndexKey(obj_key, version)
             s3_index.update_ids(idx_key, ids)
 
-            for id in ids:
-                idx_key = HashedKey(iso, col_id, exp_id, chan_id, resolution + 1, id)
+            def update(id):
+                idx_key = keys.id_key(id)
                 chan_key = IdIndexKey(idx_key, version)
                 id_index.update_id(chan_key, obj_key)
 
-def downsample_cube(volume, cube, is_annotation):
+            if executor is None:
+                for id in ids:
+                    update(id)
+            else:
+                # Wait for all of the updates, raising the first error
+                for future in [executor.submit(update, id) for id in ids]:
+                    future.result()
+
+    # Mark the cube as saved
+    if digest is not None:
+        s3_index.update_digest(S3IndexKey(obj_key, version), digest)
+
+def level_bytes(resolution, step, levels, block, dtype):
+    """Number of bytes needed for the output of every level"""
+    total = 0
+    scale = XYZ(1, 1, 1)
+    for level in range(1, levels + 1):
+        scale = scale * step
+        shape = XYZ(*CUBOIDSIZE[resolution + level]) * (block // scale)
+        total += int(np.prod(shape.zyx)) * dtype.itemsize
+    return total
+
+def slab_thickness(args, dim, step, levels, block, dtype, axis):
+    """Select the largest slab that keeps the buffers under args['memory_limit']
+
+    The slab is a multiple of the block size along the axis, so every level
+    of every slab is made of whole downsampled voxels.
+
+    Args:
+        args (dict) : See downsample_volume
+        dim (XYZ) : Dimensions of a single cube
+        step (XYZ) : Extent of the volume to downsample for a single level
+        levels (int) : Number of resolutions to generate
+        block (XYZ) : Number of cubes in the volume
+        dtype (np.dtype) : Data type of the volume
+        axis (int) : ZYX index of the slab axis
+
+    Returns:
+        int : Slab thickness along the axis, in voxels of the volume
+    """
+    shape = list((dim * block).zyx)
+    factor = block.zyx[axis]
+
+    # Bytes needed for each voxel of slab thickness, for the slab and each level's slab
+    per_voxel = 0
+    scale = XYZ(1, 1, 1)
+    for level in range(levels + 1):
+        per_voxel += int(np.prod(shape)) // shape[axis] // int(np.prod(scale.zyx)) * scale.zyx[axis]
+        scale = scale * step
+    per_voxel *= dtype.itemsize
+
+    available = args['memory_limit'] * 2**20 \
+                - level_bytes(args['resolution'], step, levels, block, dtype) \
+                - int(np.prod(dim.zyx)) * dtype.itemsize # decompression buffer
+
+    thickness = max(available // per_voxel, factor) // factor * factor
+    if available // per_voxel < factor:
+        log.warning("memory_limit is too small, using the smallest slab")
+    return min(thickness, shape[axis])
+
+def stream_volume(args, target, step, dim, levels, source, iso, index_annotations, s3, s3_index, id_index,
+                  fetch_executor, index_executor = None):
+    """Downsample an annotation volume in slabs, to limit the memory used
+
+    The compressed cubes are downloaded and kept in memory. The volume is then
+    split into slabs along args['slab_axis']. For each slab, the cubes that
+    overlap it are decompressed and the slab's part copied in, before the slab
+    is downsampled into each level. Cubes are decompressed once per slab they
+    overlap, trading decompression time for memory.
+
+    Args:
+        args (dict) : See downsample_volume
+        target (XYZ) : Corner of volume to downsample
+        step (XYZ) : Extent of the volume to downsample for a single level
+        dim (XYZ) : Dimensions of a single cube
+        levels (int) : Number of resolutions to generate
+        source (KeyContext) : Keys of the source cubes
+        iso (str|None) : 'ISO' if the BOSS keys should include the ISO flag
+        index_annotations (boolean) : If resolution + 1 annotation cubes should be indexed
+        s3 (S3Bucket) : Bucket containing the cubes
+        s3_index (DynamoDBTable) : S3 Index table
+        id_index (DynamoDBTable) : ID Index table
+        fetch_executor (ThreadPoolExecutor) : Threads to download the cubes with
+        index_executor (optional[ThreadPoolExecutor]) : Threads to update the ID Index with
+    """
+    resolution = args['resolution']
+    dtype = source.dtype
+    method = args.get('downsample_method')
+    block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+
+    axis_name = args.get('slab_axis', 'z')
+    if axis_name not in ('z', 'y'):
+        raise ValueError("Unsupported slab axis '{}'".format(axis_name))
+    axis = 'zyx'.index(axis_name)
+
+    cube_bytes = int(np.prod(dim.zyx)) * dtype.itemsize
+
+    offsets = list(xyz_range(block))
+    keys = source.cube_keys([(target + offset).morton for offset in offsets], version = 0)
+
+    def fetch(offset, obj_key):
+        try:
+            data = s3.get(obj_key)
+            nbytes, _, _ = blosc.get_cbuffer_sizes(data)
+            if nbytes != cube_bytes:
+                raise ValueError("Cube {} is {} bytes, expected {}".format(obj_key, nbytes, cube_bytes))
+            return offset, data
+        except Exception: # Same as fetch_cube, a missing cube is blank data
+            return offset, None
+
+    compressed = dict(future.result() for future in
+                      [fetch_executor.submit(fetch, offset, key) for offset, key in zip(offsets, keys)])
+    exists = np.zeros(block.zyx, dtype=bool)
+    for offset, data in compressed.items():
+        exists[offset.zyx] = data is not None
+
+    log.debug("Streaming {}".format(target))
+    if not exists.any():
+        log.debug("Completely empty volume, not downsampling")
+        return
+
+    # Full outputs for each level
+    scales, outputs = [], []
+    scale = XYZ(1, 1, 1)
+    for level in range(1, levels + 1):
+        scale = scale * step
+        output = key_context(args, resolution + level, iso)
+        new_dim = output.dim
+        cube, new = output.buffer('cube-{}'.format(level), block // scale)
+        cube = cube.view(Buffer)
+        if not new:
+            cube.fill(0)
+        cube.dim = new_dim * (block // scale)
+        cube.cubes = block // scale
+        scales.append(scale)
+        outputs.append(cube)
+
+    thickness = slab_thickness(args, dim, step, levels, block, dtype, axis)
+    total = (dim * block).zyx[axis]
+    buf = source.buffer('scratch-0')[0]
+
+    def with_axis(shape, value):
+        shape = list(shape)
+        shape[axis] = value
+        return tuple(shape)
+
+    for start in range(0, total, thickness):
+        stop = min(start + thickness, total)
+
+        # Fill the slab from the cubes that overlap it
+        slab, _ = BUFFERS.get('slab-0', with_axis((dim * block).zyx, stop - start), dtype)
+        slab.fill(0)
+        for offset, data in compressed.items():
+            lo = offset.zyx[axis] * dim.zyx[axis]
+            hi = lo + dim.zyx[axis]
+            if data is None or hi <= start or lo >= stop:
+                continue
+
+            blosc.decompress_ptr(data, buf.__array_interface__['data'][0])
+
+            src = [slice(None)] * 3
+            src[axis] = slice(max(start, lo) - lo, min(stop, hi) - lo)
+            dst = [slice(o * d, (o + 1) * d) for o, d in zip(offset.zyx, dim.zyx)]
+            dst[axis] = slice(max(start, lo) - start, min(stop, hi) - start)
+            slab[tuple(dst)] = buf[tuple(src)]
+
+        # Downsample the slab through each level
+        volume = slab.view(Buffer)
+        for level, (scale, output) in enumerate(zip(scales, outputs), start = 1):
+            shape = with_axis(output.shape, (stop - start) // scale.zyx[axis])
+            out, _ = BUFFERS.get('slab-{}'.format(level), shape, dtype)
+            out = out.view(Buffer)
+            out.dim = XYZ(*reversed(shape))
+            volume.dim = out.dim
+            volume.cubes = step
+            downsample_cube(volume, out, True, method)
+
+            dst = [slice(None)] * 3
+            dst[axis] = slice(start // scale.zyx[axis], stop // scale.zyx[axis])
+            np.asarray(output)[tuple(dst)] = out
+            volume = out
+
+    for level, (scale, output) in enumerate(zip(scales, outputs), start = 1):
+        cubes = output.cubes
+        exists = exists.reshape(cubes.z, step.z, cubes.y, step.y, cubes.x, step.x).any(axis=(1, 3, 5))
+        save_level(args, target, scale, level, output, exists, iso, index_annotations, s3, s3_index, id_index,
+                   index_executor)
+
+def fetch_cube(s3, obj_key, out):
+    """Download a single cube from S3 and decompress it into the given buffer
+
+    Called from multiple threads at once. The boto3 client is thread safe and
+    blosc releases the GIL while decompressing, so both the S3 round trip and
+    the decompression overlap with the other fetches.
+
+    Args:
+        s3 (S3Bucket) : Bucket containing the cube
+        obj_key (str) : HashedKey of the cube to download
+        out (np.array) : C ordered buffer of a single cube
+
+    Returns:
+        boolean : If the cube exists and was decompressed into out
+    """
+    try:
+        data = s3.get(obj_key)
+
+        # Make sure the decompressed data will fit before writing into the buffer
+        nbytes, _, _ = blosc.get_cbuffer_sizes(data)
+        if nbytes != out.nbytes:
+            raise ValueError("Cube {} is {} bytes, expected {}".format(obj_key, nbytes, out.nbytes))
+
+        # DP ???: Check to see if the buffer is all zeros?
+        blosc.decompress_ptr(data, out.__array_interface__['data'][0])
+        return True
+    except Exception: # TODO: Create custom exception for S3 download
+        # Eat the error, we don't care if the cube doesn't exist
+        #log.debug("No cube at {}".format(obj_key))
+        return False
+
+def downsample_cube(volume, cube, is_annotation, method=None):
     """Downsample the given Buffer into the target Buffer
 
+    If a method is given the data is downsampled by bossutils.downsample,
+    which reduces the whole volume at once (including Z for isotropic
+    downsamples) and supports all data types. Annotation data can use the
+    ANNOTATION_REDUCERS, such as 'mode'.
+
     Note: Both volume and cube both have the following attributes
         dim (XYZ) : The dimensions of the cubes contained in the Buffer
         cubes (XYZ) : The number of cubes of size dim contained in the Buffer
@@ -314,10 +910,13 @@ def downsample_cube(volume, cube, is_annotation):
         volume (Buffer) : Raw numpy array of input cube data
         cube (Buffer) : Raw numpy array for output data
         is_annotation (boolean) : If the downsample should be an annotation downsample
+        method (optional[str]) : Name of the bossutils.downsample reducer to use
     """
     #log.debug("downsample_cube({}, {}, {})".format(volume.shape, cube.shape, is_annotation))
 
-    if is_annotation:
+    if method is not None:
+        block_reduce(volume, volume.cubes, method, out=cube)
+    elif is_annotation:
         # Use a C implementation to downsample each value
         ndlib.addAnnotationData_ctype(volume, cube, volume.cubes.zyx, volume.dim.zyx)
     else:
@@ -340,19 +939,57 @@ def downsample_cube(volume, cube, is_annotation):
 
             cube[z, :, :] = Buffer.asarray(image.resize((cube.shape.x, cube.shape.y), Image.BILINEAR))
 
+def morton_targets(morton_range, start, stop, block):
+    """Convert a range of block Morton IDs into volume corners
+
+    Args:
+        morton_range (list[int]) : [first, stop) Morton IDs of the block coordinates
+        start (XYZ) : First cube of the frame being downsampled
+        stop (XYZ) : Last cube (exclusive) of the frame being downsampled
+        block (XYZ) : Number of cubes in each volume
+
+    Returns:
+        list[XYZ] : Corners of the volumes in the range that overlap the frame
+    """
+    targets = []
+    first, last = morton_range
+    for morton in range(first, last):
+        target = XYZ.from_morton(morton) * block
+        if all(start[i] - block[i] < target[i] < stop[i] for i in range(3)):
+            targets.append(target)
+    return targets
+
 def handler(args, context):
-    """Convert JSON arguments into the expected internal types"""
+    """Convert JSON arguments into the expected internal types
+
+    Either a single 'target', a list of 'targets', or a 'morton_range' of block
+    Morton IDs with the 'start' and 'stop' cubes of the frame can be given.
+    """
     def convert(key):
         args[key] = XYZ(*args[key])
 
-    convert('target')
     convert('step')
     convert('dim')
 
-    downsample_volume(args['args'], args['target'], args['step'], args['dim'], args['use_iso_flag'], args['index_annotations'])
+    levels = args.get('levels', 1)
+
+    if 'targets' in args:
+        targets = [XYZ(*target) for target in args['targets']]
+    elif 'morton_range' in args:
+        step = args['step']
+        block = XYZ(step.x ** levels, step.y ** levels, step.z ** levels)
+        targets = morton_targets(args['morton_range'], XYZ(*args['start']), XYZ(*args['stop']), block)
+    else:
+        targets = [XYZ(*args['target'])]
+
+    downsample_volumes(args['args'], targets, args['step'], args['dim'], args['use_iso_flag'], args['index_annotations'],
+                       levels = levels, fuse_anisotropic = args.get('fuse_anisotropic', False))
 
 ## Entry point for multiLambda ##
-log.debug("sys.argv[1]: " + sys.argv[1])
-args = json.loads(sys.argv[1])
-handler(args, None)
+# The lambda loader runs this file with runpy.run_path, so only execute the
+# handler when run as a script, not when imported (by tests or benchmarks)
+if __name__ in ('__main__', '<run_path>'):
+    log.debug("sys.argv[1]: " + sys.argv[1])
+    args = json.loads(sys.argv[1])
+    handler(args, None)
 
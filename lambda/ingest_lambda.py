@@ -5,7 +5,7 @@ import sys
 import json
 import time
 
-from spdb.spatialdb import Cube, SpatialDB, SpdbError
+from spdb.spatialdb import Cube, SpatialDB
 from spdb.project import BossResourceBasic
 from spdb.c_lib.ndtype import CUBOIDSIZE
 from spdb.c_lib.ndlib import XYZMorton
@@ -17,13 +17,17 @@ from ndingest.ndqueue.ingestqueue import IngestQueue
 from ndingest.ndbucket.tilebucket import TileBucket
 from ndingest.util.bossutil import BossUtil
 
-from io import BytesIO
-from PIL import Image
-import numpy as np
+from bossutils.dirty_cubes import DirtyCubeTracker
+from bossutils.compression import Compressor
+from bossutils.ingest import TileSlab, write_cuboids, cuboid_memory
+from bossutils.ingest import MAX_TILE_THREADS, MAX_WRITE_THREADS, CUBOIDS_PER_THREAD
+from bossutils.metrics import StageMetrics
+
+from concurrent.futures import ThreadPoolExecutor
 import math
+import blosc
 import boto3
 
-print("$$$ IN INGEST LAMBDA $$$")
 # Load settings
 SETTINGS = BossSettings.load()
 
@@ -35,209 +39,248 @@ event = json.loads(json_event)
 proj_info = BossIngestProj.fromSupercuboidKey(event["chunk_key"])
 proj_info.job_id = event["ingest_job"]
 
-# Handle up to 2 messages before quitting (helps deal with making sure all messages get processed)
-run_cnt = 0
-while run_cnt < 1:   # Adjusted count down to 1 as lambda is crashing with full memory when pulling off more than 1.
-    # Get message from SQS flush queue, try for ~2 seconds
-    rx_cnt = 0
-    msg_data = None
-    msg_id = None
-    msg_rx_handle = None
-    while rx_cnt < 6:
-        ingest_queue = IngestQueue(proj_info)
-        msg = [x for x in ingest_queue.receiveMessage()]
-        if msg:
-            msg = msg[0]
-            print("MESSAGE: {}".format(msg))
-            print(len(msg))
-            msg_id = msg[0]
-            msg_rx_handle = msg[1]
-            msg_data = json.loads(msg[2])
-            print("MESSAGE DATA: {}".format(msg_data))
-            break
-        else:
-            rx_cnt += 1
-            print("No message found. Try {} of 6".format(rx_cnt))
-            time.sleep(1)
-
-    if not msg_id:
-        # Nothing to flush. Exit.
-        sys.exit("No ingest message available")
-
-    # Get the write-cuboid key to flush
-    chunk_key = msg_data['chunk_key']
-    print("Ingesting Chunk {}".format(chunk_key))
-
-    # Setup SPDB instance
-    sp = SpatialDB(msg_data['parameters']["KVIO_SETTINGS"],
-                   msg_data['parameters']["STATEIO_CONFIG"],
-                   msg_data['parameters']["OBJECTIO_CONFIG"])
-
-    # Get tile list from Tile Index Table
-    tile_index_db = BossTileIndexDB(proj_info.project_name)
-    # tile_index_result (dict): keys are S3 object keys of the tiles comprising the chunk.
-    tile_index_result = tile_index_db.getCuboid(msg_data["chunk_key"], int(msg_data["ingest_job"]))
-    if tile_index_result is None:
-        # Remove message so it's not redelivered.
-        ingest_queue.deleteMessage(msg_id, msg_rx_handle)
-        sys.exit("Aborting due to chunk key missing from tile index table")
-
-    # Sort the tile keys
-    print("Tile Keys: {}".format(tile_index_result["tile_uploaded_map"]))
-    tile_key_list = [x.rsplit("&", 2) for x in tile_index_result["tile_uploaded_map"].keys()]
-    tile_key_list = sorted(tile_key_list, key=lambda x: int(x[1]))
-    tile_key_list = ["&".join(x) for x in tile_key_list]
-    print("Sorted Tile Keys: {}".format(tile_key_list))
-
-    # Augment Resource JSON data so it will instantiate properly that was pruned due to S3 metadata size limits
-    resource_dict = msg_data['parameters']['resource']
-    _, exp_name, ch_name = resource_dict["boss_key"].split("&")
-
-    resource_dict["channel"]["name"] = ch_name
-    resource_dict["channel"]["description"] = ""
-    resource_dict["channel"]["sources"] = []
-    resource_dict["channel"]["related"] = []
-    resource_dict["channel"]["default_time_sample"] = 0
-    resource_dict["channel"]["downsample_status"] = "NOT_DOWNSAMPLED"
-
-    resource_dict["experiment"]["name"] = exp_name
-    resource_dict["experiment"]["description"] = ""
-    resource_dict["experiment"]["num_time_samples"] = 1
-    resource_dict["experiment"]["time_step"] = None
-    resource_dict["experiment"]["time_step_unit"] = None
-
-    resource_dict["coord_frame"]["name"] = "cf"
-    resource_dict["coord_frame"]["name"] = ""
-    resource_dict["coord_frame"]["x_start"] = 0
-    resource_dict["coord_frame"]["x_stop"] = 100000
-    resource_dict["coord_frame"]["y_start"] = 0
-    resource_dict["coord_frame"]["y_stop"] = 100000
-    resource_dict["coord_frame"]["z_start"] = 0
-    resource_dict["coord_frame"]["z_stop"] = 100000
-    resource_dict["coord_frame"]["voxel_unit"] = "nanometers"
-
-    # Setup the resource
-    resource = BossResourceBasic()
-    resource.from_dict(resource_dict)
-    dtype = resource.get_numpy_data_type()
-
-    # read all tiles from bucket into a slab
-    tile_bucket = TileBucket(proj_info.project_name)
-    data = []
-    num_z_slices = 0
-    for tile_key in tile_key_list:
+# Number of tile fetch / decode threads
+tile_threads = event.get('tile_fetch_threads', MAX_TILE_THREADS)
+
+# MB a chunk can use once decoded, larger chunks are processed in windows of cuboid columns
+memory_limit = event.get('memory_limit')
+
+# Threads to upload and index the cuboids of each window with, and the number of cuboids they can hold
+write_threads = event.get('cuboid_write_threads', MAX_WRITE_THREADS)
+write_executor = ThreadPoolExecutor(max_workers=write_threads)
+max_cuboids = write_threads * CUBOIDS_PER_THREAD
+
+# Compresses the cuboids on all vCPUs, with the blosc settings for each data type
+# (see bossutils.compression.codec_settings)
+# Not shared across invocations, so its metrics are the invocation's. Closed at the end
+blosc.set_releasegil(True)
+compressor = Compressor(event.get('compression'), event.get('compression_threads'))
+
+# Stage timings, emitted as a single record at the end of the invocation
+# 'metrics_sample_rate' is the fraction of invocations that emit their record
+metrics = StageMetrics('ingest_lambda', event.get('metrics_sample_rate', 1.0))
+chunk_keys = []
+
+def emit_metrics(status):
+    stats = compressor.metrics()
+    if stats['count'] > 0:
+        metrics.add('compress', stats['seconds'], stats['count'])
+    metrics.emit(status=status, chunk_keys=chunk_keys, compression_ratio=stats['ratio'])
+
+# Handle up to max_messages messages before quitting (helps deal with making sure all messages get processed)
+# Defaults to 1 as lambda was crashing with full memory when pulling off more than 1. Set a memory_limit
+# to bound the memory used by each chunk when handling more.
+# Emitted however the invocation ends, 'error' if an exception was raised
+status = 'error'
+try:
+    run_cnt = 0
+    while run_cnt < event.get('max_messages', 1):
+        # Get message from SQS flush queue, try for ~2 seconds
+        rx_cnt = 0
+        msg_data = None
+        msg_id = None
+        msg_rx_handle = None
+        while rx_cnt < 6:
+            ingest_queue = IngestQueue(proj_info)
+            msg = [x for x in ingest_queue.receiveMessage()]
+            if msg:
+                msg = msg[0]
+                msg_id = msg[0]
+                msg_rx_handle = msg[1]
+                msg_data = json.loads(msg[2])
+                break
+            else:
+                rx_cnt += 1
+                print("No message found. Try {} of 6".format(rx_cnt))
+                time.sleep(1)
+
+        if not msg_id:
+            if run_cnt > 0:
+                # Already processed a message
+                break
+            # Nothing to flush. Exit.
+            status = 'no_message'
+            sys.exit("No ingest message available")
+
+        # Get the write-cuboid key to flush
+        chunk_key = msg_data['chunk_key']
+        chunk_keys.append(chunk_key)
+        metrics.count('messages')
+
+        # Setup SPDB instance
+        sp = SpatialDB(msg_data['parameters']["KVIO_SETTINGS"],
+                       msg_data['parameters']["STATEIO_CONFIG"],
+                       msg_data['parameters']["OBJECTIO_CONFIG"])
+
+        # Get tile list from Tile Index Table
+        tile_index_db = BossTileIndexDB(proj_info.project_name)
+        # tile_index_result (dict): keys are S3 object keys of the tiles comprising the chunk.
+        tile_index_result = tile_index_db.getCuboid(msg_data["chunk_key"], int(msg_data["ingest_job"]))
+        if tile_index_result is None:
+            # Remove message so it's not redelivered.
+            ingest_queue.deleteMessage(msg_id, msg_rx_handle)
+            status = 'missing_chunk'
+            sys.exit("Aborting due to chunk key missing from tile index table")
+
+        # Sort the tile keys
+        tile_key_list = [x.rsplit("&", 2) for x in tile_index_result["tile_uploaded_map"].keys()]
+        tile_key_list = sorted(tile_key_list, key=lambda x: int(x[1]))
+        tile_key_list = ["&".join(x) for x in tile_key_list]
+        metrics.count('tiles', len(tile_key_list))
+
+        # Augment Resource JSON data so it will instantiate properly that was pruned due to S3 metadata size limits
+        resource_dict = msg_data['parameters']['resource']
+        _, exp_name, ch_name = resource_dict["boss_key"].split("&")
+
+        resource_dict["channel"]["name"] = ch_name
+        resource_dict["channel"]["description"] = ""
+        resource_dict["channel"]["sources"] = []
+        resource_dict["channel"]["related"] = []
+        resource_dict["channel"]["default_time_sample"] = 0
+        resource_dict["channel"]["downsample_status"] = "NOT_DOWNSAMPLED"
+
+        resource_dict["experiment"]["name"] = exp_name
+        resource_dict["experiment"]["description"] = ""
+        resource_dict["experiment"]["num_time_samples"] = 1
+        resource_dict["experiment"]["time_step"] = None
+        resource_dict["experiment"]["time_step_unit"] = None
+
+        resource_dict["coord_frame"]["name"] = "cf"
+        resource_dict["coord_frame"]["name"] = ""
+        resource_dict["coord_frame"]["x_start"] = 0
+        resource_dict["coord_frame"]["x_stop"] = 100000
+        resource_dict["coord_frame"]["y_start"] = 0
+        resource_dict["coord_frame"]["y_stop"] = 100000
+        resource_dict["coord_frame"]["z_start"] = 0
+        resource_dict["coord_frame"]["z_stop"] = 100000
+        resource_dict["coord_frame"]["voxel_unit"] = "nanometers"
+
+        # Setup the resource
+        resource = BossResourceBasic()
+        resource.from_dict(resource_dict)
+        dtype = resource.get_numpy_data_type()
+
+        # read all tiles from bucket into a slab
+        tile_bucket = TileBucket(proj_info.project_name)
+        tiles = None # Release the previous message's slab first
+        tiles = TileSlab(tile_key_list, dtype, metrics, lambda: TileBucket(proj_info.project_name),
+                         tile_threads, memory_limit, cuboid_memory(CUBOIDSIZE[proj_info.resolution], dtype, max_cuboids))
         try:
-            image_data, message_id, receipt_handle, _ = tile_bucket.getObjectByKey(tile_key)
-        except KeyError:
-            print('Key: {} not found in tile bucket, assuming redelivered SQS message and aborting.'.format(
-                tile_key))
+            tiles.fetch()
+        except KeyError as ex:
+            print('Key: {} not found in tile bucket, assuming redelivered SQS message and aborting.'.format(ex))
             # Remove message so it's not redelivered.
             ingest_queue.deleteMessage(msg_id, msg_rx_handle)
+            status = 'missing_tile'
             sys.exit("Aborting due to missing tile in bucket")
 
-        tile_img = np.asarray(Image.open(BytesIO(image_data)), dtype=dtype)
-        data.append(tile_img)
-        num_z_slices += 1
-
-    # Make 3D array of image data. It should be in XYZ at this point
-    chunk_data = np.array(data)
-    del data
-    tile_dims = chunk_data.shape
-
-    # Break into Cube instances
-    print("Tile Dims: {}".format(tile_dims))
-    print("Num Z Slices: {}".format(num_z_slices))
-    num_x_cuboids = int(math.ceil(tile_dims[2] / CUBOIDSIZE[proj_info.resolution][0]))
-    num_y_cuboids = int(math.ceil(tile_dims[1] / CUBOIDSIZE[proj_info.resolution][1]))
-
-    print("Num X Cuboids: {}".format(num_x_cuboids))
-    print("Num Y Cuboids: {}".format(num_y_cuboids))
-
-    # Cuboid List
-    cuboids = []
-    chunk_key_parts = BossUtil.decode_chunk_key(chunk_key)
-    t_index = chunk_key_parts['t_index']
-    for x_idx in range(0, num_x_cuboids):
-        for y_idx in range(0, num_y_cuboids):
-            # TODO: check time series support
-            cube = Cube.create_cube(resource, CUBOIDSIZE[proj_info.resolution])
-            cube.zeros()
-
-            # Compute Morton ID
-            # TODO: verify Morton indices correct!
-            print(chunk_key_parts)
-            morton_x_ind = x_idx + (chunk_key_parts["x_index"] * num_x_cuboids)
-            morton_y_ind = y_idx + (chunk_key_parts["y_index"] * num_y_cuboids)
-            print("Morton X: {}".format(morton_x_ind))
-            print("Morton Y: {}".format(morton_y_ind))
-            morton_index = XYZMorton([morton_x_ind, morton_y_ind, int(chunk_key_parts['z_index'])])
-
-            # Insert sub-region from chunk_data into cuboid
-            x_start = x_idx * CUBOIDSIZE[proj_info.resolution][0]
-            x_end = x_start + CUBOIDSIZE[proj_info.resolution][0]
-            x_end = min(x_end, tile_dims[2])
-            y_start = y_idx * CUBOIDSIZE[proj_info.resolution][1]
-            y_end = y_start + CUBOIDSIZE[proj_info.resolution][1]
-            y_end = min(y_end, tile_dims[1])
-            z_end = CUBOIDSIZE[proj_info.resolution][2]
-            # TODO: get sub-array w/o making a copy.
-            print("Yrange: {}".format(y_end - y_start))
-            print("Xrange: {}".format(x_end - x_start))
-            print("X start: {}".format(x_start))
-            print("X stop: {}".format(x_end))
-            cube.data[0, 0:num_z_slices, 0:(y_end - y_start), 0:(x_end - x_start)] = chunk_data[0:num_z_slices,
-                                                                                 y_start:y_end, x_start:x_end]
-
-            # Create object key
-            object_key = sp.objectio.generate_object_key(resource, proj_info.resolution, t_index, morton_index)
-            print("Object Key: {}".format(object_key))
-
-            # Put object in S3
-            sp.objectio.put_objects([object_key], [cube.to_blosc()])
-
-            # Add object to index
-            sp.objectio.add_cuboid_to_index(object_key, ingest_job=int(msg_data["ingest_job"]))
-
-            # Update id indices if this is an annotation channel
-            if resource.data['channel']['type'] == 'annotation':
+        # Shape of the 3D array of image data, in ZYX
+        tile_dims = tiles.shape
+        num_z_slices = tile_dims[0]
+
+        # Break into Cube instances
+        num_x_cuboids = int(math.ceil(tile_dims[2] / CUBOIDSIZE[proj_info.resolution][0]))
+        num_y_cuboids = int(math.ceil(tile_dims[1] / CUBOIDSIZE[proj_info.resolution][1]))
+
+        # Cuboid List
+        cuboids = []
+        mortons = []
+        chunk_key_parts = BossUtil.decode_chunk_key(chunk_key)
+        t_index = chunk_key_parts['t_index']
+        cuboid_size = CUBOIDSIZE[proj_info.resolution]
+        for win_y_start, win_y_stop, win_x_start, win_x_stop in tiles.windows(cuboid_size):
+            # Image data for the window's cuboids
+            chunk_data = tiles.window(win_y_start, win_y_stop, win_x_start, win_x_stop)
+
+            def window_cuboids():
+                """Assemble the window's cuboids as write_cuboids takes them"""
+                for x_idx in range(win_x_start // cuboid_size[0], int(math.ceil(win_x_stop / cuboid_size[0]))):
+                    for y_idx in range(win_y_start // cuboid_size[1], int(math.ceil(win_y_stop / cuboid_size[1]))):
+                        assemble_start = time.perf_counter()
+
+                        # TODO: check time series support
+                        cube = Cube.create_cube(resource, CUBOIDSIZE[proj_info.resolution])
+                        cube.zeros()
+
+                        # Compute Morton ID
+                        # TODO: verify Morton indices correct!
+                        morton_x_ind = x_idx + (chunk_key_parts["x_index"] * num_x_cuboids)
+                        morton_y_ind = y_idx + (chunk_key_parts["y_index"] * num_y_cuboids)
+                        morton_index = XYZMorton([morton_x_ind, morton_y_ind, int(chunk_key_parts['z_index'])])
+                        mortons.append(morton_index)
+
+                        # Insert sub-region from chunk_data into cuboid
+                        x_start = x_idx * CUBOIDSIZE[proj_info.resolution][0]
+                        x_end = x_start + CUBOIDSIZE[proj_info.resolution][0]
+                        x_end = min(x_end, tile_dims[2])
+                        y_start = y_idx * CUBOIDSIZE[proj_info.resolution][1]
+                        y_end = y_start + CUBOIDSIZE[proj_info.resolution][1]
+                        y_end = min(y_end, tile_dims[1])
+                        z_end = CUBOIDSIZE[proj_info.resolution][2]
+                        # TODO: get sub-array w/o making a copy.
+                        cube.data[0, 0:num_z_slices, 0:(y_end - y_start), 0:(x_end - x_start)] = chunk_data[0:num_z_slices,
+                                                                                             y_start - win_y_start:y_end - win_y_start,
+                                                                                             x_start - win_x_start:x_end - win_x_start]
+
+                        # Create object key
+                        object_key = sp.objectio.generate_object_key(resource, proj_info.resolution, t_index, morton_index)
+
+                        metrics.add('assemble', time.perf_counter() - assemble_start)
+                        metrics.count('cuboids')
+                        yield object_key, cube
+
+            # Put objects in S3 and add them to the indices
+            errors = write_cuboids(sp, resource, proj_info.resolution, window_cuboids(), int(msg_data["ingest_job"]),
+                                   msg_data['parameters']["OBJECTIO_CONFIG"]["s3_index_table"], write_executor,
+                                   compressor, metrics, max_cuboids)
+
+            for ex in errors:
+                sns_client = boto3.client('sns')
+                topic_arn = msg_data['parameters']["OBJECTIO_CONFIG"]["prod_mailing_list"]
+                msg = 'During ingest:\n{}\nCollection: {}\nExperiment: {}\n Channel: {}\n'.format(
+                    ex.message,
+                    resource.data['collection']['name'],
+                    resource.data['experiment']['name'],
+                    resource.data['channel']['name'])
+                sns_client.publish(
+                    TopicArn=topic_arn,
+                    Subject='Object services misuse',
+                    Message=msg)
+
+        # Record the new cuboids for incremental downsampling
+        dirty_cube_table = msg_data['parameters']["OBJECTIO_CONFIG"].get("dirty_cube_table")
+        if dirty_cube_table and proj_info.resolution == 0:
+            tracker = DirtyCubeTracker(dirty_cube_table)
+            tracker.mark(DirtyCubeTracker.channel_key(resource.get_lookup_key(), 0, t_index), mortons)
+
+        # Delete message since it was processed successfully
+        ingest_queue.deleteMessage(msg_id, msg_rx_handle)
+
+        # Delete Tiles
+        for tile in tile_key_list:
+            for try_cnt in range(0, 4):
                 try:
-                    sp.objectio.update_id_indices(
-                        resource, proj_info.resolution, [object_key], [cube.data])
-                except SpdbError as ex:
-                    sns_client = boto3.client('sns')
-                    topic_arn = msg_data['parameters']["OBJECTIO_CONFIG"]["prod_mailing_list"]
-                    msg = 'During ingest:\n{}\nCollection: {}\nExperiment: {}\n Channel: {}\n'.format(
-                        ex.message,
-                        resource.data['collection']['name'],
-                        resource.data['experiment']['name'],
-                        resource.data['channel']['name'])
-                    sns_client.publish(
-                        TopicArn=topic_arn,
-                        Subject='Object services misuse',
-                        Message=msg)
-
-    # Delete message since it was processed successfully
-    ingest_queue.deleteMessage(msg_id, msg_rx_handle)
-
-    # Delete Tiles
-    for tile in tile_key_list:
+                    time.sleep(try_cnt)
+                    tile_bucket.deleteObject(tile)
+                    break
+                except:
+                    print("failed")
+
+        # Delete Entry in tile table
         for try_cnt in range(0, 4):
             try:
                 time.sleep(try_cnt)
-                print("Deleting tile: {}".format(tile))
-                tile_bucket.deleteObject(tile)
+                tile_index_db.deleteCuboid(chunk_key, int(msg_data["ingest_job"]))
                 break
             except:
                 print("failed")
 
-    # Delete Entry in tile table
-    for try_cnt in range(0, 4):
-        try:
-            time.sleep(try_cnt)
-            tile_index_db.deleteCuboid(chunk_key, int(msg_data["ingest_job"]))
-            break
-        except:
-            print("failed")
-
-    # Increment run counter
-    run_cnt += 1
+        # Increment run counter
+        run_cnt += 1
+
+    status = 'ok'
+finally:
+    # The lambda loader re-runs this script for each invocation, don't leave the threads running
+    write_executor.shutdown()
+    compressor.close()
+    emit_metrics(status)
@@ -0,0 +1 @@
+../lambda/downsample_volume.py
\ No newline at end of file
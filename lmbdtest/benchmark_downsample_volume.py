@@ -0,0 +1,267 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local benchmark for the downsample_volume lambda
+
+Runs downsample_volume against in memory stand-ins for the S3 bucket and the
+DynamoDB tables, so throughput can be measured without AWS. Each case is run
+in a separate process so that the peak RSS of the case can be reported.
+
+Reported for each case:
+    cubes/s : Source cubes downsampled per second
+    MB/s : Uncompressed source data downsampled per second
+    fetch, decompress, downsample, compress, put, index : Seconds spent in
+        each stage. Stages run on multiple threads are summed across the
+        threads, so they can add up to more than the wall time
+    peak RSS : Peak resident memory of the process running the case
+
+Usage:
+    python3 -m lmbdtest.benchmark_downsample_volume [--targets N] [--latency S] ...
+"""
+
+import argparse
+import resource
+import threading
+import time
+import blosc
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+# lambdafcns is a symbolic link to boss-tools/lambda
+import lambdafcns.downsample_volume as dv
+from lmbdtest.fakes import MemoryS3Bucket, MemoryDynamoDBTable, make_args
+from bossutils.multidimensional import XYZ
+from bossutils.multidimensional import range as xyz_range
+from spdb.c_lib.ndtype import CUBOIDSIZE
+
+DATA_TYPES = ('uint8', 'uint16', 'uint64')
+TYPES = ('anisotropic', 'isotropic')
+DENSITIES = ('dense', 'sparse')
+
+# float: Fraction of the source cubes of each volume that exist for a 'sparse' case
+SPARSE_FRACTION = 0.25
+
+class StageTimer(object):
+    """Thread safe accumulator of the time spent in each stage"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = defaultdict(float)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.times[stage] += seconds
+
+    def wrap(self, stage, func):
+        """Wrap the function so that its run time is added to the stage"""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+class TimedBlosc(object):
+    """Proxy for the blosc module that times decompression
+
+    Compression is timed by the downsample_volume cube_compressor
+    """
+    def __init__(self, timer):
+        self.decompress_ptr = timer.wrap('decompress', blosc.decompress_ptr)
+
+    def __getattr__(self, name):
+        return getattr(blosc, name)
+
+def make_cube(data_type, dim, seed):
+    """Create the data for a single cube
+
+    Image cubes are smooth gradients with noise, annotation cubes are blocks
+    of IDs, so both compress in a similar way to real data.
+    """
+    rng = np.random.RandomState(seed)
+    dtype = dv.np_types[data_type]
+    if data_type == 'uint64':
+        ids = rng.randint(1, 1000, size=(dim.z, dim.y // 64, dim.x // 64)).astype(dtype)
+        return np.ascontiguousarray(ids.repeat(64, axis=1).repeat(64, axis=2))
+    else:
+        max_ = np.iinfo(dtype).max
+        z, y, x = np.ogrid[0:dim.z, 0:dim.y, 0:dim.x]
+        data = (x + y + z) * (max_ // (dim.x + dim.y + dim.z)) + rng.randint(0, max_ // 16, size=dim.zyx)
+        return data.astype(dtype)
+
+def populate(store, args, targets, step, dim, density, seed=0):
+    """Upload the source cubes for the given targets into the store
+
+    Returns:
+        (int, int): Number of cubes uploaded and their uncompressed size in bytes
+    """
+    rng = np.random.RandomState(seed)
+    count, nbytes = 0, 0
+    offsets = list(xyz_range(step))
+    for target in targets:
+        if density == 'sparse':
+            # At least one cube, so that every target is downsampled
+            num = max(1, int(len(offsets) * SPARSE_FRACTION))
+            selected = [offsets[i] for i in rng.choice(len(offsets), num, replace=False)]
+        else:
+            selected = offsets
+
+        for offset in selected:
+            cube = target + offset
+            data = make_cube(args['data_type'], dim, seed + count)
+            key = dv.HashedKey(None, args['collection_id'], args['experiment_id'], args['channel_id'],
+                               args['resolution'], 0, cube.morton, version=0)
+            store[key] = blosc.compress(data, typesize=data.dtype.itemsize)
+            count += 1
+            nbytes += data.nbytes
+    return count, nbytes
+
+def run_case(data_type, type_, density, num_targets, latency, method):
+    """Run a single benchmark case
+
+    Returns:
+        dict: The measurements of the case
+    """
+    args = make_args(data_type, type_)
+    if method is not None:
+        args['downsample_method'] = method
+    step = XYZ(2, 2, 2) if type_ == 'isotropic' else XYZ(2, 2, 1)
+    dim = XYZ(*CUBOIDSIZE[0])
+    targets = [XYZ(i, 0, 0) * step for i in range(num_targets)]
+
+    store = {}
+    cubes, nbytes = populate(store, args, targets, step, dim, density)
+
+    timer = StageTimer()
+    tables = defaultdict(dict)
+    dv.blosc = TimedBlosc(timer)
+    dv.downsample_cube = timer.wrap('downsample', dv.downsample_cube)
+    dv.S3Bucket = lambda bucket: MemoryS3Bucket(store, latency, timer)
+    dv.DynamoDBTable = lambda table: MemoryDynamoDBTable(tables[table],
+                                                         ('channel-id-key', 'version')
+                                                         if table == args['id_index'] else
+                                                         ('object-key', 'version-node'),
+                                                         latency, timer)
+
+    start = time.perf_counter()
+    dv.downsample_volumes(args, targets, step, dim, False, True)
+    wall = time.perf_counter() - start
+    timer.add('compress', dv.cube_compressor(args).metrics()['seconds'])
+
+    result = {
+        'case': '{} {} {}'.format(data_type, type_, density),
+        'cubes': cubes,
+        'wall': wall,
+        'cubes/s': cubes / wall,
+        'MB/s': nbytes / wall / 2**20,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, # KiB -> MiB
+    }
+    result.update(timer.times)
+    return result
+
+def run_downsample_cube(data_type, type_, repeat, method):
+    """Benchmark just downsample_cube on a full volume
+
+    Returns:
+        dict: The measurements of the case
+    """
+    step = XYZ(2, 2, 2) if type_ == 'isotropic' else XYZ(2, 2, 1)
+    dim = XYZ(*CUBOIDSIZE[0])
+
+    volume = dv.Buffer.zeros(dim * step, dtype=dv.np_types[data_type])
+    for offset in xyz_range(step):
+        volume[offset * dim: (offset + 1) * dim] = make_cube(data_type, dim, offset.morton)
+    volume.dim = dim
+    volume.cubes = step
+
+    cube = dv.Buffer.zeros(dim, dtype=volume.dtype)
+    cube.dim = dim
+    cube.cubes = XYZ(1, 1, 1)
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        dv.downsample_cube(volume, cube, data_type == 'uint64', method)
+    wall = time.perf_counter() - start
+
+    return {
+        'case': 'downsample_cube {} {}'.format(data_type, type_),
+        'cubes/s': repeat * step.x * step.y * step.z / wall,
+        'MB/s': repeat * volume.nbytes / wall / 2**20,
+    }
+
+STAGES = ('fetch', 'decompress', 'downsample', 'compress', 'put', 'index')
+
+def print_results(results):
+    header = '{:<28} {:>6} {:>8} {:>8} {:>8}'.format('case', 'cubes', 'cubes/s', 'MB/s', 'RSS MB')
+    header += ''.join(' {:>10}'.format(stage) for stage in STAGES)
+    print(header)
+    for result in results:
+        line = '{:<28} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}'.format(result['case'],
+                                                                result['cubes'],
+                                                                result['cubes/s'],
+                                                                result['MB/s'],
+                                                                result['peak_rss'])
+        line += ''.join(' {:>10.3f}'.format(result.get(stage, 0.0)) for stage in STAGES)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the downsample_volume lambda locally")
+    parser.add_argument('--targets', type = int, default = 4,
+                        help = "Number of volumes to downsample per case")
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = "Simulated seconds of latency for each S3 / DynamoDB request")
+    parser.add_argument('--method', default = None,
+                        help = "bossutils.downsample reducer to use, instead of the default resize")
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = "Number of downsample_cube calls to time")
+    parser.add_argument('--data-type', choices = DATA_TYPES, action = 'append',
+                        help = "Data types to benchmark (default all)")
+    parser.add_argument('--type', choices = TYPES, action = 'append',
+                        help = "Downsample types to benchmark (default all)")
+    parser.add_argument('--density', choices = DENSITIES, action = 'append',
+                        help = "Volume densities to benchmark (default all)")
+    args = parser.parse_args()
+
+    results = []
+    for data_type in args.data_type or DATA_TYPES:
+        # The default image resize doesn't support uint64
+        method = args.method
+        if data_type == 'uint64' and method is not None and method not in dv.ANNOTATION_REDUCERS:
+            method = None
+
+        for type_ in args.type or TYPES:
+            for density in args.density or DENSITIES:
+                # A new process per case, so peak RSS is measured per case
+                with ProcessPoolExecutor(max_workers = 1) as executor:
+                    future = executor.submit(run_case, data_type, type_, density,
+                                             args.targets, args.latency, method)
+                    results.append(future.result())
+
+    print_results(results)
+    print()
+
+    for data_type in args.data_type or DATA_TYPES:
+        method = args.method
+        if data_type == 'uint64' and method is not None and method not in dv.ANNOTATION_REDUCERS:
+            method = None
+
+        for type_ in args.type or TYPES:
+            result = run_downsample_cube(data_type, type_, args.repeat, method)
+            print('{:<40} {:>8.1f} cubes/s {:>8.1f} MB/s'.format(result['case'],
+                                                               result['cubes/s'],
+                                                               result['MB/s']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In memory stand-ins for the AWS resources used by downsample_volume
+
+Shared by the downsample_volume tests and benchmark.
+"""
+
+import threading
+import time
+
+class MemoryS3Bucket(object):
+    """In memory stand-in for downsample_volume.S3Bucket
+
+    Args:
+        store (dict): Object key to data of the bucket
+        latency (float): Seconds each request sleeps for, to simulate the
+                         S3 round trip
+        timer (optional[StageTimer]): Records the 'fetch' and 'put' times
+                                      (see benchmark_downsample_volume)
+    """
+    def __init__(self, store, latency=0.0, timer=None):
+        self.store = store
+        self.latency = latency
+        if timer is not None:
+            self.get = timer.wrap('fetch', self.get)
+            self.put = timer.wrap('put', self.put)
+
+    def get(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return self.store[key]
+        except KeyError:
+            raise Exception("No Such Key")
+
+    def put(self, key, data):
+        if self.latency:
+            time.sleep(self.latency)
+        self.store[key] = bytes(data)
+
+class MemoryDynamoDBTable(object):
+    """In memory stand-in for downsample_volume.DynamoDBTable
+
+    Items are stored by the values of their key attributes.
+
+    Args:
+        items (dict): Key to item of the table
+        key_names (tuple): Names of the key attributes of the table
+        latency (float): Seconds each request sleeps for
+        timer (optional[StageTimer]): Records the 'index' times
+                                      (see benchmark_downsample_volume)
+    """
+    def __init__(self, items, key_names, latency=0.0, timer=None):
+        self.items = items
+        self.key_names = key_names
+        self.latency = latency
+        self.lock = threading.Lock()
+        if timer is not None:
+            for name in ('put', 'get', 'exists', 'update_ids', 'update_id', 'update_digest'):
+                setattr(self, name, timer.wrap('index', getattr(self, name)))
+
+    def _key(self, item):
+        if self.latency:
+            time.sleep(self.latency)
+        return tuple(list(item[name].values())[0] for name in self.key_names)
+
+    def _add(self, key, attr, type_, values):
+        with self.lock:
+            item = self.items.setdefault(self._key(key), dict(key))
+            current = item.setdefault(attr, {type_: []})[type_]
+            current.extend(v for v in values if v not in current)
+
+    def put(self, item):
+        with self.lock:
+            self.items[self._key(item)] = dict(item)
+
+    def get(self, key):
+        with self.lock:
+            return self.items.get(self._key(key))
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def update_ids(self, key, ids):
+        self._add(key, 'id-set', 'NS', ids)
+
+    def update_id(self, key, obj_key):
+        self._add(key, 'cuboid-set', 'SS', [obj_key])
+
+    def update_digest(self, key, digest):
+        with self.lock:
+            self.items[self._key(key)]['content-digest'] = {'S': digest}
+
+def make_args(data_type, type_):
+    """Create downsample_volume arguments that use the in memory bucket and tables"""
+    return {
+        'collection_id': 1,
+        'experiment_id': 2,
+        'channel_id': 3,
+        'annotation_channel': data_type == 'uint64',
+        'data_type': data_type,
+
+        's3_bucket': 'cuboids.benchmark',
+        's3_index': 's3index.benchmark',
+        'id_index': 'idindex.benchmark',
+
+        'resolution': 0,
+        'annotation_index_max': 3,
+
+        'type': type_,
+        'iso_resolution': 3,
+    }
@@ -0,0 +1,155 @@
+# Copyright 2016 The Johns Hopkins University Applied Physics Laboratory
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# lambdafcns is a symbolic link to boss-tools/lambda.  Since lambda is a
+# reserved word, this allows importing downsample_volume.py without
+# updating scripts responsible for deploying the lambda code.
+import lambdafcns.downsample_volume as dv
+from lmbdtest.fakes import MemoryS3Bucket, MemoryDynamoDBTable, make_args
+from bossutils.multidimensional import XYZ
+from spdb.c_lib.ndtype import CUBOIDSIZE
+import blosc
+import numpy as np
+import runpy
+import unittest
+from unittest.mock import patch
+
+class TestDownsampleVolume(unittest.TestCase):
+    def setUp(self):
+        self.store = {}
+        self.tables = {'s3index.benchmark': {}, 'idindex.benchmark': {}}
+        self.args = make_args('uint8', 'anisotropic')
+        self.args['downsample_method'] = 'mean'
+        self.dim = XYZ(*CUBOIDSIZE[0])
+        self.step = XYZ(2, 2, 1)
+
+    def key(self, cube, resolution):
+        return dv.HashedKey(None, 1, 2, 3, resolution, 0, cube.morton, version=0)
+
+    def downsample(self, target, levels=1, use_iso_key=False, fuse_anisotropic=False):
+        def table(name):
+            key_names = ('object-key', 'version-node') if name == 's3index.benchmark' else \
+                        ('channel-id-key', 'version')
+            return MemoryDynamoDBTable(self.tables[name], key_names)
+
+        with patch.object(dv, 'S3Bucket', lambda bucket: MemoryS3Bucket(self.store)), \
+             patch.object(dv, 'DynamoDBTable', table):
+            dv.downsample_volume(self.args, target, self.step, self.dim, use_iso_key, True, levels, fuse_anisotropic)
+
+    def test_downsample_volume(self):
+        for i, cube in enumerate([XYZ(2, 2, 0), XYZ(3, 2, 0), XYZ(2, 3, 0)]):
+            data = np.full(self.dim.zyx, (i + 1) * 40, dtype=np.uint8)
+            self.store[self.key(cube, 0)] = blosc.compress(data, typesize=1)
+
+        self.downsample(XYZ(2, 2, 0))
+
+        data = blosc.decompress(self.store[self.key(XYZ(1, 1, 0), 1)])
+        cube = np.frombuffer(data, dtype=np.uint8).reshape(self.dim.zyx)
+        half = self.dim // 2
+
+        self.assertEqual(cube[0, 0, 0], 40)
+        self.assertEqual(cube[0, 0, half.x], 80)
+        self.assertEqual(cube[0, half.y, 0], 120)
+        self.assertEqual(cube[0, half.y, half.x], 0) # missing cube
+        self.assertEqual(len(self.tables['s3index.benchmark']), 1)
+
+    def test_downsample_volume_empty(self):
+        self.downsample(XYZ(0, 0, 0))
+
+        self.assertEqual(self.store, {})
+        self.assertEqual(self.tables['s3index.benchmark'], {})
+
+    def test_fused_anisotropic(self):
+        """Test that a fused downsample generates the same cubes as separate downsamples"""
+        self.args['iso_resolution'] = 0
+        rng = np.random.RandomState(0)
+        for cube in [XYZ(0, 0, 0), XYZ(1, 0, 1), XYZ(0, 1, 1)]:
+            data = rng.randint(0, 255, size=self.dim.zyx).astype(np.uint8)
+            self.store[self.key(cube, 0)] = blosc.compress(data, typesize=1)
+        source = dict(self.store)
+
+        for z in range(2):
+            self.downsample(XYZ(0, 0, z))
+        self.step = XYZ(2, 2, 2)
+        self.downsample(XYZ(0, 0, 0), use_iso_key = True)
+        expected = self.store
+
+        self.store = dict(source)
+        self.downsample(XYZ(0, 0, 0), use_iso_key = True, fuse_anisotropic = True)
+
+        self.assertEqual(self.store, expected)
+        self.assertEqual(len(expected) - len(source), 3) # two anisotropic cubes and one isotropic
+
+    def test_key_context(self):
+        keys = dv.key_context(self.args, 2, 'ISO')
+        mortons = [XYZ(x, 3, 1).morton for x in range(4)]
+
+        self.assertEqual(keys.cube_keys(mortons, version=0),
+                         [dv.HashedKey('ISO', 1, 2, 3, 2, 0, morton, version=0) for morton in mortons])
+        self.assertEqual(keys.cube_key(mortons[0]), dv.HashedKey('ISO', 1, 2, 3, 2, 0, mortons[0]))
+        self.assertEqual(keys.id_key(42), dv.HashedKey('ISO', 1, 2, 3, 2, 42))
+        self.assertIs(dv.key_context(self.args, 2, 'ISO'), keys)
+
+        # The lambda loader re-runs the script for each invocation
+        rerun = runpy.run_path(dv.__file__, run_name = 'downsample_volume')
+        self.assertIs(rerun['key_context'](self.args, 2, 'ISO'), keys)
+
+    def test_stream_annotations(self):
+        """Test that streaming an annotation volume in slabs gives the same cubes"""
+        self.args = make_args('uint64', 'anisotropic')
+        self.args['downsample_method'] = 'mode'
+        self.dim = XYZ(64, 64, 16)
+        rng = np.random.RandomState(0)
+        for cube in [XYZ(0, 0, 0), XYZ(1, 0, 0), XYZ(3, 3, 0)]:
+            data = rng.randint(0, 4, size=self.dim.zyx).astype(np.uint64)
+            self.store[self.key(cube, 0)] = blosc.compress(data, typesize=8)
+        source = dict(self.store)
+
+        with patch.object(dv, 'CUBOIDSIZE', [[64, 64, 16]] * 8):
+            self.downsample(XYZ(0, 0, 0), levels = 2)
+            expected = self.store
+
+            for axis in ('z', 'y'):
+                self.store = dict(source)
+                self.args['memory_limit'] = 1
+                self.args['slab_axis'] = axis
+                self.downsample(XYZ(0, 0, 0), levels = 2)
+
+                self.assertEqual(self.store, expected)
+
+    def test_skip_unchanged_after_failure(self):
+        """Test that a cube whose ID Index update failed isn't skipped when retried"""
+        self.args = make_args('uint64', 'anisotropic')
+        self.args['downsample_method'] = 'mode'
+        self.args['skip_unchanged'] = True
+        self.dim = XYZ(64, 64, 16)
+        data = np.full(self.dim.zyx, 7, dtype=np.uint64)
+        self.store[self.key(XYZ(0, 0, 0), 0)] = blosc.compress(data, typesize=8)
+
+        def fail(self, key, obj_key):
+            raise Exception("Throttled")
+
+        with patch.object(dv, 'CUBOIDSIZE', [[64, 64, 16]] * 8):
+            with patch.object(MemoryDynamoDBTable, 'update_id', fail):
+                with self.assertRaises(Exception):
+                    self.downsample(XYZ(0, 0, 0))
+            self.assertEqual(self.tables['idindex.benchmark'], {})
+            for item in self.tables['s3index.benchmark'].values():
+                self.assertNotIn('content-digest', item)
+
+            self.downsample(XYZ(0, 0, 0))
+
+        self.assertEqual(len(self.tables['idindex.benchmark']), 1)
+        for item in self.tables['s3index.benchmark'].values():
+            self.assertIn('content-digest', item)